@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compare evaluating enrichment rule conditions with Enrichment.evaluate_condition, which interprets each
+condition dict on every event, and with the predicates that load_from_mongo compiles them into:
+
+    python3 benchmarks/enrichment_conditions.py --rules 3000 --events 200
+"""
+
+import time
+import random
+import argparse
+
+from pdaltagent.enrichment import Enrichment
+
+
+SOURCE_SYSTEMS = ["nagios", "zabbix", "datadog", "splunk", "prometheus"]
+CHECKS = ["cpu", "disk", "memory", "http", "replication", "heartbeat"]
+
+
+def make_rules(count, seed=0):
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            when = {"=": ["source_system", rnd.choice(SOURCE_SYSTEMS)]}
+        elif kind == 1:
+            when = {"AND": [
+                {"=": ["source_system", rnd.choice(SOURCE_SYSTEMS)]},
+                {"IN": ["check", rnd.sample(CHECKS, 3)]},
+            ]}
+        elif kind == 2:
+            when = {"AND": [
+                {"=": ["host", {"type": "regex", "value": f"web-{rnd.randint(0, 99)}*"}]},
+                {"NOT IN": ["env", ["dev", "test"]]},
+            ]}
+        else:
+            when = {"OR": [
+                {"=": ["check", rnd.choice(CHECKS)]},
+                {"=": [".payload.source", {"type": "formal-regex", "value": f"^db-{rnd.randint(0, 99)}\\."}]},
+            ]}
+        rules.append({"id": str(i), "type": "composition", "active": True, "when": when})
+    return rules
+
+
+def make_events(count, seed=0):
+    rnd = random.Random(seed)
+    events = []
+    for i in range(count):
+        host = f"{rnd.choice(['web', 'db'])}-{rnd.randint(0, 99)}.prod.example.com"
+        events.append({
+            "payload": {
+                "summary": f"check failed on {host}",
+                "source": host,
+                "severity": "critical",
+                "custom_details": {
+                    "source_system": rnd.choice(SOURCE_SYSTEMS),
+                    "check": rnd.choice(CHECKS),
+                    "host": host,
+                    "env": rnd.choice(["prod", "dev"]),
+                },
+            },
+        })
+    return events
+
+
+def bench(name, fn, events):
+    start = time.perf_counter()
+    matched = 0
+    for event in events:
+        matched += fn(event)
+    elapsed = time.perf_counter() - start
+    print(f"{name:24} {len(events) / elapsed:10.1f} events/s ({matched} matches)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=3000)
+    parser.add_argument("--events", type=int, default=200)
+    args = parser.parse_args()
+    enrich = Enrichment(None, broken_regex=True, prepend_path="payload.custom_details.")
+    rules = make_rules(args.rules)
+    enrich.enrichments = [{"name": "bench", "type": "match_all", "rules": rules}]
+    enrich.compile_conditions()
+    events = make_events(args.events)
+    bench("interpreted (old)", lambda event: sum(enrich.evaluate_condition(event, rule["when"]) for rule in rules), events)
+    bench("compiled", lambda event: sum(enrich.predicate(rule["when"])(event) for rule in rules), events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Compare enriching events with every rule of an enrichment set checked for every event, and with only
+the rules the rule index finds for the event's values (plus the ones it can't index):
+
+    python3 benchmarks/enrichment_rules.py --rules 5000 --events 500
+"""
+
+import copy
+import time
+import random
+import argparse
+
+from pdaltagent.enrichment import Enrichment
+from pdaltagent.rule_index import RuleIndex
+
+
+SOURCE_SYSTEMS = ["nagios", "zabbix", "datadog", "splunk", "prometheus"]
+CHECKS = ["cpu", "disk", "memory", "http", "replication", "heartbeat"]
+
+
+def make_rules(count, seed=0):
+    rnd = random.Random(seed)
+    rules = []
+    for i in range(count):
+        kind = i % 10
+        if kind < 6:
+            when = {"=": ["host", f"host-{rnd.randint(0, count)}"]}
+        elif kind < 8:
+            when = {"AND": [
+                {"=": ["source_system", rnd.choice(SOURCE_SYSTEMS)]},
+                {"IN": ["check", rnd.sample(CHECKS, 2)]},
+            ]}
+        elif kind < 9:
+            when = {"IN": ["host", [f"host-{rnd.randint(0, count)}" for _ in range(3)]]}
+        else:
+            when = {"=": ["host", {"type": "regex", "value": f"^host-{rnd.randint(0, 99)}$"}]}
+        rules.append({
+            "id": str(i),
+            "type": "composition",
+            "active": True,
+            "when": when,
+            "config": {"destination": "team", "value": f"team-{i % 50}"},
+        })
+    return rules
+
+
+def make_events(count, rules, seed=0):
+    rnd = random.Random(seed)
+    return [{
+        "payload": {
+            "summary": "check failed",
+            "source": "bench",
+            "severity": "critical",
+            "custom_details": {
+                "source_system": rnd.choice(SOURCE_SYSTEMS),
+                "check": rnd.choice(CHECKS),
+                "host": f"host-{rnd.randint(0, len(rules))}",
+            },
+        },
+    } for _ in range(count)]
+
+
+def bench(name, enrich, events):
+    events = copy.deepcopy(events)
+    start = time.perf_counter()
+    for event in events:
+        enrich.enrich_event(event)
+    elapsed = time.perf_counter() - start
+    matched = sum("team" in event["payload"]["custom_details"] for event in events)
+    print(f"{name:24} {len(events) / elapsed:10.1f} events/s ({matched} enriched)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rules", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=500)
+    args = parser.parse_args()
+    enrich = Enrichment(None, prepend_path="payload.custom_details.")
+    rules = make_rules(args.rules)
+    enrich.enrichments = [{"name": "bench", "type": "match_all", "rules": rules}]
+    enrich.compile_conditions()
+    events = make_events(args.events, rules)
+    bench("indexed", enrich, events)
+    enrich.rule_index = lambda enrichment_set: RuleIndex([None] * len(enrichment_set["rules"]))
+    bench("every rule (old)", enrich, events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compare enqueueing v2 events one per request on /v2/enqueue with enqueueing them in bulk on
+/v2/enqueue/batch, as a JSON array and as NDJSON.
+
+Runs the listener in process with the Flask test client, and publishes to whatever broker
+CELERY_BROKER_URL points at (use memory:// to measure the listener without a broker):
+
+    CELERY_BROKER_URL=amqp://guest@localhost// python3 benchmarks/listener_enqueue.py --events 10000
+"""
+
+import json
+import time
+import argparse
+
+from pdaltagent.listener import app
+
+
+def make_events(count):
+    return [
+        {
+            "routing_key": "R" + "0" * 31,
+            "event_action": "trigger",
+            "dedup_key": f"bench-{i}",
+            "payload": {"summary": f"Benchmark event {i}", "source": "bench", "severity": "info"},
+        }
+        for i in range(count)
+    ]
+
+
+def single(client, events):
+    for event in events:
+        r = client.post("/v2/enqueue", json=event)
+        assert r.status_code == 200, r.data
+
+
+def batch_array(client, events, batch_size):
+    for i in range(0, len(events), batch_size):
+        r = client.post("/v2/enqueue/batch", json=events[i:i + batch_size])
+        assert r.status_code == 200 and r.json["invalid"] == 0, r.data
+
+
+def batch_ndjson(client, events, batch_size):
+    for i in range(0, len(events), batch_size):
+        body = "\n".join(json.dumps(e) for e in events[i:i + batch_size])
+        r = client.post("/v2/enqueue/batch", data=body, content_type="application/x-ndjson")
+        assert r.status_code == 200 and r.json["invalid"] == 0, r.data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+    client = app.test_client()
+    for (name, fn) in [
+        ("single /v2/enqueue", lambda: single(client, events)),
+        (f"batch JSON array x{args.batch_size}", lambda: batch_array(client, events, args.batch_size)),
+        (f"batch NDJSON x{args.batch_size}", lambda: batch_ndjson(client, events, args.batch_size)),
+    ]:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        print(f"{name:32} {args.events} events in {elapsed:.2f}s, {args.events / elapsed:.0f} events/s")
+
+
+if __name__ == "__main__":
+    main()
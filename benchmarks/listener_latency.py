@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Measure ingest latency of a running listener: POST v2 events to /v2/enqueue at a fixed rate and
+report latency percentiles. Run it against the gunicorn listener and the async listener at
+increasing rates to compare how p99 holds up:
+
+    python3 benchmarks/listener_latency.py --url http://localhost:8080 --rate 500 --seconds 20
+"""
+
+import time
+import asyncio
+import argparse
+import aiohttp
+
+
+def make_event(i):
+    return {
+        "routing_key": "R" + "0" * 31,
+        "event_action": "trigger",
+        "dedup_key": f"bench-{i}",
+        "payload": {"summary": f"Benchmark event {i}", "source": "bench", "severity": "info"},
+    }
+
+
+async def post(session, url, i, latencies, errors):
+    start = time.perf_counter()
+    try:
+        async with session.post(f"{url}/v2/enqueue", json=make_event(i)) as response:
+            await response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                return
+    except aiohttp.ClientError as e:
+        errors.append(str(e))
+        return
+    latencies.append(time.perf_counter() - start)
+
+
+async def run(url, rate, seconds):
+    latencies = []
+    errors = []
+    tasks = []
+    connector = aiohttp.TCPConnector(limit=0, ssl=False)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        for i in range(int(rate * seconds)):
+            # open loop: send on schedule whether or not earlier requests have finished
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(session, url, i, latencies, errors)))
+        await asyncio.gather(*tasks)
+    return (sorted(latencies), errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second")
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    (latencies, errors) = asyncio.run(run(args.url, args.rate, args.seconds))
+    if not latencies:
+        print(f"No successful requests, errors: {errors[:10]}")
+        return
+    pct = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+    print(f"{len(latencies)} ok, {len(errors)} errors at {args.rate:.0f}/s: "
+          f"p50 {pct(0.5):.1f}ms, p90 {pct(0.9):.1f}ms, p99 {pct(0.99):.1f}ms, max {latencies[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compare a big mapping table held in memory, which every worker process would have its own copy of, with
+the same table in a MappingStore file that the workers map and share:
+
+    python3 benchmarks/mapping_store.py --rows 500000 --lookups 100000
+"""
+
+import os
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from pdaltagent.mapping_store import MappingStore
+
+
+TEAMS = ["network", "database", "platform", "storage", "payments", "identity"]
+
+
+def make_rows(count, seed=0):
+    rnd = random.Random(seed)
+    for i in range(count):
+        yield {
+            "host": f"host-{i:07d}.prod.example.com",
+            "ci_id": f"CI{i:09d}",
+            "team": rnd.choice(TEAMS),
+            "datacenter": rnd.choice(["us-east-1", "us-west-2", "eu-west-1"]),
+            "owner": f"owner-{rnd.randint(0, 999)}@example.com",
+            "tags": ["prod", rnd.choice(["linux", "windows"])],
+        }
+
+
+def bench(name, find_one, queries, memory):
+    start = time.perf_counter()
+    found = sum(find_one(query) is not None for query in queries)
+    elapsed = time.perf_counter() - start
+    print(f"{name:20} {len(queries) / elapsed:10.1f} lookups/s, {memory / 1e6:8.1f} MB per worker ({found} found)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+    rnd = random.Random(1)
+    queries = [{"host": f"host-{rnd.randint(0, args.rows * 2):07d}.prod.example.com"} for _ in range(args.lookups)]
+
+    tracemalloc.start()
+    rows = list(make_rows(args.rows))
+    index = {}
+    for row in rows:
+        index.setdefault(row["host"], row)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    bench("in memory (old)", lambda query: index.get(query["host"]), queries, memory)
+    del rows, index
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "mapping_bench.store")
+        start = time.perf_counter()
+        MappingStore.build(path, make_rows(args.rows), "bench", ["host", "ci_id"])
+        print(f"built {os.path.getsize(path) / 1e6:.1f} MB store in {time.perf_counter() - start:.1f} seconds")
+        tracemalloc.start()
+        store = MappingStore(path)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        bench("mapped store", store.find_one, queries, memory)
+
+
+if __name__ == "__main__":
+    main()
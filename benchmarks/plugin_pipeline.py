@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Measure how much time PluginHost itself adds per event, apart from what the plugins do, by running
+events through a few do-nothing filter_event plugins with the compiled pipeline and with the old
+way of calling them (inspect.signature and a copy of the event for every plugin):
+
+    python3 benchmarks/plugin_pipeline.py --events 100000 --plugins 5
+"""
+
+import time
+import inspect
+import logging
+import argparse
+
+from pdaltagent.plugin_host import PluginHost
+
+
+class OneArg:
+    def filter_event(self, event):
+        return event
+
+
+class TwoArgs:
+    def filter_event(self, event, routing_key):
+        return (event, routing_key)
+
+
+class ThreeArgs:
+    def filter_event(self, event, routing_key, destination_type):
+        return (event, None, destination_type)
+
+
+def old_filter_event(host, event, routing_key=None, destination_type="v2"):
+    """PluginHost.filter_event as it used to be"""
+    _event = dict(event)
+    for method in host.methods['filter_event']:
+        e = dict(_event)
+        num_params = len(inspect.signature(method).parameters)
+        if num_params == 1:
+            r = method(e)
+        elif num_params == 2:
+            r = method(e, routing_key)
+        else:
+            r = method(e, routing_key, destination_type)
+        if r is None:
+            return None
+        if isinstance(r, tuple):
+            _event = r[0]
+            routing_key = (r[1] if len(r) > 1 else None) or routing_key
+            destination_type = (r[2] if len(r) > 2 else None) or destination_type
+        else:
+            _event = r
+    return (_event, routing_key, destination_type)
+
+
+def make_host(num_plugins):
+    # skip load_plugins, which would import the real plugins
+    host = PluginHost.__new__(PluginHost)
+    host.logger = logging.getLogger("benchmark")
+    host.methods = {'filter_event': [], 'filter_webhook': [], 'fetch_events': []}
+    host.pipelines = {'filter_event': [], 'filter_webhook': []}
+    host.loaded = set()
+    classes = [OneArg, TwoArgs, ThreeArgs]
+    host.load_methods([classes[i % len(classes)]() for i in range(num_plugins)])
+    return host
+
+
+def bench(name, fn, host, events):
+    start = time.perf_counter()
+    for event in events:
+        fn(event, "R" + "0" * 31, "v2")
+    elapsed = time.perf_counter() - start
+    print(f"{name:24} {elapsed / len(events) * 1e6:8.2f} us/event")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--plugins", type=int, default=5)
+    args = parser.parse_args()
+    host = make_host(args.plugins)
+    events = [{
+        "event_action": "trigger",
+        "dedup_key": f"bench-{i}",
+        "payload": {"summary": f"Benchmark event {i}", "source": "bench", "severity": "info", "custom_details": {"i": i}},
+    } for i in range(args.events)]
+    bench("old", lambda *a: old_filter_event(host, *a), host, events)
+    bench("compiled pipeline", host.filter_event, host, events)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Compare the structure-aware PII scrubber with the old approach of running every regex over the whole
+serialized event, on a mix of realistic v2 events:
+
+    python3 benchmarks/scrubber_throughput.py --events 2000
+"""
+
+import json
+import time
+import random
+import argparse
+
+from pdaltagent import scrubber
+
+
+def serialized_scrub(body_in):
+    """The scrubber as it used to be: every regex in turn over json.dumps of the whole event"""
+    body = dict(body_in)
+    routing_key = body.get('routing_key')
+    string = json.dumps(body)
+    for (name, regex) in scrubber.regexes.items():
+        string = regex.sub(f"{{{{{name.upper()}}}}}", string)
+    body = json.loads(string)
+    if routing_key:
+        body['routing_key'] = routing_key
+    return body
+
+
+def make_events(count, seed=0):
+    rnd = random.Random(seed)
+    hosts = [f"web-{i:02d}.prod.example.com" for i in range(20)]
+    checks = ["CPU usage high", "Disk almost full", "HTTP 500 rate elevated", "Replication lag", "Heartbeat missed"]
+    events = []
+    for i in range(count):
+        host = rnd.choice(hosts)
+        custom_details = {
+            "check": rnd.choice(checks),
+            "value": rnd.randint(0, 100),
+            "threshold": 90,
+            "tags": ["env:prod", f"team:{rnd.choice(['db', 'web', 'infra'])}"],
+            "message": rnd.choice([
+                "Service degraded, see runbook for details",
+                f"Contact oncall at ops-{i % 7}@example.com or 415-555-{1000 + i % 9000:04d}",
+                f"Request from 10.{i % 255}.{(i * 7) % 255}.{(i * 13) % 255} failed with status 500",
+                "Threshold exceeded for the last 5 minutes on all nodes in the cluster",
+            ]),
+            "log": " ".join(rnd.choice(["error", "timeout", "retrying", "connection", "reset", "upstream"]) for _ in range(40)),
+        }
+        events.append({
+            "routing_key": "R" + "0" * 31,
+            "event_action": "trigger",
+            "dedup_key": f"{host}-{custom_details['check']}",
+            "payload": {
+                "summary": f"{custom_details['check']} on {host}",
+                "source": host,
+                "severity": rnd.choice(["info", "warning", "error", "critical"]),
+                "component": "api",
+                "group": "prod",
+                "class": "metrics",
+                "custom_details": custom_details,
+            },
+        })
+    return events
+
+
+def bench(name, fn, events):
+    start = time.perf_counter()
+    for event in events:
+        fn(event)
+    elapsed = time.perf_counter() - start
+    print(f"{name:24} {len(events) / elapsed:10.0f} events/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2000)
+    args = parser.parse_args()
+    events = make_events(args.events)
+    bench("serialized (old)", serialized_scrub, events)
+    bench("structure-aware", scrubber.scrub, events)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ import uuid
 
 from pdaltagent.config import MONGODB_URL, SUPERVISOR_URL, PDAGENTD_ADMIN_USER, PDAGENTD_ADMIN_PASS, PDAGENTD_ADMIN_DB
 from pdaltagent.enrichment import Enrichment
+import pdaltagent.stats
 
 from pdaltagent.api.routes.users import users_blueprint
 from pdaltagent.api.routes.maints import maints_blueprint
@@ -119,6 +120,12 @@ class Api:
             self.restart_all()
             return jsonify({"status": "ok"})
 
+        # Stats reported by the worker and listener processes on this host
+        @self.app.route("/stats", methods=["GET"])
+        @auth_required()
+        def stats():
+            return jsonify(pdaltagent.stats.collect())
+
         @self.app.route("/")
         @self.app.route("/<path:subpath>")
         # @auth_required()
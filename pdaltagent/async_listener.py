@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+asyncio listener for the same routes as pdaltagent.listener.
+
+Requests are handled on an event loop, so slow clients only cost an open connection instead of a
+whole gunicorn worker, and events are published to the broker by a separate thread that groups
+everything received within PDAGENTD_LISTENER_BATCH_WINDOW_MS into one publish batch over a single
+producer. Each request still only gets its response after its events are in the broker, or in the
+local spool if the broker is unavailable (see pdaltagent.spool).
+
+Run it instead of the gunicorn listener programs:
+
+    python3 -m pdaltagent.async_listener --port 8080
+    python3 -m pdaltagent.async_listener --port 8443 --certfile /etc/pdagentd/ssl/cert.pem --keyfile /etc/pdagentd/ssl/key.pem
+"""
+
+import os
+import ssl
+import json
+import time
+import queue
+import asyncio
+import logging
+import argparse
+import threading
+import collections
+from aiohttp import web
+
+import pdaltagent.stats
+from pdaltagent.config import app as celery_app, LISTENER_BATCH_WINDOW_MS, LISTENER_MAX_BATCH
+from pdaltagent.listener import SCRUB, validate_v2, publish as publish_event
+from pdaltagent.spool import get_spool
+from pdaltagent.admission import admission, event_severity
+from pdaltagent.scrubber import scrub
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# biggest request body accepted, for /v2/enqueue/batch JSON arrays
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+class MicroBatchPublisher:
+    """Publishes send_to_pd messages from a thread of its own, in batches that share one producer
+
+    Args:
+        window_ms (float): how long to wait for more events after the first one of a batch arrives
+        max_batch (int): the most events to publish in one batch
+    """
+
+    def __init__(self, window_ms=LISTENER_BATCH_WINDOW_MS, max_batch=LISTENER_MAX_BATCH):
+        self.window = window_ms / 1000
+        self.max_batch = max(max_batch, 1)
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.latencies = collections.deque(maxlen=10000)
+        self.counts = {'events': 0, 'batches': 0, 'failed': 0}
+        pdaltagent.stats.register('async_listener', self.stats)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='async_listener_publisher', daemon=True)
+        self.thread.start()
+
+    def publish(self, routing_key, body, destination_type):
+        """Queue an event to be published, returning a future that's done when it's in the broker"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((loop, future, time.monotonic(), (routing_key, body, destination_type)))
+        return future
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def resolve(future, exc):
+        # the client may have gone away and cancelled its request
+        if future.done():
+            return
+        if exc is None:
+            future.set_result(None)
+        else:
+            future.set_exception(exc)
+
+    def publish_batch(self, batch):
+        """Publish a batch over one producer, spooling whatever can't be published
+
+        Returns:
+            list: None for each event that was published or spooled, or the exception if it was neither
+        """
+        spool = get_spool(publish_event)
+        results = []
+        with celery_app.producer_or_acquire() as producer:
+            for (loop, future, received, (routing_key, body, destination_type)) in batch:
+                try:
+                    if SCRUB:
+                        body = scrub(body)
+                    if spool is not None and spool.spooling:
+                        spool.append(routing_key, body, destination_type)
+                    else:
+                        try:
+                            publish_event(routing_key, body, destination_type, producer=producer)
+                        except Exception as e:
+                            if spool is None:
+                                raise
+                            spool.failed(e)
+                            spool.append(routing_key, body, destination_type)
+                    results.append(None)
+                except Exception as e:
+                    results.append(e)
+        return results
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = self.publish_batch(batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            now = time.monotonic()
+            self.counts['batches'] += 1
+            for ((loop, future, received, _args), exc) in zip(batch, results):
+                if exc is None:
+                    self.counts['events'] += 1
+                else:
+                    logger.error(f"Couldn't enqueue event: {exc}")
+                    self.counts['failed'] += 1
+                self.latencies.append(now - received)
+                loop.call_soon_threadsafe(self.resolve, future, exc)
+            pdaltagent.stats.maybe_dump()
+
+    def stats(self):
+        r = dict(self.counts)
+        latencies = sorted(self.latencies)
+        if latencies:
+            r['publish_latency_ms'] = {
+                'p50': round(latencies[len(latencies) // 2] * 1000, 2),
+                'p99': round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+            }
+        return r
+
+
+publisher = MicroBatchPublisher()
+
+
+async def read_json(request):
+    try:
+        return json.loads(await request.read())
+    except ValueError:
+        return None
+
+
+def too_many_events(retry_after):
+    return web.Response(text="Too many events queued, try again later\n", status=429, headers={'Retry-After': str(retry_after)})
+
+
+async def enqueue(routing_key, body, destination_type, severity=None):
+    retry_after = admission.check(severity)
+    if retry_after is not None:
+        return too_many_events(retry_after)
+    try:
+        await publisher.publish(routing_key, body, destination_type)
+    except Exception:
+        return web.Response(text="Failed to enqueue message\n", status=500)
+    return web.Response(text="Message enqueued\n")
+
+
+async def enqueue_integration(request):
+    body = await read_json(request)
+    if not body:
+        return web.Response(text="Bad request\n", status=400)
+    return await enqueue(request.match_info['routing_key'], body, "v1")
+
+
+async def enqueue_x_ere(request):
+    body = await read_json(request)
+    if not body:
+        return web.Response(text="Bad request\n", status=400)
+    return await enqueue(request.match_info['routing_key'], body, "x-ere")
+
+
+async def enqueue_v2(request):
+    body = await read_json(request)
+    error = validate_v2(body)
+    if error is not None:
+        return web.Response(text=f"{error}\n", status=400)
+    return await enqueue(body['routing_key'], body, "v2", event_severity(body))
+
+
+async def batch_items(request):
+    """Yield (body, error) for each event in a JSON array or NDJSON request body, like the listener does"""
+    if 'ndjson' in request.content_type or 'jsonlines' in request.content_type:
+        lines = request.content
+    else:
+        data = await request.read()
+        try:
+            items = json.loads(data)
+        except ValueError:
+            lines = data.splitlines()
+        else:
+            for item in (items if isinstance(items, list) else [items]):
+                yield (item, None)
+            return
+    if isinstance(lines, list):
+        for line in lines:
+            if line.strip():
+                yield parse_line(line)
+    else:
+        async for line in lines:
+            if line.strip():
+                yield parse_line(line)
+
+
+def parse_line(line):
+    try:
+        return (json.loads(line), None)
+    except ValueError as e:
+        return (None, f"Invalid JSON: {e}")
+
+
+async def enqueue_v2_batch(request):
+    results = []
+    futures = []
+    index = 0
+    async for (body, error) in batch_items(request):
+        if error is None:
+            error = validate_v2(body)
+        retry_after = admission.check(event_severity(body)) if error is None else None
+        if error is not None:
+            results.append({'index': index, 'status': 'invalid', 'error': error})
+        elif retry_after is not None:
+            results.append({'index': index, 'status': 'throttled', 'retry_after': retry_after})
+        else:
+            results.append({'index': index, 'status': 'enqueued'})
+            futures.append((index, publisher.publish(body['routing_key'], body, "v2")))
+        index += 1
+    for (index, future) in futures:
+        try:
+            await future
+        except Exception as e:
+            results[index] = {'index': index, 'status': 'failed', 'error': str(e)}
+    enqueued = len([r for r in results if r['status'] == 'enqueued'])
+    throttled = [r['retry_after'] for r in results if r['status'] == 'throttled']
+    failed = len([r for r in results if r['status'] == 'failed'])
+    response = web.json_response({'enqueued': enqueued, 'invalid': len(results) - enqueued - len(throttled) - failed, 'throttled': len(throttled), 'failed': failed, 'results': results})
+    if throttled:
+        response.headers['Retry-After'] = str(max(throttled))
+        if not enqueued:
+            response.set_status(429)
+    return response
+
+
+def make_app():
+    web_app = web.Application(client_max_size=MAX_REQUEST_BYTES)
+    web_app.add_routes([
+        web.post('/integration/{routing_key}/enqueue', enqueue_integration),
+        web.post('/x-ere/{routing_key}', enqueue_x_ere),
+        web.post('/v2/enqueue', enqueue_v2),
+        web.post('/v2/enqueue/batch', enqueue_v2_batch),
+    ])
+    return web_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Async PDaltagent listener")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--certfile")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.certfile:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.certfile, args.keyfile)
+
+    logger.info(f"Async listener starting on port {args.port} with batch window {publisher.window * 1000}ms, max batch {publisher.max_batch}")
+    publisher.start()
+    web.run_app(make_app(), host=args.host, port=args.port, ssl_context=ssl_context, print=None)
+
+
+if __name__ == '__main__':
+    main()
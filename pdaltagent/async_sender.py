@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+asyncio delivery mode for the pd_events and pd_webhooks queues.
+
+Event and webhook delivery is almost all network wait, so instead of blocking a prefork process on
+each POST, this worker runs an event loop that keeps up to PDAGENTD_ASYNC_MAX_IN_FLIGHT deliveries in
+flight at once, with at most PDAGENTD_ASYNC_PER_HOST_LIMIT concurrent connections to any one host.
+Messages go through the same filter plugins and get the same ack/retry handling as send_to_pd and
+send_webhook. Filter plugins defined with async def are awaited on the same loop, so their I/O overlaps
+too.
+
+Run it instead of the events and webhooks Celery workers:
+
+    python3 -m pdaltagent.async_sender
+"""
+
+import os
+import json
+import asyncio
+import logging
+import threading
+import aiohttp
+
+import pdaltagent.pd as pd
+import pdaltagent.stats
+from pdaltagent.config import app, ASYNC_MAX_IN_FLIGHT, ASYNC_PER_HOST_LIMIT
+from pdaltagent.queue_consumer import QueueConsumer
+from pdaltagent.rate_limiter import rate_limiter
+from pdaltagent.coalescer import coalescer
+from pdaltagent.tasks import send_to_pd, send_webhook, filter_event_async, filter_webhook_async, rate_limited_countdown, deferred_arguments
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+
+class AsyncSender:
+    def __init__(self, queue_names=None, max_in_flight=ASYNC_MAX_IN_FLIGHT, per_host_limit=ASYNC_PER_HOST_LIMIT):
+        self.max_in_flight = max(max_in_flight, 1)
+        self.per_host_limit = per_host_limit
+        self.consumer = QueueConsumer(app, queue_names or ['pd_events', 'pd_webhooks'], prefetch_count=self.max_in_flight)
+        self.loop = None
+        self.session = None
+        self.tasks = set()
+        self.held = 0
+        self.counts = {'in_flight': 0, 'sent': 0, 'suppressed': 0, 'coalesced': 0, 'deferred': 0, 'retried': 0, 'failed': 0}
+        pdaltagent.stats.register('async_sender', lambda: dict(self.counts, held=self.held))
+
+    # consumer thread
+
+    def on_message(self, task_message):
+        self.loop.call_soon_threadsafe(self.dispatch, task_message)
+
+    def on_tick(self):
+        pdaltagent.stats.maybe_dump()
+
+    # event loop
+
+    def update_prefetch_count(self):
+        self.consumer.call_soon_threadsafe(self.consumer.set_prefetch_count, self.max_in_flight + self.held)
+
+    def dispatch(self, task_message):
+        delay = task_message.seconds_until_due()
+        if delay > 0:
+            # retried messages wait unacked until their countdown is up, like in a Celery worker
+            self.held += 1
+            self.update_prefetch_count()
+            self.loop.call_later(delay, self.release, task_message)
+            return
+        task = self.loop.create_task(self.process(task_message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def release(self, task_message):
+        self.held -= 1
+        self.update_prefetch_count()
+        self.dispatch(task_message)
+
+    def ack(self, task_message):
+        self.consumer.call_soon_threadsafe(task_message.ack)
+
+    def retry(self, task_message, task, countdown, exc, **kwargs):
+        logger.info(f"Task {task_message} retry: Retry in {countdown}s: {exc}")
+        self.counts['retried'] += 1
+        self.consumer.call_soon_threadsafe(lambda: task_message.retry(task, countdown, **kwargs))
+
+    def defer(self, task_message, task, countdown, arguments=None, **kwargs):
+        logger.info(f"Task {task_message} deferred: Send in {round(countdown, 2)}s")
+        self.counts['deferred'] += 1
+        self.consumer.call_soon_threadsafe(lambda: task_message.defer(task, countdown, arguments, **kwargs))
+
+    def fail(self, task_message, args, exc):
+        (destination, payload) = (args.get('routing_key', args.get('url')), args.get('payload'))
+        logger.warning(f"Failed to send {payload!r} to {destination}: {exc}")
+        self.counts['failed'] += 1
+        self.ack(task_message)
+
+    async def process(self, task_message):
+        self.counts['in_flight'] += 1
+        args = {}
+        try:
+            if task_message.name == send_to_pd.name:
+                args = task_message.bind(send_to_pd)
+                await self.send_event(task_message, args)
+            elif task_message.name == send_webhook.name:
+                args = task_message.bind(send_webhook)
+                await self.send_webhook(task_message, args)
+            else:
+                logger.error(f"Rejecting unexpected task {task_message}")
+                self.consumer.call_soon_threadsafe(task_message.reject)
+        except TypeError as e:
+            if not args:
+                logger.error(f"Rejecting task {task_message} with invalid arguments: {e}")
+                self.consumer.call_soon_threadsafe(task_message.reject)
+            else:
+                self.fail(task_message, args, e)
+        except Exception as e:
+            self.fail(task_message, args, e)
+        finally:
+            self.counts['in_flight'] -= 1
+
+    async def post(self, url, payload):
+        """POST a JSON payload, returning the response status, reason, headers and body"""
+        async with self.session.post(url, json=payload) as response:
+            body = await response.read()
+            return (response.status, response.reason, response.headers, body)
+
+    async def send_event(self, task_message, args):
+        if args['filtered']:
+            # deferred after it was filtered, and checked for coalescing before that
+            r = (args['payload'], args['routing_key'], args['destination_type'])
+        else:
+            if coalescer.superseded(args['routing_key'], args['payload'], args['destination_type'], args['seq']):
+                self.counts['coalesced'] += 1
+                self.ack(task_message)
+                return
+            r = await filter_event_async(args['routing_key'], args['payload'], args['destination_type'])
+            if r is None:
+                logger.info(f"Task {task_message} succeeded: {('event suppressed', json.dumps(args['payload']))}")
+                self.counts['suppressed'] += 1
+                self.ack(task_message)
+                return
+        (_payload, _routing_key, _destination_type) = r
+        delay = rate_limiter.acquire(_routing_key, _destination_type, reserved=args['rate_reserved'])
+        if delay > 0:
+            self.defer(task_message, send_to_pd, delay, deferred_arguments(args, r))
+            return
+        url = pd.url_for_destination_type(_routing_key, args['base_url'], _destination_type)
+        (status, reason, headers, body) = await self.post(url, _payload)
+        if status >= 400:
+            error = f"{status} {'Client' if status < 500 else 'Server'} Error: {reason} for url: {url}"
+            if status == 429:
+                countdown = rate_limited_countdown(task_message.retries, _routing_key, _destination_type, headers.get('Retry-After'))
+                self.retry(task_message, send_to_pd, countdown, error, rate_reserved=False)
+            else:
+                self.fail(task_message, args, error)
+            return
+        r = json.loads(body) if len(body) > 0 else None
+        logger.info(f"Task {task_message} succeeded: {(_routing_key, r)}")
+        self.counts['sent'] += 1
+        self.ack(task_message)
+
+    async def send_webhook(self, task_message, args):
+        r = await filter_webhook_async(args['url'], args['payload'])
+        if r is None:
+            logger.info(f"Task {task_message} succeeded: {('webhook suppressed', args['url'], json.dumps(args['payload']))}")
+            self.counts['suppressed'] += 1
+            self.ack(task_message)
+            return
+        (_payload, _url) = r
+        (status, reason, headers, body) = await self.post(_url, _payload)
+        logger.info(f"Task {task_message} succeeded: {(_url, f'<Response [{status}]>')}")
+        self.counts['sent'] += 1
+        self.ack(task_message)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        connector = aiohttp.TCPConnector(
+            limit=self.max_in_flight,
+            limit_per_host=self.per_host_limit,
+            keepalive_timeout=pd.HTTP_POOL_IDLE_TIMEOUT_SECONDS,
+        )
+        async with aiohttp.ClientSession(connector=connector, trust_env=True) as session:
+            self.session = session
+            consumer_thread = threading.Thread(
+                target=self.consumer.run,
+                args=(self.on_message, self.on_tick, lambda: 0.05),
+                name='async_sender_consumer',
+                daemon=True,
+            )
+            consumer_thread.start()
+            while consumer_thread.is_alive():
+                await asyncio.sleep(1)
+
+    def run(self):
+        logger.info(f"Async sender starting with max in flight {self.max_in_flight}, per host limit {self.per_host_limit}")
+        asyncio.run(self.main())
+
+
+def main():
+    AsyncSender().run()
+
+
+if __name__ == '__main__':
+    main()
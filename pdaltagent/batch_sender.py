@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Batch delivery mode for the pd_events queue.
+
+Instead of running send_to_pd once per message in a Celery worker, this consumer pulls up to
+PDAGENTD_BATCH_SIZE messages (or whatever arrives within PDAGENTD_BATCH_WAIT_MS), runs them through
+the filter_event plugins as one batch (so plugins that implement filter_events can handle them together)
+and sends them to PagerDuty concurrently over the pooled connections.
+Each message is still acked, retried or failed on its own, with the same semantics as send_to_pd.
+
+Run it instead of the events Celery worker:
+
+    python3 -m pdaltagent.batch_sender
+"""
+
+import os
+import time
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from requests import HTTPError
+
+import pdaltagent.pd as pd
+import pdaltagent.stats
+from pdaltagent.config import app, BATCH_SIZE, BATCH_WAIT_MS
+from pdaltagent.queue_consumer import QueueConsumer
+from pdaltagent.rate_limiter import rate_limiter
+from pdaltagent.coalescer import coalescer
+from pdaltagent.tasks import send_to_pd, filter_events, rate_limited_countdown, deferred_arguments
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+
+class BatchSender:
+    def __init__(self, batch_size=BATCH_SIZE, batch_wait_ms=BATCH_WAIT_MS):
+        self.batch_size = max(batch_size, 1)
+        self.batch_wait = batch_wait_ms / 1000
+        self.pending = []
+        self.held = []
+        self.batch_started = None
+        self.executor = ThreadPoolExecutor(max_workers=self.batch_size, thread_name_prefix='batch_sender')
+        self.consumer = QueueConsumer(app, ['pd_events'], prefetch_count=self.batch_size)
+        self.counts = {'batches': 0, 'sent': 0, 'suppressed': 0, 'coalesced': 0, 'deferred': 0, 'retried': 0, 'failed': 0}
+        pdaltagent.stats.register('batch_sender', lambda: dict(self.counts))
+
+        # every event in a batch can be in flight at once, so make sure they can all keep their connections
+        events_session = pd.sessions['events']
+        events_session.pool_size = max(events_session.pool_size, self.batch_size)
+
+    def on_message(self, task_message):
+        if task_message.seconds_until_due() > 0:
+            # retried messages wait here unacked until their countdown is up, like in a Celery worker
+            self.held.append(task_message)
+            self.consumer.set_prefetch_count(self.batch_size + len(self.held))
+            return
+        self.add(task_message)
+
+    def add(self, task_message):
+        if not self.pending:
+            self.batch_started = time.monotonic()
+        self.pending.append(task_message)
+
+    def timeout(self):
+        timeouts = [1.0]
+        if self.pending:
+            timeouts.append(self.batch_started + self.batch_wait - time.monotonic())
+        if self.held:
+            timeouts.append(min(x.seconds_until_due() for x in self.held))
+        return min(timeouts)
+
+    def on_tick(self):
+        if self.held:
+            due = [x for x in self.held if x.seconds_until_due() == 0]
+            if due:
+                self.held = [x for x in self.held if x not in due]
+                for task_message in due:
+                    self.add(task_message)
+        if self.pending and (
+            len(self.pending) >= self.batch_size or
+            time.monotonic() - self.batch_started >= self.batch_wait
+        ):
+            batch = self.pending[:self.batch_size]
+            self.pending = self.pending[self.batch_size:]
+            self.batch_started = time.monotonic()
+            self.send_batch(batch)
+            self.consumer.set_prefetch_count(self.batch_size + len(self.held))
+        pdaltagent.stats.maybe_dump()
+
+    def on_reset(self):
+        self.pending = []
+        self.held = []
+
+    def fail(self, task_message, args, exc):
+        logger.warning(f"Failed to send {args.get('payload')!r} to {args.get('routing_key')}: {exc}")
+        self.counts['failed'] += 1
+        task_message.ack()
+
+    def send_batch(self, batch):
+        """Filter and send a batch of send_to_pd task messages"""
+        self.counts['batches'] += 1
+        sends = []
+        pending = []
+        for task_message in batch:
+            if task_message.name != send_to_pd.name:
+                logger.error(f"Rejecting unexpected task {task_message} in pd_events queue")
+                task_message.reject()
+                continue
+            try:
+                args = task_message.bind(send_to_pd)
+            except TypeError as e:
+                logger.error(f"Rejecting task {task_message} with invalid arguments: {e}")
+                task_message.reject()
+                continue
+            if args['filtered']:
+                # deferred after it was filtered, and checked for coalescing before that
+                pending.append((task_message, args))
+                continue
+            if coalescer.superseded(args['routing_key'], args['payload'], args['destination_type'], args['seq']):
+                self.counts['coalesced'] += 1
+                task_message.ack()
+                continue
+            pending.append((task_message, args))
+
+        # filter the whole batch together, so plugins with filter_events can do their lookups in bulk
+        unfiltered = [(task_message, args) for (task_message, args) in pending if not args['filtered']]
+        try:
+            filtered = iter(filter_events([(args['routing_key'], args['payload'], args['destination_type']) for (task_message, args) in unfiltered]))
+        except Exception as e:
+            for (task_message, args) in unfiltered:
+                self.fail(task_message, args, e)
+            (pending, filtered) = ([(task_message, args) for (task_message, args) in pending if args['filtered']], iter(()))
+        results = [(args['payload'], args['routing_key'], args['destination_type']) if args['filtered'] else next(filtered) for (task_message, args) in pending]
+
+        for ((task_message, args), r) in zip(pending, results):
+            if r is None:
+                logger.info(f"Task {task_message} succeeded: {('event suppressed', json.dumps(args['payload']))}")
+                self.counts['suppressed'] += 1
+                task_message.ack()
+                continue
+            (_payload, _routing_key, _destination_type) = r
+            delay = rate_limiter.acquire(_routing_key, _destination_type, reserved=args['rate_reserved'])
+            if delay > 0:
+                logger.info(f"Task {task_message} deferred: Send in {round(delay, 2)}s")
+                self.counts['deferred'] += 1
+                task_message.defer(send_to_pd, delay, deferred_arguments(args, r))
+                continue
+            future = self.executor.submit(pd.send_event, _routing_key, _payload, args['base_url'], _destination_type)
+            sends.append((task_message, args, _routing_key, _destination_type, future))
+
+        for (task_message, args, routing_key, destination_type, future) in sends:
+            try:
+                r = future.result()
+            except HTTPError as e:
+                if e.response is not None and e.response.status_code == 429:
+                    countdown = rate_limited_countdown(task_message.retries, routing_key, destination_type, e.response.headers.get('Retry-After'))
+                    logger.info(f"Task {task_message} retry: Retry in {countdown}s: {e}")
+                    self.counts['retried'] += 1
+                    task_message.retry(send_to_pd, countdown, rate_reserved=False)
+                else:
+                    self.fail(task_message, args, e)
+                continue
+            except Exception as e:
+                self.fail(task_message, args, e)
+                continue
+            logger.info(f"Task {task_message} succeeded: {(routing_key, r)}")
+            self.counts['sent'] += 1
+            task_message.ack()
+
+    def run(self):
+        logger.info(f"Batch sender starting with batch size {self.batch_size}, batch wait {int(self.batch_wait * 1000)}ms")
+        self.consumer.run(self.on_message, self.on_tick, self.timeout, self.on_reset)
+
+
+def main():
+    BatchSender().run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import os
+import time
+import logging
+import threading
+
+import pdaltagent.stats
+from pdaltagent.shared_table import SharedTable
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# which queued events are dropped when a newer event for the same routing key and dedup key is queued:
+#   none: nothing is dropped
+#   same_action: events that are followed by a newer event with the same action (repeated triggers, resolves...)
+#   resolve: same_action, and every event that is followed by a newer resolve
+#   latest: every event that is followed by any newer event, so only the last one is sent
+COALESCE_POLICY = "none"
+if os.environ.get("PDAGENTD_COALESCE_POLICY"):
+    COALESCE_POLICY = os.environ.get("PDAGENTD_COALESCE_POLICY").strip().lower()
+
+COALESCE_POLICIES = ["none", "same_action", "resolve", "latest"]
+ACTIONS = ["trigger", "acknowledge", "resolve"]
+
+
+def event_key(routing_key, payload, destination_type):
+    """Get the (dedup key, action) of an event, or None if it's not the kind of event that can be coalesced"""
+    if not isinstance(payload, dict):
+        return None
+    if destination_type == "v2":
+        (dedup_key, action) = (payload.get("dedup_key"), payload.get("event_action"))
+    elif destination_type == "v1":
+        (dedup_key, action) = (payload.get("incident_key"), payload.get("event_type"))
+    else:
+        return None
+    if not dedup_key or action not in ACTIONS:
+        return None
+    return (f"{routing_key}:{dedup_key}", action)
+
+
+class Coalescer:
+    """Drops queued events that were made redundant by newer events for the same routing key and dedup key.
+
+    When an event is queued, enqueued() gives it a sequence number and records it as the newest event with
+    its action for its key, in a table shared by the listener and the workers. When the event comes up
+    for delivery, superseded() compares its sequence number with the newest ones for its key to decide
+    whether it can be dropped under the coalescing policy.
+    """
+
+    def __init__(self, policy=COALESCE_POLICY):
+        if policy not in COALESCE_POLICIES:
+            logger.error(f"Unknown coalescing policy {policy!r}, should be one of {', '.join(COALESCE_POLICIES)}; events won't be coalesced")
+            policy = "none"
+        self.policy = policy
+        self.table = None
+        self.table_lock = threading.Lock()
+        self.disabled = policy == "none"
+        self.counts = {'tracked': 0, 'coalesced': 0}
+        self.coalesced_by_action = {action: 0 for action in ACTIONS}
+
+    def get_table(self):
+        if self.table is None and not self.disabled:
+            with self.table_lock:
+                if self.table is None:
+                    try:
+                        self.table = SharedTable("coalesce", ["seq"] + ACTIONS)
+                    except OSError as e:
+                        logger.error(f"Couldn't create shared coalescing table, events won't be coalesced: {e}")
+                        self.disabled = True
+        return self.table
+
+    def enqueued(self, routing_key, payload, destination_type="v2"):
+        """Record that an event is being queued
+
+        Returns:
+            int: the event's sequence number, or None if it isn't tracked
+        """
+        k = event_key(routing_key, payload, destination_type)
+        table = self.get_table()
+        if k is None or table is None:
+            return None
+        (key, action) = k
+        (index, key_hash) = table.slot_for(key)
+        with table.locked(index):
+            (slot_hash, record) = table.read(index)
+            if slot_hash != key_hash:
+                record = {'seq': 0}
+            # microseconds since the epoch, so sequence numbers keep going up even if the slot was taken over
+            seq = max(int(record['seq']) + 1, int(time.time() * 1000000))
+            record['seq'] = seq
+            record[action] = seq
+            table.write(index, key_hash, record)
+        self.counts['tracked'] += 1
+        return seq
+
+    def superseded(self, routing_key, payload, destination_type="v2", seq=None):
+        """Check whether a queued event was made redundant by a newer one and can be dropped"""
+        k = event_key(routing_key, payload, destination_type)
+        table = self.get_table()
+        if seq is None or k is None or table is None:
+            return False
+        (key, action) = k
+        (index, key_hash) = table.slot_for(key)
+        with table.locked(index):
+            (slot_hash, record) = table.read(index)
+        if slot_hash != key_hash:
+            return False
+        if self.policy == "latest":
+            newer = record['seq'] > seq
+        elif self.policy == "resolve":
+            newer = record[action] > seq or record['resolve'] > seq
+        else:
+            newer = record[action] > seq
+        if newer:
+            self.counts['coalesced'] += 1
+            self.coalesced_by_action[action] += 1
+            logger.info(f"Dropping {action} event for {key} because a newer event for it is queued")
+        return newer
+
+    def stats(self):
+        return dict(self.counts, policy=self.policy, coalesced_by_action=dict(self.coalesced_by_action))
+
+
+coalescer = Coalescer()
+pdaltagent.stats.register("coalescer", coalescer.stats)
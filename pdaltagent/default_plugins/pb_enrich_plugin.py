@@ -1,5 +1,6 @@
 from pdaltagent.config import MONGODB_URL
 from pdaltagent.enrichment import Enrichment
+from pdaltagent.enrichment_watcher import EnrichmentWatcher
 from pymongo import MongoClient
 import datetime
 import json
@@ -10,8 +11,6 @@ prepend_path = "payload.custom_details."
 class Plugin:
     def __init__(self):
         self.order = 100
-        # default refresh time is 1 hour
-        self.refresh_time = datetime.timedelta(hours=1)
 
         # add k/v pairs to the event for debugging enrichment
         self.debug_enrichment = True
@@ -33,7 +32,8 @@ class Plugin:
             "created_at", expireAfterSeconds=86400, background=True
         )
 
-        self.last_loaded_time = datetime.datetime.now(datetime.timezone.utc)
+        # changes to the enrichments, maintenance windows and correlations are applied in the background
+        self.watcher = EnrichmentWatcher(self.enrich)
 
     def tracking_fields(self, event):
         r = {}
@@ -54,12 +54,7 @@ class Plugin:
             "created_at": datetime.datetime.now(datetime.timezone.utc),
             "before": json.loads(json.dumps(event)),
         }
-        # check if last loaded is more than refresh time before now
-        now = datetime.datetime.now(datetime.timezone.utc)
-        if now - self.last_loaded_time > self.refresh_time:
-            print("Refreshing enrichment data from MongoDB...")
-            self.enrich.load_from_mongo()
-            self.last_loaded_time = now
+        self.watcher.start()
 
         try:
             event = self.enrich.enrich_event(event, debug_enrichment=self.debug_enrichment)
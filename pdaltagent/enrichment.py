@@ -6,6 +6,11 @@ import hashlib
 from zoneinfo import ZoneInfo
 from pymongo import MongoClient, ASCENDING
 
+import pdaltagent.stats
+from pdaltagent.regex_guard import regex_guard, literal
+from pdaltagent.mapping_tables import MappingTables
+from pdaltagent.rule_index import RuleIndex
+
 
 class Enrichment:
     """
@@ -68,10 +73,18 @@ class Enrichment:
         self.enrichment_metadata = []
         self.enrichments = []
         self.correlations = []
+        # the loaded documents of each collection, by _id, and the enrichment set built from each enrich_ collection
+        self.documents = {}
+        self.enrichment_sets = {}
+        # compiled predicates of the loaded conditions, by (id of condition, broken_regex, prepend_path),
+        # and the rule indexes of the enrichment sets, by (id of enrichment set, "rules", None)
+        self.predicates = {}
 
         if self.mongo_url:
             self.client = MongoClient(self.mongo_url)
             self.db = self.client[self.db_name]
+            self.mapping_tables = MappingTables(self.db)
+            pdaltagent.stats.register("mapping_tables", self.mapping_tables.stats)
             self.load_from_mongo()
 
     def load_from_mongo(self):
@@ -87,11 +100,6 @@ class Enrichment:
                 f"Loading enrichment configuration from MongoDB..."
             )
 
-        # Load maintenance windows
-        self.maintenances = list(
-            self.db[self.maintenances_collection_name].find({}, {"_id": 0})
-        )
-
         # create id for enrichments without id
         # enrichments_without_id = self.db[self.enrich_metadata_collection_name].find(
         #     {
@@ -113,38 +121,15 @@ class Enrichment:
         #         {"_id": mongo_id}, {"$set": {"id": id}}
         #     )
 
-        # Load enrichment metadata
-        active_enrichments = list(
-            self.db[self.enrich_metadata_collection_name].find(
-                {"active": True}, {"_id": 0}
+        documents = {
+            name: self.read_collection(name)
+            for name in (
+                self.maintenances_collection_name,
+                self.enrich_metadata_collection_name,
+                self.correlations_collection_name,
             )
-        )
-        active_enrichments_sorted = sorted(active_enrichments, key=lambda x: x.get("order", float("inf")))
-        self.enrichment_metadata = active_enrichments_sorted
-
-        # Load enrichment rules
-        self.enrichments = []
-        for enrichment_metadata in self.enrichment_metadata:
-            if not ("active" in enrichment_metadata and enrichment_metadata["active"]):
-                continue
-            enrichment_name = enrichment_metadata["name"]
-            enrichment_type = enrichment_metadata["type"]
-            collection_name = self.enrich_collection_prefix + enrichment_name
-            enrichment_rules = list(
-                self.db[collection_name].find({"active": True}, {"_id": 0})
-            )
-            enrichment_rules_sorted = sorted(enrichment_rules, key=lambda x: x.get("order", float("inf")))
-            self.enrichments.append(
-                {
-                    "name": enrichment_name,
-                    "type": enrichment_type,
-                    "rules": enrichment_rules_sorted,
-                }
-            )
-
-        active_correlations = list(self.db[self.correlations_collection_name].find({"active": True}, {"_id": 0}))
-        active_correlations_sorted = sorted(active_correlations, key=lambda x: x.get("order", float("inf")))
-        self.correlations = active_correlations_sorted
+        }
+        self.apply_documents(documents)
 
         if self.debug:
             print(f"Loaded {len(self.maintenances)} maintenance windows")
@@ -157,6 +142,211 @@ class Enrichment:
                 )
             print(enrichment_tag_order_str)
 
+    def collection_filter(self, name):
+        """
+        The query for the documents of a configuration collection that are loaded.
+        """
+        if name == self.maintenances_collection_name:
+            return {}
+        return {"active": True}
+
+    def read_collection(self, name, old=None):
+        """
+        Read the documents of a configuration collection, by _id. The documents that are the same
+        as in old (the documents of the collection that are loaded now) are kept as they are, so
+        that their compiled conditions are reused.
+        """
+        documents = {}
+        for document in self.db[name].find(self.collection_filter(name)):
+            _id = document.pop("_id")
+            if old is not None and old.get(_id) == document:
+                document = old[_id]
+            documents[_id] = document
+        return documents
+
+    def apply_documents(self, documents):
+        """
+        Build the configuration from the documents of its collections, reading the rules of any
+        enrichment set that has just been activated, compile the conditions that have changed and
+        swap all of it in at once.
+
+        Args:
+        documents (dict): for each collection name, its documents by _id. The enrichment sets
+          whose metadata and rules documents are the same objects as before are reused.
+        """
+        documents = dict(documents)
+        for name in (self.maintenances_collection_name, self.enrich_metadata_collection_name, self.correlations_collection_name):
+            if name not in documents:
+                documents[name] = self.read_collection(name)
+        by_order = lambda x: x.get("order", float("inf"))
+
+        maintenances = list(documents[self.maintenances_collection_name].values())
+        enrichment_metadata = sorted(documents[self.enrich_metadata_collection_name].values(), key=by_order)
+
+        enrichments = []
+        enrichment_sets = {}
+        changed_sets = []
+        for metadata in enrichment_metadata:
+            if not ("active" in metadata and metadata["active"]):
+                continue
+            collection_name = self.enrich_collection_prefix + metadata["name"]
+            if collection_name in enrichment_sets:
+                # the same name twice in the metadata gets the same rules, like before
+                enrichments.append(enrichment_sets[collection_name][2])
+                continue
+            if collection_name not in documents:
+                documents[collection_name] = self.read_collection(collection_name)
+            rules = documents[collection_name]
+            previous = self.enrichment_sets.get(collection_name)
+            if previous is not None and previous[0] is metadata and previous[1] is rules:
+                enrichment_set = previous[2]
+            else:
+                enrichment_set = {
+                    "name": metadata["name"],
+                    "type": metadata["type"],
+                    "rules": sorted(rules.values(), key=by_order),
+                }
+                changed_sets.append(enrichment_set)
+            enrichments.append(enrichment_set)
+            enrichment_sets[collection_name] = (metadata, rules, enrichment_set)
+        # the rules of sets that have been deactivated aren't kept
+        documents = {
+            name: x for (name, x) in documents.items()
+            if not name.startswith(self.enrich_collection_prefix) or name in enrichment_sets
+        }
+
+        correlations = sorted(documents[self.correlations_collection_name].values(), key=by_order)
+
+        self.screen_regexes(changed_sets)
+        predicates = self.compiled(maintenances, enrichments, correlations, previous=self.predicates)
+        # one update of the instance dict, so events on other threads see the old configuration or the new one
+        self.__dict__.update(
+            documents=documents,
+            enrichment_sets=enrichment_sets,
+            maintenances=maintenances,
+            enrichment_metadata=enrichment_metadata,
+            enrichments=enrichments,
+            correlations=correlations,
+            predicates=predicates,
+        )
+
+        mapping_fields = {}
+        for enrichment_set in changed_sets:
+            for rule in enrichment_set["rules"]:
+                if rule.get("type") == "mapping" and isinstance(rule.get("config"), dict) and rule["config"].get("name"):
+                    mapping_fields.setdefault(rule["config"]["name"], set()).update(
+                        f["tag_name"] for f in rule["config"].get("fields", []) if f.get("type") == "query_tag"
+                    )
+        self.mapping_tables.preload(mapping_fields)
+
+    def reload_collections(self, names=None):
+        """
+        Read configuration collections again (all of the loaded ones if names is None) and apply
+        what has changed in them.
+        """
+        documents = dict(self.documents)
+        for name in list(documents) if names is None else names:
+            if name in documents or name in (
+                self.maintenances_collection_name,
+                self.enrich_metadata_collection_name,
+                self.correlations_collection_name,
+            ):
+                documents[name] = self.read_collection(name, documents.get(name))
+        self.apply_documents(documents)
+
+    def apply_changes(self, changes):
+        """
+        Apply MongoDB change stream events (with full documents looked up) to the loaded
+        configuration, so that only the changed documents are replaced and compiled again.
+        Collections that were dropped or renamed are read again.
+        """
+        documents = dict(self.documents)
+        copied = set()
+        for change in changes:
+            name = change.get("ns", {}).get("coll")
+            if name not in documents:
+                # not loaded, like the rules of an inactive enrichment set
+                continue
+            if change["operationType"] not in ("insert", "update", "replace", "delete"):
+                documents[name] = self.read_collection(name, documents[name])
+                copied.add(name)
+                continue
+            if name not in copied:
+                documents[name] = dict(documents[name])
+                copied.add(name)
+            _id = change["documentKey"]["_id"]
+            document = change.get("fullDocument")
+            # matched like collection_filter does in MongoDB, where 1 isn't true
+            if document is not None and all(type(document.get(k)) is type(v) and document.get(k) == v for (k, v) in self.collection_filter(name).items()):
+                documents[name][_id] = {k: v for (k, v) in document.items() if k != "_id"}
+            else:
+                documents[name].pop(_id, None)
+        self.apply_documents(documents)
+
+    def screen_regexes(self, rules):
+        """
+        Compile the regexes in the rules ahead of time, so that the regex guard can flag
+        patterns that may backtrack catastrophically when they're loaded instead of when
+        they stall an event. Invalid regexes are left for the operators to report.
+        """
+        if isinstance(rules, list):
+            for x in rules:
+                self.screen_regexes(x)
+        elif isinstance(rules, dict):
+            regexes = []
+            if rules.get("type") in ("regex", "formal-regex") and isinstance(rules.get("value"), str):
+                regexes.append((rules["value"], re.IGNORECASE if rules["type"] == "regex" else 0))
+                if self.broken_regex:
+                    regexes.append((self.fix_regex(rules["value"]), re.IGNORECASE if rules["type"] == "regex" else 0))
+            if isinstance(rules.get("regex"), str):
+                regexes.append((rules["regex"], 0))
+            for (regex, flags) in regexes:
+                try:
+                    regex_guard.compile(regex, flags)
+                except re.error:
+                    pass
+            for value in rules.values():
+                if isinstance(value, (list, dict)):
+                    self.screen_regexes(value)
+
+    def compile_conditions(self):
+        """
+        Compile the conditions of the loaded rules, maintenance windows and correlations into
+        predicates, so that events don't have to wait for them to be compiled.
+        """
+        self.predicates = self.compiled(self.maintenances, self.enrichments, self.correlations)
+
+    def compiled(self, maintenances, enrichments, correlations, previous=None):
+        """
+        Compile the conditions of a configuration, reusing the predicates in previous for the
+        conditions (and rule indexes for the enrichment sets) that are the same objects as when
+        they were compiled, and return the predicates.
+        """
+        live = {}
+        for enrichment_set in enrichments:
+            live[id(enrichment_set)] = enrichment_set
+            for rule in enrichment_set["rules"]:
+                live[id(rule.get("when"))] = rule.get("when")
+        for maint in maintenances:
+            live[id(maint.get("condition"))] = maint.get("condition")
+        for correlation in correlations:
+            live[id(correlation)] = correlation
+        predicates = {
+            key: r for (key, r) in (previous or {}).items() if live.get(key[0], live) is r[0]
+        }
+        for enrichment_set in enrichments:
+            for rule in enrichment_set["rules"]:
+                self.predicate(rule.get("when"), predicates=predicates)
+                if rule.get("type") == "mapping":
+                    # do_enrichment checks the when condition of mappings again, with broken regexes fixed
+                    self.predicate(rule.get("when"), broken_regex=True, predicates=predicates)
+            self.rule_index(enrichment_set, predicates=predicates)
+        for maint in maintenances:
+            self.predicate(maint.get("condition"), predicates=predicates)
+        for correlation in correlations:
+            self.correlation_predicate(correlation, predicates=predicates)
+        return predicates
+
     def add_message_to_event(self, event, message, is_debug=False):
         if is_debug and not self.debug:
             return
@@ -383,7 +573,7 @@ class Enrichment:
                 if broken_regex:
                     regex = self.fix_regex(regex)
                 try:
-                    return re.search(regex, left, re.IGNORECASE) is not None
+                    return regex_guard.search(regex, left, re.IGNORECASE) is not None
                 except re.error:
                     print(f"Invalid regex {regex}")
                     return False
@@ -392,14 +582,14 @@ class Enrichment:
                 # if broken_regex:
                 #     regex = self.fix_regex(regex)
                 try:
-                    return re.search(regex, left) is not None
+                    return regex_guard.search(regex, left) is not None
                 except re.error:
                     if broken_regex:
                         print(f"Invalid regex {regex}, trying to fix it... ", end='', flush=True)
                         try:
                             regex = self.fix_regex(regex)
                             print(f"fixed to {regex}")
-                            return re.search(regex, left) is not None
+                            return regex_guard.search(regex, left) is not None
                         except re.error:
                             print(f"still invalid regex {regex}")
                             return False
@@ -485,6 +675,287 @@ class Enrichment:
                 raise ValueError(f"Unsupported operator {operator} in condition {json.dumps(condition)}")
         return True
 
+    def predicate(self, condition, broken_regex=None, prepend_path=None, predicates=None):
+        """
+        Get the compiled predicate for a condition, compiling it the first time it's seen.
+        Meant for the conditions of loaded rules, which are used over and over; compiled
+        predicates are kept until the next load_from_mongo.
+        """
+        if broken_regex is None:
+            broken_regex = self.broken_regex
+        if prepend_path is None:
+            prepend_path = self.prepend_path
+        if predicates is None:
+            predicates = self.predicates
+        key = (id(condition), broken_regex, prepend_path)
+        r = predicates.get(key)
+        # the condition is kept with its predicate, so its id can't be reused by another condition
+        if r is None or r[0] is not condition:
+            r = predicates[key] = (condition, self.compile_condition(condition, broken_regex, prepend_path))
+        return r[1]
+
+    def correlation_predicate(self, correlation, predicates=None):
+        """
+        Get the compiled predicate for the text BPQL filter of a correlation.
+        """
+        if predicates is None:
+            predicates = self.predicates
+        key = (id(correlation), "correlation", None)
+        r = predicates.get(key)
+        if r is None or r[0] is not correlation:
+            try:
+                predicate = self.compile_condition(self.text_BPQL_to_json(correlation["filter"]))
+            except Exception as e:
+                predicate = self.compile_error(e)
+            r = predicates[key] = (correlation, predicate)
+        return r[1]
+
+    def rule_index(self, enrichment_set, predicates=None):
+        """
+        Get the index of the rules of an enrichment set on the values their when conditions
+        require (see rule_index.py), building it the first time it's needed.
+        """
+        if predicates is None:
+            predicates = self.predicates
+        key = (id(enrichment_set), "rules", None)
+        r = predicates.get(key)
+        rules = enrichment_set["rules"]
+        if r is None or r[0] is not enrichment_set or r[1].size != len(rules):
+            keys = []
+            for rule in rules:
+                tests = []
+                if isinstance(rule, dict) and "when" in rule and self.well_formed(rule["when"]):
+                    tests = list(self.required_tests(rule["when"], self.prepend_path))
+                if tests:
+                    (path, values) = min(tests, key=lambda test: len(test[1]))
+                    keys.append((path, self.compile_path(path), values))
+                else:
+                    keys.append(None)
+            r = predicates[key] = (enrichment_set, RuleIndex(keys))
+        return r[1]
+
+    def well_formed(self, condition):
+        """
+        Whether the compiled predicate of a condition can't raise, so that skipping it for events
+        it can't match doesn't hide an error.
+        """
+        if condition is None:
+            return True
+        if not isinstance(condition, dict):
+            return False
+        for operator, operands in condition.items():
+            if operator in ("=", "!=", "IN", "NOT IN"):
+                if not isinstance(operands, list) or len(operands) < 2 or not isinstance(operands[0], str):
+                    return False
+                rights = [operands[1]] if operator in ("=", "!=") else operands[1]
+                return isinstance(rights, list) and all(
+                    isinstance(x, str)
+                    or (isinstance(x, dict) and x.get("type") in ("regex", "formal-regex") and isinstance(x.get("value"), str))
+                    for x in rights
+                )
+            elif operator in ("OR", "AND"):
+                if not isinstance(operands, list) or not all(self.well_formed(x) for x in operands):
+                    return False
+            else:
+                return False
+        return True
+
+    def required_tests(self, condition, prepend_path):
+        """
+        Yield the (path, values) of the = and IN tests on plain strings that a well formed condition
+        can't be true without, where values are the case-folded strings the value at path must equal.
+        """
+        if condition is None:
+            return
+        for operator, operands in condition.items():
+            if operator in ("=", "IN"):
+                rights = [operands[1]] if operator == "=" else operands[1]
+                if all(isinstance(x, str) for x in rights):
+                    yield (self.make_path(prepend_path, operands[0]), {x.lower() for x in rights})
+                return
+            elif operator in ("!=", "NOT IN"):
+                return
+            elif operator == "AND":
+                for x in operands:
+                    yield from self.required_tests(x, prepend_path)
+
+    @staticmethod
+    def compile_error(e):
+        """
+        A predicate that raises e, for a condition that evaluate_condition would raise on
+        when it gets to it.
+        """
+        def fail(entity):
+            raise e
+        return fail
+
+    def compile_or_fail(self, compile, *args):
+        try:
+            return compile(*args)
+        except Exception as e:
+            return self.compile_error(e)
+
+    def compile_condition(self, condition, broken_regex=None, prepend_path=None):
+        """
+        Compile a BPQL condition into a function of an entity that returns what evaluate_condition
+        would. The operators are dispatched, the paths are split and the regexes are fixed and
+        compiled once here instead of on every evaluation.
+        """
+        if broken_regex is None:
+            broken_regex = self.broken_regex
+        if prepend_path is None:
+            prepend_path = self.prepend_path
+        if condition is None:
+            return lambda entity: True
+
+        checks = []
+        comparison = None
+        for operator, operands in condition.items():
+            if operator in ("=", "!=", "IN", "NOT IN"):
+                comparison = self.compile_or_fail(self.compile_comparison, operator, operands, broken_regex, prepend_path)
+                # a comparison decides the condition, so anything after it is never looked at
+                break
+            elif operator in ("OR", "AND"):
+                try:
+                    subs = [self.compile_or_fail(self.compile_condition, x, broken_regex, prepend_path) for x in operands]
+                except Exception as e:
+                    checks.append(self.compile_error(e))
+                    continue
+                if operator == "OR":
+                    checks.append(lambda entity, subs=subs: any(sub(entity) for sub in subs))
+                else:
+                    checks.append(lambda entity, subs=subs: all(sub(entity) for sub in subs))
+            else:
+                checks.append(self.compile_error(ValueError(f"Unsupported operator {operator} in condition {json.dumps(condition)}")))
+
+        if not checks:
+            return comparison or (lambda entity: True)
+        if comparison is None and len(checks) == 1:
+            return checks[0]
+
+        def predicate(entity):
+            for check in checks:
+                if not check(entity):
+                    return False
+            return comparison(entity) if comparison is not None else True
+        return predicate
+
+    def compile_comparison(self, operator, operands, broken_regex, prepend_path):
+        """
+        Compile a =, !=, IN or NOT IN condition.
+        """
+        get = self.compile_path(self.make_path(prepend_path, operands[0]))
+        if operator in ("=", "!="):
+            matches = self.compile_or_fail(self.compile_operand, operands[1], broken_regex)
+        elif not isinstance(operands[1], list):
+            matches = self.compile_error(ValueError(f"Unsupported type {type(operands[1])}"))
+        else:
+            matchers = [self.compile_or_fail(self.compile_operand, x, broken_regex) for x in operands[1]]
+            strings = {x.lower() for x in operands[1] if isinstance(x, str)}
+            if len(strings) == len(operands[1]):
+                # all plain strings, so one lookup does it
+                matches = lambda left: left.lower() in strings
+            else:
+                matches = lambda left: any(m(left) for m in matchers)
+
+        if operator in ("=", "IN"):
+            def compare(entity):
+                value = get(entity)
+                if value is None:
+                    return False
+                return matches(str(value))
+        else:
+            def compare(entity):
+                value = get(entity)
+                if value is None:
+                    return True
+                return not matches(str(value))
+        return compare
+
+    def compile_operand(self, operand, broken_regex):
+        """
+        Compile the right side of a BPQL = into a function of the string value of the left side.
+        """
+        if isinstance(operand, str):
+            right = operand.lower()
+            return lambda left: left.lower() == right
+        elif isinstance(operand, dict):
+            if operand["type"] == "regex":
+                regex = operand["value"]
+                if broken_regex:
+                    regex = self.fix_regex(regex)
+                flags = re.IGNORECASE
+            elif operand["type"] == "formal-regex":
+                regex = operand["value"]
+                flags = 0
+            else:
+                raise ValueError(f"Unsupported type {operand['type']}")
+            try:
+                compiled = regex_guard.compile(regex, flags)
+            except re.error:
+                if operand["type"] == "regex":
+                    print(f"Invalid regex {regex}")
+                    return lambda left: False
+                if not broken_regex:
+                    return lambda left: False
+                try:
+                    compiled = regex_guard.compile(self.fix_regex(regex), flags)
+                except re.error:
+                    print(f"Invalid regex {regex}, still invalid after fixing it")
+                    return lambda left: False
+            return self.compile_search(compiled)
+        else:
+            raise ValueError(f"Unsupported type {type(operand)}")
+
+    def compile_search(self, regex):
+        """
+        Compile a regex search into a function of the string to search, which skips the regex engine
+        (and the regex guard) when the pattern is a plain string with wildcards.
+        """
+        search = lambda left: regex_guard.search(regex, left) is not None
+        r = literal(regex.pattern, regex.flags)
+        if r is None:
+            return search
+        (anchored, text) = r
+        if not regex.flags & re.IGNORECASE:
+            return (lambda left: left.startswith(text)) if anchored else (lambda left: text in left)
+        if not text.isascii():
+            return search
+        # lower() only folds case like the regex engine does for ASCII
+        text = text.lower()
+        if anchored:
+            return lambda left: left.lower().startswith(text) if left.isascii() else search(left)
+        return lambda left: text in left.lower() if left.isascii() else search(left)
+
+    @staticmethod
+    def compile_path(path):
+        """
+        Compile a path into a function that gets the value at it, like get_value_at_path.
+        """
+        keys = []
+        for key in path.split("."):
+            try:
+                keys.append((key, int(key)))
+            except ValueError:
+                keys.append((key, None))
+
+        def get(data):
+            current = data
+            try:
+                for (key, index) in keys:
+                    if isinstance(current, dict):
+                        current = current.get(key)
+                    elif isinstance(current, list):
+                        if index is None:
+                            return None
+                        current = current[index]
+                    else:
+                        return None
+                return current
+            except:
+                return None
+        return get
+
     def apply_regex_and_fill_template(self, input_string, regex, template):
         """
         Apply a regex to a string and fill a template with the results.
@@ -503,7 +974,7 @@ class Enrichment:
         if type(template) is not str:
             raise ValueError(f"apply_regex_and_fill_template: template must be a string, not {type(template)} (got {template})")
 
-        match = re.search(regex, _input_string)
+        match = regex_guard.search(regex, _input_string)
         if match:
             temp = template
             for i in range(1, len(match.groups()) + 1):
@@ -533,16 +1004,15 @@ class Enrichment:
         rule_id = mapping_obj.get("id", "no mapping id")
 
         collection_name = "mapping_" + mapping["name"]
-        try:
-            self.db.list_collections(filter={"name": collection_name}).next()
-        except StopIteration:
+        # looked up in an in-memory index of the collection rather than in MongoDB, see mapping_tables.py
+        table = self.mapping_tables.table(mapping["name"])
+        if table is None:
             self.add_message_to_event(
                 entity,
                 f"do_mapping: collection {collection_name} not found",
                 is_debug=True,
             )
             return
-        collection = self.db[collection_name]
         fields = mapping["fields"]
         query_fields = [f for f in fields if f["type"] == "query_tag"]
         result_fields = [f for f in fields if f["type"] == "result_tag"]
@@ -562,7 +1032,7 @@ class Enrichment:
             self.add_message_to_event(entity, f"do_mapping: no query fields found")
             return
         query_message = f"do_mapping: query {json.dumps(query)}"
-        query_result = collection.find_one(query, {"_id": 0})
+        query_result = table.find_one(query, case_insensitive=bool(mapping.get("case_insensitive")))
         if query_result is None:
             query_message += " returned no results"
             self.add_message_to_event(entity, query_message, is_debug=True)
@@ -742,7 +1212,7 @@ class Enrichment:
             if source_system:
                 # source system can be a broken regex
                 selected_source_system = self.fix_regex(selected_source_system)
-                if not re.search(selected_source_system, source_system, re.IGNORECASE):
+                if not regex_guard.search(selected_source_system, source_system, re.IGNORECASE):
                     self.add_message_to_event(
                         entity,
                         f"do_enrichment: enrichment {enrichment['id']} not applied because source system {selected_source_system} does not match {source_system}",
@@ -754,12 +1224,7 @@ class Enrichment:
         try:
             if enrichment_type == "mapping":
                 if enrichment["when"] is not None:
-                    if not self.evaluate_condition(
-                        entity,
-                        enrichment["when"],
-                        broken_regex=True,
-                        prepend_path=prepend_path,
-                    ):
+                    if not self.predicate(enrichment["when"], broken_regex=True, prepend_path=prepend_path)(entity):
                         self.add_message_to_event(
                             entity,
                             f"do_enrichment: enrichment {enrichment['id']} not applied because when condition is false",
@@ -834,7 +1299,7 @@ class Enrichment:
             False otherwise, and maints_applied is a list of the maintenance windows that apply.
         """
         maints_now = [maint for maint in self.maintenances if self.is_active_now(maint)]
-        maints_applied = [maint for maint in maints_now if self.evaluate_condition(event, maint["condition"])]
+        maints_applied = [maint for maint in maints_now if self.predicate(maint["condition"])(event)]
         is_in_maint = len(maints_applied) > 0
         return (is_in_maint, maints_applied)
 
@@ -875,9 +1340,8 @@ class Enrichment:
         Returns:
         Correlation value if the event produces one, None otherwise.
         """
-        filter = self.text_BPQL_to_json(correlation["filter"])
         tags = correlation["tags"]
-        if self.evaluate_condition(event, filter):
+        if self.correlation_predicate(correlation)(event):
             message_str = f"Matched correlation {correlation['id']}, "
             v = self.correlation_value(event, correlation)
             if v:
@@ -898,9 +1362,15 @@ class Enrichment:
         Returns:
         The enriched event.
         """
-        for enrichment_set in self.enrichments:
-            for enrichment in enrichment_set["rules"]:
-                if self.evaluate_condition(event, enrichment["when"]):
+        # read once, since the watcher can swap in a new configuration at any time
+        (enrichments, correlations) = (self.enrichments, self.correlations)
+        for enrichment_set in enrichments:
+            rules = enrichment_set["rules"]
+            # only the rules the event's values may match, in order
+            candidates = self.rule_index(enrichment_set).candidates(event)
+            for position in candidates:
+                enrichment = rules[position]
+                if self.predicate(enrichment["when"])(event):
                     message_str = (
                         f"Matched rule {enrichment_set['name']}: {enrichment['id']}"
                     )
@@ -918,7 +1388,8 @@ class Enrichment:
                     else:
                         message_str += f" - not applied"
                         self.add_message_to_event(event, message_str, is_debug=True)
-        for correlation in self.correlations:
+                    candidates.changed()
+        for correlation in correlations:
             correlation_value = self.do_correlation(event, correlation)
             if correlation_value:
                 self.set_value_at_path(
@@ -0,0 +1,146 @@
+import os
+import re
+import time
+import logging
+import threading
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+import pdaltagent.stats
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# how often to check the enrichment, maintenance and correlation collections for changes when MongoDB can't
+# stream them (change streams need a replica set), and to wait before following the stream again after an error
+ENRICH_POLL_SECONDS = 10
+if os.environ.get("PDAGENTD_ENRICH_POLL_SECONDS"):
+    try:
+        ENRICH_POLL_SECONDS = float(os.environ.get("PDAGENTD_ENRICH_POLL_SECONDS"))
+    except:
+        pass
+
+# the server errors that mean change streams aren't available at all, like on a standalone server
+CHANGE_STREAMS_UNSUPPORTED = {40573, 40324, 136}
+
+
+class EnrichmentWatcher:
+    """Keeps an Enrichment up to date with MongoDB from a background thread in each worker process, so that
+    no event waits for it to be reloaded.
+
+    The watcher follows a change stream on the database and applies each batch of changes to the
+    maintenance, metadata, rules and correlation documents (see Enrichment.apply_changes). Where change
+    streams aren't available it compares the collections' hashes every ENRICH_POLL_SECONDS instead, and
+    reads again only the collections that have changed (or all of them, if the server won't hash them).
+    Either way, only the conditions that changed are compiled again and the new configuration is swapped
+    in all at once.
+
+    Args:
+        enrich (Enrichment): the enrichment to keep up to date
+    """
+
+    def __init__(self, enrich, poll_seconds=ENRICH_POLL_SECONDS):
+        self.enrich = enrich
+        self.poll_seconds = poll_seconds
+        self.pid = None
+        self.thread = None
+        self.mode = None
+        self.hashes = {}
+        self.applied_at = None
+        self.counts = {'changes': 0, 'polls': 0, 'reloads': 0, 'errors': 0}
+        pdaltagent.stats.register("enrichment_watcher", self.stats)
+
+    def start(self):
+        """Start watching in this process, if it isn't already; cheap enough to call for every event, and threads
+        don't survive the fork into a worker process"""
+        if self.pid == os.getpid() and self.thread.is_alive():
+            return
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name="enrichment-watcher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                if self.mode != "polling":
+                    self.follow_changes()
+                else:
+                    self.poll()
+                    time.sleep(self.poll_seconds)
+            except OperationFailure as e:
+                if self.mode != "polling" and e.code in CHANGE_STREAMS_UNSUPPORTED:
+                    logger.info(f"MongoDB can't stream changes ({e}), polling for enrichment changes every {self.poll_seconds} seconds")
+                    self.mode = "polling"
+                    continue
+                self.failed(e)
+            except Exception as e:
+                self.failed(e)
+
+    def failed(self, e):
+        self.counts['errors'] += 1
+        logger.error(f"Couldn't update the enrichment configuration: {e}")
+        time.sleep(self.poll_seconds)
+
+    def watched(self):
+        """The change stream pipeline for the configuration collections"""
+        enrich = self.enrich
+        return [{"$match": {"$or": [
+            {"ns.coll": {"$in": [
+                enrich.maintenances_collection_name,
+                enrich.enrich_metadata_collection_name,
+                enrich.correlations_collection_name,
+            ]}},
+            {"ns.coll": {"$regex": "^" + re.escape(enrich.enrich_collection_prefix)}},
+        ]}}]
+
+    def follow_changes(self):
+        with self.enrich.db.watch(self.watched(), full_document="updateLookup", max_await_time_ms=1000) as stream:
+            self.mode = "change_stream"
+            # anything that changed before the stream was opened
+            self.reload()
+            while stream.alive:
+                changes = []
+                change = stream.try_next()
+                while change is not None:
+                    changes.append(change)
+                    change = stream.try_next() if len(changes) < 1000 else None
+                if changes:
+                    self.enrich.apply_changes(changes)
+                    self.counts['changes'] += len(changes)
+                    self.applied_at = time.time()
+                    logger.debug(f"Applied {len(changes)} enrichment configuration changes")
+
+    def poll(self):
+        enrich = self.enrich
+        self.counts['polls'] += 1
+        names = sorted(set(enrich.documents) | {
+            enrich.maintenances_collection_name,
+            enrich.enrich_metadata_collection_name,
+            enrich.correlations_collection_name,
+        })
+        try:
+            hashes = enrich.db.command("dbHash", collections=names)["collections"]
+        except OperationFailure:
+            self.reload()
+            return
+        changed = [name for name in names if hashes.get(name) != self.hashes.get(name)]
+        if changed:
+            enrich.reload_collections(changed)
+            self.counts['reloads'] += 1
+            self.applied_at = time.time()
+            logger.debug(f"Reloaded the changed enrichment collections {', '.join(changed)}")
+        self.hashes = hashes
+
+    def reload(self):
+        self.enrich.reload_collections()
+        self.counts['reloads'] += 1
+        self.applied_at = time.time()
+
+    def stats(self):
+        return dict(
+            self.counts,
+            mode=self.mode,
+            seconds_since_applied=round(time.time() - self.applied_at, 1) if self.applied_at else None,
+        )
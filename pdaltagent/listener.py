@@ -2,24 +2,46 @@
 
 from pdaltagent.tasks import send_to_pd
 from pdaltagent.scrubber import scrub
+from pdaltagent.config import app as celery_app
+from pdaltagent.spool import get_spool
+from pdaltagent.admission import admission, event_severity
 import pdaltagent.pd as pd
 import os
+import json
 
-from flask import Flask, request
+from flask import Flask, request, jsonify
 app = Flask(__name__)
 
 SCRUB = True if os.environ.get("PDAGENTD_SCRUB_PII") and os.environ.get("PDAGENTD_SCRUB_PII").lower != 'false' else False
 
+def publish(routing_key, body, destination_type, task_id=None, producer=None):
+	send_to_pd.apply_async((routing_key, body), {'destination_type': destination_type}, task_id=task_id, producer=producer)
+
+def enqueue(routing_key, body, destination_type):
+	"""Publish an event to the broker, spooling it to disk if the broker is unavailable"""
+	spool = get_spool(publish)
+	if spool is None:
+		publish(routing_key, body, destination_type)
+	else:
+		spool.publish(routing_key, body, destination_type)
+
+def too_many_events(retry_after):
+	return "Too many events queued, try again later\n", 429, {'Retry-After': str(retry_after)}
+
 @app.route('/integration/<routing_key>/enqueue', methods=['POST'])
 def enqueue_integration(routing_key):
 	body = request.get_json(force=True)
 	if not body:
 		return "Bad request\n", 400
 
+	retry_after = admission.check()
+	if retry_after is not None:
+		return too_many_events(retry_after)
+
 	if SCRUB:
 		body = scrub(body)
 
-	send_to_pd.delay(routing_key, body, destination_type="v1")
+	enqueue(routing_key, body, "v1")
 	return "Message enqueued\n"
 
 @app.route('/x-ere/<routing_key>', methods=['POST'])
@@ -28,10 +50,14 @@ def enqueue_x_ere(routing_key):
 	if not body:
 		return "Bad request\n", 400
 
+	retry_after = admission.check()
+	if retry_after is not None:
+		return too_many_events(retry_after)
+
 	if SCRUB:
 		body = scrub(body)
 
-	send_to_pd.delay(routing_key, body, destination_type="x-ere")
+	enqueue(routing_key, body, "x-ere")
 	return "Message enqueued\n"
 
 @app.route('/v2/enqueue', methods=['POST'])
@@ -51,8 +77,104 @@ def enqueue_v2():
 	if not pd.is_valid_integration_key(routing_key):
 		return "Invalid routing key found in payload\n", 400
 
+	retry_after = admission.check(event_severity(body))
+	if retry_after is not None:
+		return too_many_events(retry_after)
+
 	if SCRUB:
 		body = scrub(body)
 
-	send_to_pd.delay(routing_key, body, destination_type="v2")
+	enqueue(routing_key, body, "v2")
 	return "Message enqueued\n"
+
+def validate_v2(body):
+	"""Validate a v2 event the same way as /v2/enqueue
+
+	Returns:
+		str: the reason the event is invalid, or None if it's valid
+	"""
+	if not body or not isinstance(body, dict):
+		return "Bad request"
+	if not pd.is_valid_v2_payload(body):
+		return "Invalid PD events v2 payload"
+	if not body.get('routing_key'):
+		return "No routing key found in payload"
+	if not pd.is_valid_integration_key(body['routing_key']):
+		return "Invalid routing key found in payload"
+	return None
+
+def batch_items():
+	"""Yield (body, error) for each event in a JSON array or NDJSON request body. NDJSON sent as
+	application/x-ndjson is read line by line as it comes in, so it doesn't have to be held in memory."""
+	if 'ndjson' in (request.content_type or '') or 'jsonlines' in (request.content_type or ''):
+		lines = request.stream
+	else:
+		data = request.get_data()
+		try:
+			items = json.loads(data)
+		except ValueError:
+			# not one JSON document, so try it as NDJSON
+			lines = data.splitlines()
+		else:
+			for item in (items if isinstance(items, list) else [items]):
+				yield (item, None)
+			return
+	for line in lines:
+		if not line.strip():
+			continue
+		try:
+			yield (json.loads(line), None)
+		except ValueError as e:
+			yield (None, f"Invalid JSON: {e}")
+
+@app.route('/v2/enqueue/batch', methods=['POST'])
+def enqueue_v2_batch():
+	"""Enqueue many v2 events at once, from a JSON array or newline delimited JSON, publishing them
+	all over one broker connection. Responds with a result for each event, in order. If the broker fails
+	partway through and there's no spool, the rest of the events are failed, so that the client knows
+	which ones were enqueued and only sends the others again."""
+	results = []
+	enqueued = 0
+	throttled = 0
+	spool = get_spool(publish)
+	# the error that publishing failed with, after which the rest of the events aren't tried
+	broken = None
+	with celery_app.producer_or_acquire() as producer:
+		for (index, (body, error)) in enumerate(batch_items()):
+			if error is None:
+				error = validate_v2(body)
+			if error is not None:
+				results.append({'index': index, 'status': 'invalid', 'error': error})
+				continue
+			if broken is not None:
+				results.append({'index': index, 'status': 'failed', 'error': str(broken)})
+				continue
+			retry_after = admission.check(event_severity(body))
+			if retry_after is not None:
+				results.append({'index': index, 'status': 'throttled', 'retry_after': retry_after})
+				throttled += 1
+				continue
+			if SCRUB:
+				body = scrub(body)
+			if spool is not None and spool.spooling:
+				spool.append(body['routing_key'], body, "v2")
+			else:
+				try:
+					publish(body['routing_key'], body, "v2", producer=producer)
+				except Exception as e:
+					if spool is None:
+						app.logger.error(f"Couldn't enqueue event: {e}")
+						broken = e
+						results.append({'index': index, 'status': 'failed', 'error': str(e)})
+						continue
+					spool.failed(e)
+					spool.append(body['routing_key'], body, "v2")
+			results.append({'index': index, 'status': 'enqueued'})
+			enqueued += 1
+	failed = len([r for r in results if r['status'] == 'failed'])
+	response = jsonify({'enqueued': enqueued, 'invalid': len(results) - enqueued - throttled - failed, 'throttled': throttled, 'failed': failed, 'results': results})
+	if throttled:
+		response.headers['Retry-After'] = str(max(r['retry_after'] for r in results if r['status'] == 'throttled'))
+		if not enqueued:
+			response.status_code = 429
+	return response
@@ -0,0 +1,358 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import pickle
+import marshal
+import hashlib
+import logging
+import tempfile
+from array import array
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# where mapping tables that are too big to hold in each worker's memory are written as files that all the
+# worker processes on the host map; set it to empty to look them up in MongoDB instead
+MAPPING_STORE_DIR = os.environ.get("PDAGENTD_MAPPING_STORE_DIR", os.path.join(tempfile.gettempdir(), "pdaltagent-mappings"))
+
+# how often a process checks whether another process has replaced a store file it has mapped
+MAPPING_STORE_STAT_SECONDS = 5
+
+MAGIC = b"PDMAPST2"
+HEADER = struct.Struct("<8sI")
+# key hash, and where its rows start in the field's postings and how many there are
+SLOT = struct.Struct("<QII")
+ROW_ID = struct.Struct("<I")
+ZERO_HASH = bytes(8)
+OFFSET = struct.Struct("<Q")
+
+
+def index_value(value):
+    """The form of a value in the index: MongoDB matches 1 and 1.0 but not 1 and true or "1", and neither does this
+
+    Raises:
+        TypeError: for values that can't be indexed, like dicts
+    """
+    if isinstance(value, str):
+        return value
+    r = (type(value) is bool, value)
+    hash(r)
+    return r
+
+
+def index_values(value, case_insensitive):
+    """The index forms a row's value can be found by: an array is found by each of its elements, like in MongoDB"""
+    values = value if isinstance(value, list) else [value]
+    r = []
+    for x in values:
+        try:
+            x = index_value(x)
+        except TypeError:
+            continue
+        r.append(x.lower() if case_insensitive and isinstance(x, str) else x)
+    return r
+
+
+def key_hash(value):
+    """A hash of the index form of a value that's the same in every process (unlike hash()), and never 0"""
+    if isinstance(value, tuple) and isinstance(value[1], float) and value[1].is_integer():
+        # MongoDB matches 1 and 1.0, but they have different reprs
+        value = (value[0], int(value[1]))
+    return int.from_bytes(hashlib.blake2b(repr(value).encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little") or 1
+
+
+def encode(value):
+    """Rows are usually plain JSON-like data that marshal handles quickly, but may have dates and the like"""
+    try:
+        return b"m" + marshal.dumps(value)
+    except ValueError:
+        return b"p" + pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data):
+    return marshal.loads(data[1:]) if data[:1] == b"m" else pickle.loads(data[1:])
+
+
+def copy_file(src, dst, size=1 << 20):
+    while True:
+        data = src.read(size)
+        if not data:
+            return
+        dst.write(data)
+
+
+class MappingStore:
+    """A mapping table in a read-only, memory-mapped file, for tables too big to hold in every worker's memory.
+
+    The file has each distinct value once (see encode), each row as (field id, value id) pairs, and for
+    each indexed field, an open addressing hash table with a slot for each distinct case-folded value,
+    pointing to the list of the rows that have it (its postings). A lookup probes the table of each of
+    its indexed fields, and decodes only the rows in the shortest of their postings, so the pages of the
+    file are shared by all the processes that map it and nothing is read up front.
+
+    Layout: header (magic, meta size), meta (marshal: signature, fields, sections, indexes), value offsets,
+    values, row offsets, rows, then a slot table and postings for each indexed field.
+
+    Args:
+        path (str): the store file
+
+    Raises:
+        ValueError: if the file isn't a mapping store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, meta_size) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a mapping store")
+        meta = marshal.loads(self.mm[HEADER.size:HEADER.size + meta_size])
+        # offsets in the meta data are from the end of it
+        base = HEADER.size + meta_size
+        self.signature = meta["signature"]
+        self.fields = meta["fields"]
+        self.rows = meta["rows"]
+        self.size = len(self.mm)
+        self.sections = {name: base + offset for (name, offset) in meta["sections"].items()}
+        self.indexes = {field: (base + offset, slots, base + postings)
+                        for (field, (offset, slots, postings)) in meta["indexes"].items()}
+        self.stat_at = time.monotonic()
+
+    @staticmethod
+    def build(path, rows, signature, index_fields):
+        """Write a store file, to a temporary file that then replaces path so that readers never see half of one
+
+        Args:
+            path (str): the store file
+            rows (iterable): the rows, as dicts
+            signature (str): identifies the version of the collection the rows came from
+            index_fields (iterable): the fields to index
+        """
+        directory = os.path.dirname(path)
+        fields = {}
+        value_ids = {}
+        value_offsets = array("Q", [0])
+        row_offsets = array("Q", [0])
+        entries = {f: (array("Q"), array("I")) for f in index_fields}
+        with tempfile.TemporaryFile(dir=directory) as values_file, tempfile.TemporaryFile(dir=directory) as rows_file:
+            for (row_id, row) in enumerate(rows):
+                pairs = array("I")
+                for (field, value) in row.items():
+                    if field == "_id":
+                        continue
+                    data = encode(value)
+                    value_id = value_ids.get(data)
+                    if value_id is None:
+                        value_id = value_ids[data] = len(value_ids)
+                        values_file.write(data)
+                        value_offsets.append(value_offsets[-1] + len(data))
+                    pairs.extend((fields.setdefault(field, len(fields)), value_id))
+                    if field in entries:
+                        (hashes, row_ids) = entries[field]
+                        for x in set(index_values(value, True)):
+                            hashes.append(key_hash(x))
+                            row_ids.append(row_id)
+                rows_file.write(pairs.tobytes())
+                row_offsets.append(row_offsets[-1] + len(pairs) * pairs.itemsize)
+            del value_ids
+
+            tables = {}
+            for field in list(entries):
+                (hashes, row_ids) = entries.pop(field)
+                # group the rows by key hash, keeping them in order within each group
+                order = sorted(range(len(hashes)), key=hashes.__getitem__)
+                postings = array("I", [row_ids[i] for i in order])
+                hashes = array("Q", [hashes[i] for i in order])
+                del order, row_ids
+                starts = [i for i in range(len(hashes)) if i == 0 or hashes[i] != hashes[i - 1]]
+                starts.append(len(hashes))
+                slots = 16
+                while slots < len(starts) * 2:
+                    slots *= 2
+                mask = slots - 1
+                table = bytearray(slots * SLOT.size)
+                for n in range(len(starts) - 1):
+                    (start, h) = (starts[n], hashes[starts[n]])
+                    slot = h & mask
+                    while table[slot * SLOT.size:slot * SLOT.size + 8] != ZERO_HASH:
+                        slot = (slot + 1) & mask
+                    SLOT.pack_into(table, slot * SLOT.size, h, start, starts[n + 1] - start)
+                tables[field] = (slots, table, postings)
+
+            (sections, indexes, offset) = ({}, {}, 0)
+            for (name, size) in [("value_offsets", len(value_offsets) * OFFSET.size), ("values", value_offsets[-1]),
+                                 ("row_offsets", len(row_offsets) * OFFSET.size), ("rows", row_offsets[-1])]:
+                sections[name] = offset
+                offset += size
+            for (field, (slots, table, postings)) in tables.items():
+                indexes[field] = (offset, slots, offset + len(table))
+                offset += len(table) + len(postings) * postings.itemsize
+            meta = marshal.dumps({
+                "signature": signature,
+                "fields": sorted(fields, key=fields.get),
+                "rows": len(row_offsets) - 1,
+                "sections": sections,
+                "indexes": indexes,
+            })
+
+            (fd, tmp_path) = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(HEADER.pack(MAGIC, len(meta)))
+                    f.write(meta)
+                    f.write(value_offsets.tobytes())
+                    values_file.seek(0)
+                    copy_file(values_file, f)
+                    f.write(row_offsets.tobytes())
+                    rows_file.seek(0)
+                    copy_file(rows_file, f)
+                    for (slots, table, postings) in tables.values():
+                        f.write(table)
+                        f.write(postings.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                raise
+
+    def replaced(self):
+        """Whether another process has replaced the file since it was mapped, checked at most every few seconds"""
+        now = time.monotonic()
+        if now - self.stat_at < MAPPING_STORE_STAT_SECONDS:
+            return False
+        self.stat_at = now
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return False
+
+    def offset(self, section, i):
+        return OFFSET.unpack_from(self.mm, self.sections[section] + i * OFFSET.size)[0]
+
+    def value(self, value_id):
+        start = self.sections["values"]
+        return decode(self.mm[start + self.offset("value_offsets", value_id):start + self.offset("value_offsets", value_id + 1)])
+
+    def row(self, row_id):
+        """Decode a row into a new dict"""
+        (start, end) = (self.offset("row_offsets", row_id), self.offset("row_offsets", row_id + 1))
+        pairs = struct.unpack_from(f"<{(end - start) // 4}I", self.mm, self.sections["rows"] + start)
+        return {self.fields[pairs[i]]: self.value(pairs[i + 1]) for i in range(0, len(pairs), 2)}
+
+    def postings(self, field, h):
+        """Where the ids of the rows whose value of field has the key hash h are, and how many there are
+
+        Returns:
+            tuple: (file offset, count)
+        """
+        (offset, slots, postings) = self.indexes[field]
+        mask = slots - 1
+        slot = h & mask
+        while True:
+            (slot_hash, start, count) = SLOT.unpack_from(self.mm, offset + slot * SLOT.size)
+            if not slot_hash:
+                return (postings, 0)
+            if slot_hash == h:
+                return (postings + start * ROW_ID.size, count)
+            slot = (slot + 1) & mask
+
+    def find_one(self, query, case_insensitive=False):
+        """Find the first row whose fields equal the values in query, like collection.find_one(query)
+
+        Args:
+            query (dict): field names and values
+            case_insensitive (bool): whether string values match regardless of case
+
+        Returns:
+            dict: the row, None if there isn't one, or NotImplemented if none of the query's fields are indexed
+        """
+        shortest = None
+        for (field, value) in query.items():
+            keys = index_values(value, True) if field in self.indexes else []
+            if len(keys) != 1:
+                continue
+            postings = self.postings(field, key_hash(keys[0]))
+            if shortest is None or postings[1] < shortest[1]:
+                shortest = postings
+            if shortest[1] <= 1:
+                # none, or as few as any field's could have
+                break
+        if shortest is None:
+            return NotImplemented
+        (start, count) = shortest
+        if not count:
+            return None
+        row_ids = struct.unpack_from(f"<{count}I", self.mm, start)
+        wanted = [(f, set(index_values(v, case_insensitive))) for (f, v) in query.items()]
+        # the index is case-folded and hashed, so check each field of the rows it found
+        for row_id in row_ids:
+            row = self.row(row_id)
+            if all(f in row and not values.isdisjoint(index_values(row[f], case_insensitive)) for (f, values) in wanted):
+                return row
+        return None
+
+
+def store_path(name):
+    return os.path.join(MAPPING_STORE_DIR, f"{name}.store")
+
+
+def open_store(name, signature, index_fields, rows=None):
+    """Map the store file of a mapping table if it's up to date and indexes all of index_fields, otherwise build
+    it from rows first (if given). Only one process builds a file at a time; the others wait for it and map it.
+
+    Args:
+        name (str): the mapping_<name> collection name
+        signature (str): identifies the current version of the collection
+        index_fields (iterable): the fields the store must index
+        rows (callable, optional): returns the rows of the collection
+
+    Returns:
+        MappingStore: the store, or None if there's no usable one and rows wasn't given
+    """
+    path = store_path(name)
+
+    def usable():
+        try:
+            store = MappingStore(path)
+        except (OSError, ValueError, EOFError):
+            return (None, None)
+        ok = store.signature == signature and set(index_fields) <= set(store.indexes)
+        return (store if ok else None, store)
+
+    (store, old) = usable()
+    if store is not None or rows is None:
+        return store
+    os.makedirs(MAPPING_STORE_DIR, exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # another process may have built it while this one waited for the lock
+        (store, old) = usable()
+        if store is None:
+            # temporary files left by a process that died building one
+            prefix = os.path.basename(path) + "."
+            for entry in os.listdir(MAPPING_STORE_DIR):
+                if entry.startswith(prefix) and entry != prefix + "lock":
+                    try:
+                        os.unlink(os.path.join(MAPPING_STORE_DIR, entry))
+                    except OSError:
+                        pass
+            # keep indexing the fields the other processes asked for
+            fields = set(index_fields) | (set(old.indexes) if old is not None else set())
+            start = time.monotonic()
+            MappingStore.build(path, rows(), signature, sorted(fields))
+            store = MappingStore(path)
+            logger.info(f"Built mapping store {path}: {store.rows} rows, {store.size} bytes, "
+                        f"indexed on {', '.join(sorted(fields))}, in {time.monotonic() - start:.1f} seconds")
+    return store
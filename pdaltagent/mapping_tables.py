@@ -0,0 +1,422 @@
+import os
+import copy
+import json
+import fcntl
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from pymongo.collation import Collation, CollationStrength
+
+import pdaltagent.mapping_store as mapping_store
+from pdaltagent.mapping_store import index_value, index_values
+from pdaltagent.shared_table import SHARED_DIR
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# mapping tables with up to this many rows are held in memory; bigger ones are looked up in a memory-mapped
+# file shared by the worker processes (see mapping_store.py), or in MongoDB
+MAPPING_TABLE_MAX_ROWS = 200000
+if os.environ.get("PDAGENTD_MAPPING_TABLE_MAX_ROWS"):
+    try:
+        MAPPING_TABLE_MAX_ROWS = int(os.environ.get("PDAGENTD_MAPPING_TABLE_MAX_ROWS"))
+    except:
+        pass
+
+# how many lookups (including the ones that found nothing) to cache for each table that's looked up in MongoDB
+MAPPING_CACHE_SIZE = 10000
+if os.environ.get("PDAGENTD_MAPPING_CACHE_SIZE"):
+    try:
+        MAPPING_CACHE_SIZE = int(os.environ.get("PDAGENTD_MAPPING_CACHE_SIZE"))
+    except:
+        pass
+
+# how often to check, in the background, whether a mapping table has changed in MongoDB
+MAPPING_REFRESH_SECONDS = 300
+if os.environ.get("PDAGENTD_MAPPING_REFRESH_SECONDS"):
+    try:
+        MAPPING_REFRESH_SECONDS = float(os.environ.get("PDAGENTD_MAPPING_REFRESH_SECONDS"))
+    except:
+        pass
+
+# a field that whatever writes the mapping tables sets to the time of each write; if a table has an index on it, its
+# newest value is part of each check, so that rows changed in place are seen at the next check
+MAPPING_UPDATED_FIELD = "updated_at"
+if os.environ.get("PDAGENTD_MAPPING_UPDATED_FIELD") is not None:
+    MAPPING_UPDATED_FIELD = os.environ.get("PDAGENTD_MAPPING_UPDATED_FIELD")
+
+# how often to also hash each mapping table with MongoDB's dbHash, which reads the whole collection, to catch
+# rows that were changed in place in a table without an index on MAPPING_UPDATED_FIELD; the checks in between only
+# look at its size and newest _id, so such changes are seen within MAPPING_HASH_SECONDS + MAPPING_REFRESH_SECONDS.
+# 0 never hashes them
+MAPPING_HASH_SECONDS = 900
+if os.environ.get("PDAGENTD_MAPPING_HASH_SECONDS"):
+    try:
+        MAPPING_HASH_SECONDS = float(os.environ.get("PDAGENTD_MAPPING_HASH_SECONDS"))
+    except:
+        pass
+
+# how long to wait before looking for a mapping table again when its collection doesn't exist
+MAPPING_MISSING_SECONDS = 30
+if os.environ.get("PDAGENTD_MAPPING_MISSING_SECONDS"):
+    try:
+        MAPPING_MISSING_SECONDS = float(os.environ.get("PDAGENTD_MAPPING_MISSING_SECONDS"))
+    except:
+        pass
+
+CASE_INSENSITIVE = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+
+def copy_row(row):
+    """A copy of a row that's safe to put in an event, since events are changed in place by later filters"""
+    if any(isinstance(v, (dict, list)) for v in row.values()):
+        return copy.deepcopy(row)
+    return dict(row)
+
+
+class MappingTable:
+    """One mapping_<name> collection, as hash indexes on the query fields it's looked up by, or, if it has more
+    than max_rows rows, as a MappingStore file that all the worker processes map, with an LRU cache in front of
+    MongoDB for the lookups the store can't answer (or all of them, if there's no store directory).
+
+    An index is built for each combination of query fields (and case sensitivity) the first time it's
+    used, so that lookups cost one dict lookup whichever optional query fields an event has.
+
+    Args:
+        fields (iterable, optional): the query fields the table is looked up by, for the store to index
+    """
+
+    def __init__(self, collection, max_rows=MAPPING_TABLE_MAX_ROWS, cache_size=MAPPING_CACHE_SIZE, fields=()):
+        self.collection = collection
+        self.name = collection.name
+        self.max_rows = max_rows
+        self.cache_size = cache_size
+        self.rows = None
+        self.indexes = {}
+        self.store = None
+        self.fields = set(fields)
+        self.building = False
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.signature = None
+        self.checked_at = 0
+        self.refreshing = False
+        self.counts = {'lookups': 0, 'hits': 0, 'store_lookups': 0, 'mongo_lookups': 0, 'reloads': 0}
+
+    def load(self):
+        """Load the rows from MongoDB if there aren't too many, swapping them in all at once. A bigger table keeps
+        its current store (if any) until an up to date one has been built in the background."""
+        signature = self.fetch_signature()
+        count = self.collection.estimated_document_count()
+        store = None
+        if count > self.max_rows:
+            (rows, mode) = (None, "mongo")
+            if mapping_store.MAPPING_STORE_DIR and self.fields:
+                store_signature = self.store_signature(signature, count)
+                store = mapping_store.open_store(self.name, store_signature, self.fields)
+                if store is None:
+                    self.build_store(store_signature)
+                else:
+                    mode = "store"
+        else:
+            (rows, mode) = (list(self.collection.find({}, {"_id": 0})), "memory")
+        with self.lock:
+            (self.rows, self.indexes, self.cache, self.signature) = (rows, {}, OrderedDict(), signature)
+            if rows is not None or store is not None:
+                self.store = store
+        self.checked_at = time.monotonic()
+        self.counts['reloads'] += 1
+        logger.info(f"Loaded mapping table {self.name}: {count} rows, looked up in {mode}")
+
+    def fetch_signature(self):
+        """A signature of the collection's contents: its size and newest _id, which change whenever rows are added,
+        removed or replaced, and for rows that were changed in place, its newest MAPPING_UPDATED_FIELD if that's
+        indexed, or else its hash as of the last time it was hashed (every MAPPING_HASH_SECONDS). One process on
+        the host checks it at a time and shares the result with the others in a file in SHARED_DIR, so MongoDB gets
+        one check per host per MAPPING_REFRESH_SECONDS rather than one per worker process.
+
+        Returns:
+            str: the signature, or None if it couldn't be fetched (then the table is always reloaded)
+        """
+        try:
+            try:
+                return self.shared_check()["signature"]
+            except OSError as e:
+                logger.debug(f"Couldn't share the check of mapping table {self.name}: {e}")
+                return self.check({})["signature"]
+        except Exception as e:
+            logger.error(f"Couldn't check mapping table {self.name} for changes: {e}")
+            return None
+
+    def shared_check(self):
+        """The last check of the collection by any process on the host, checking it again if that's more than half
+        of MAPPING_REFRESH_SECONDS old. The other processes wait on the file's lock while it's checked, and then
+        use this check rather than making their own."""
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        with open(os.path.join(SHARED_DIR, f"{self.name}.signature"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                last = json.loads(f.read())
+            except ValueError:
+                last = {}
+            if time.time() - last.get("checked_at", 0) < MAPPING_REFRESH_SECONDS / 2 and "signature" in last:
+                return last
+            check = self.check(last)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(check))
+            return check
+
+    def check(self, last):
+        """Check the collection's size, newest _id and newest MAPPING_UPDATED_FIELD, and its hash if it's time to
+
+        Args:
+            last (dict): the previous check, for its hash
+
+        Returns:
+            dict: the check, with the signature, when it was made, and the hash and when it was made
+        """
+        now = time.time()
+        count = self.collection.estimated_document_count()
+        newest = self.collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        updated = self.newest_update()
+        (digest, hashed_at) = (last.get("hash"), last.get("hashed_at", 0))
+        if updated is not None:
+            (digest, hashed_at) = (None, 0)
+        elif MAPPING_HASH_SECONDS > 0 and now - hashed_at >= MAPPING_HASH_SECONDS:
+            try:
+                digest = self.collection.database.command("dbHash", collections=[self.name])["collections"].get(self.name)
+            except Exception:
+                digest = None
+            hashed_at = now
+        signature = f"{count}:{newest['_id'] if newest else None}:{updated}:{digest}"
+        return {"signature": signature, "checked_at": now, "hash": digest, "hashed_at": hashed_at}
+
+    def newest_update(self):
+        """The newest value of MAPPING_UPDATED_FIELD, if the collection has an index that starts with it (without
+        one, finding it would read the whole collection, like dbHash does)
+
+        Returns:
+            str: the value, or None if the field isn't indexed or no row has it
+        """
+        if not MAPPING_UPDATED_FIELD:
+            return None
+        indexes = self.collection.index_information().values()
+        if not any(index["key"][0][0] == MAPPING_UPDATED_FIELD for index in indexes):
+            return None
+        row = self.collection.find_one({MAPPING_UPDATED_FIELD: {"$exists": True}}, {MAPPING_UPDATED_FIELD: 1},
+                                       sort=[(MAPPING_UPDATED_FIELD, -1)])
+        return str(row[MAPPING_UPDATED_FIELD]) if row else None
+
+    def store_signature(self, signature, count):
+        """The signature for the store file: the collection's signature, or if there isn't one, its size and newest _id"""
+        if signature is not None:
+            return signature
+        newest = self.collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        return f"{count}:{newest['_id'] if newest else None}"
+
+    def build_store(self, signature):
+        """Build (or wait for another process to build) the store file in a background thread, then swap it in"""
+        if self.building:
+            return
+        self.building = True
+        threading.Thread(target=self.run_build_store, args=(signature,), name=f"mapping-store-{self.name}", daemon=True).start()
+
+    def run_build_store(self, signature):
+        try:
+            store = mapping_store.open_store(self.name, signature, set(self.fields), rows=lambda: self.collection.find({}, {"_id": 0}))
+            with self.lock:
+                if self.rows is None:
+                    (self.store, self.cache) = (store, OrderedDict())
+        except Exception as e:
+            logger.error(f"Couldn't build the mapping store for {self.name}: {e}")
+        finally:
+            self.building = False
+
+    def store_find_one(self, store, query, case_insensitive):
+        """Look a query up in the store, remapping the file first if another process has rebuilt it
+
+        Returns:
+            dict: the row, None if there isn't one, or NotImplemented if the store doesn't index the query's fields
+        """
+        if store.replaced():
+            try:
+                store = mapping_store.MappingStore(store.path)
+                with self.lock:
+                    if self.store is not None:
+                        self.store = store
+            except (OSError, ValueError, EOFError) as e:
+                logger.error(f"Couldn't map the mapping store for {self.name}: {e}")
+        row = store.find_one(query, case_insensitive)
+        if row is NotImplemented:
+            if not set(query) <= self.fields:
+                self.fields.update(query)
+                self.build_store(store.signature)
+        else:
+            self.counts['store_lookups'] += 1
+        return row
+
+    def maybe_refresh(self):
+        """Reload the table in a background thread if it's time to check it and it has changed"""
+        if self.refreshing or time.monotonic() - self.checked_at < MAPPING_REFRESH_SECONDS:
+            return
+        self.refreshing = True
+        threading.Thread(target=self.refresh, name=f"mapping-refresh-{self.name}", daemon=True).start()
+
+    def refresh(self):
+        try:
+            signature = self.fetch_signature()
+            if signature is None or signature != self.signature:
+                self.load()
+            else:
+                self.checked_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"Couldn't refresh mapping table {self.name}: {e}")
+            self.checked_at = time.monotonic()
+        finally:
+            self.refreshing = False
+
+    def index(self, fields, case_insensitive):
+        key = (fields, case_insensitive)
+        index = self.indexes.get(key)
+        if index is None:
+            with self.lock:
+                (rows, index) = (self.rows, {})
+                for row in rows:
+                    parts = [index_values(row.get(f), case_insensitive) if f in row else [] for f in fields]
+                    keys = [()]
+                    for values in parts:
+                        keys = [k + (v,) for k in keys for v in values]
+                    for k in keys:
+                        # find_one returns the first row that matches
+                        index.setdefault(k, row)
+                if self.rows is rows:
+                    self.indexes[key] = index
+        return index
+
+    def find_one(self, query, case_insensitive=False):
+        """Find the first row whose fields equal the values in query, like collection.find_one(query)
+
+        Args:
+            query (dict): field names and values
+            case_insensitive (bool): whether string values match regardless of case
+
+        Returns:
+            dict: a copy of the row without its _id, or None if there isn't one
+        """
+        self.counts['lookups'] += 1
+        self.maybe_refresh()
+        fields = tuple(sorted(query.keys()))
+        try:
+            values = tuple(index_value(query[f]) for f in fields)
+        except TypeError:
+            values = None
+        if case_insensitive and values is not None:
+            values = tuple(v.lower() if isinstance(v, str) else v for v in values)
+
+        (row, store) = (NotImplemented, self.store)
+        if self.rows is not None and values is not None:
+            row = self.index(fields, case_insensitive).get(values)
+        elif store is not None and values is not None:
+            row = self.store_find_one(store, query, case_insensitive)
+            if row is not None and row is not NotImplemented:
+                # decoded from the file, so it's already a copy
+                self.counts['hits'] += 1
+                return row
+        if row is NotImplemented:
+            cache_key = (fields, values, case_insensitive) if values is not None else None
+            with self.lock:
+                cached = cache_key is not None and cache_key in self.cache
+                if cached:
+                    self.cache.move_to_end(cache_key)
+                    row = self.cache[cache_key]
+            if not cached:
+                self.counts['mongo_lookups'] += 1
+                row = self.collection.find_one(query, {"_id": 0}, collation=CASE_INSENSITIVE if case_insensitive else None)
+                if not cached and self.rows is None and self.store is None and mapping_store.MAPPING_STORE_DIR and values is not None \
+                        and not set(query) <= self.fields:
+                    # a big table that has been looked up before its query fields were known
+                    self.fields.update(query)
+                    self.build_store(self.store_signature(self.signature, self.collection.estimated_document_count()))
+                if cache_key is not None and self.cache_size > 0:
+                    with self.lock:
+                        self.cache[cache_key] = row
+                        while len(self.cache) > self.cache_size:
+                            self.cache.popitem(last=False)
+        if row is None:
+            return None
+        self.counts['hits'] += 1
+        return copy_row(row)
+
+    def stats(self):
+        store = self.store
+        return dict(
+            self.counts,
+            mode="memory" if self.rows is not None else "store" if store is not None else "mongo",
+            rows=len(self.rows) if self.rows is not None else store.rows if store is not None else None,
+            indexes=len(self.indexes) if self.rows is not None else sorted(store.indexes) if store is not None else 0,
+            store_bytes=store.size if store is not None else None,
+            building=self.building,
+            cached=len(self.cache),
+        )
+
+
+class MappingTables:
+    """The mapping tables of one database, loaded the first time they're used (or by preload)"""
+
+    def __init__(self, db, max_rows=MAPPING_TABLE_MAX_ROWS, cache_size=MAPPING_CACHE_SIZE):
+        self.db = db
+        self.max_rows = max_rows
+        self.cache_size = cache_size
+        self.tables = {}
+        self.missing = {}
+        self.lock = threading.Lock()
+
+    def table(self, name, fields=()):
+        """Get the mapping table for mapping_<name>, loading it if needed
+
+        Args:
+            fields (iterable, optional): the query fields the table is looked up by, if it's being loaded
+
+        Returns:
+            MappingTable: the table, or None if there's no such collection
+        """
+        table = self.tables.get(name)
+        if table is not None:
+            return table
+        missing_since = self.missing.get(name)
+        if missing_since is not None and time.monotonic() - missing_since < MAPPING_MISSING_SECONDS:
+            return None
+        with self.lock:
+            table = self.tables.get(name)
+            if table is None:
+                collection_name = "mapping_" + name
+                if collection_name not in self.db.list_collection_names(filter={"name": collection_name}):
+                    self.missing[name] = time.monotonic()
+                    return None
+                table = MappingTable(self.db[collection_name], self.max_rows, self.cache_size, fields)
+                table.load()
+                self.tables[name] = table
+                self.missing.pop(name, None)
+        return table
+
+    def preload(self, tables):
+        """Load tables now, so that events don't wait for them
+
+        Args:
+            tables (dict): table names and the query fields each is looked up by
+        """
+        for (name, fields) in tables.items():
+            try:
+                self.table(name, fields)
+            except Exception as e:
+                logger.error(f"Couldn't load mapping table {name}: {e}")
+
+    def stats(self):
+        return {name: table.stats() for (name, table) in list(self.tables.items())}
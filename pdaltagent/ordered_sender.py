@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Ordered delivery mode for the pd_events queues.
+
+When PDAGENTD_ORDERED_PARTITIONS is set, send_to_pd messages are routed by routing key and dedup key
+into the queues pd_events.0 ... pd_events.N-1 (see route_event in pdaltagent.config), so all the events
+for one alert are in the same queue in the order they were enqueued. This consumer delivers each of
+those queues strictly one message at a time, on its own connection with prefetch 1, so a resolve can
+never overtake the trigger it belongs to, while events for unrelated keys are delivered in parallel
+on the other partitions.
+
+Rate limit deferrals and 429 retries wait in place instead of being requeued at the back of the
+queue, so they hold up only the partition that they're in.
+
+Run it instead of the events Celery worker (the listener and this consumer must both have the same
+PDAGENTD_ORDERED_PARTITIONS):
+
+    python3 -m pdaltagent.ordered_sender
+"""
+
+import os
+import time
+import json
+import logging
+import threading
+from requests import HTTPError
+
+import pdaltagent.pd as pd
+import pdaltagent.stats
+from pdaltagent.config import app, ORDERED_PARTITIONS, event_queue_names
+from pdaltagent.queue_consumer import QueueConsumer
+from pdaltagent.rate_limiter import rate_limiter
+from pdaltagent.coalescer import coalescer
+from pdaltagent.tasks import send_to_pd, filter_event, rate_limited_countdown
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+
+class PartitionWorker:
+    """Delivers the messages of one queue in order. Only the message being delivered is ever unacked,
+    so the broker doesn't hand out the next one until this one is done."""
+
+    def __init__(self, sender, queue_name):
+        self.sender = sender
+        self.queue_name = queue_name
+        self.consumer = QueueConsumer(app, [queue_name], prefetch_count=1)
+        self.current = None
+
+    def on_message(self, task_message):
+        if task_message.name != send_to_pd.name:
+            logger.error(f"Rejecting unexpected task {task_message} in {self.queue_name} queue")
+            task_message.reject()
+            return
+        try:
+            args = task_message.bind(send_to_pd)
+        except TypeError as e:
+            logger.error(f"Rejecting task {task_message} with invalid arguments: {e}")
+            task_message.reject()
+            return
+        self.current = {
+            'task_message': task_message,
+            'args': args,
+            # deferred events come back already filtered
+            'filtered': (args['payload'], args['routing_key'], args['destination_type']) if args['filtered'] else None,
+            # whether the rate limiter has a token reserved for the next send
+            'rate_reserved': args['rate_reserved'],
+            'retries': task_message.retries,
+            'due': time.monotonic() + task_message.seconds_until_due(),
+        }
+
+    def timeout(self):
+        if self.current:
+            return self.current['due'] - time.monotonic()
+        return 1.0
+
+    def on_tick(self):
+        if self.current and time.monotonic() >= self.current['due']:
+            self.attempt()
+        self.sender.tick()
+
+    def on_reset(self):
+        # the broker will redeliver the message, in its place at the head of the queue
+        self.current = None
+
+    def done(self, count):
+        self.sender.count(count)
+        self.current['task_message'].ack()
+        self.current = None
+
+    def fail(self, exc):
+        args = self.current['args']
+        logger.warning(f"Failed to send {args['payload']!r} to {args['routing_key']}: {exc}")
+        self.done('failed')
+
+    def wait(self, delay):
+        self.current['due'] = time.monotonic() + delay
+
+    def attempt(self):
+        (task_message, args) = (self.current['task_message'], self.current['args'])
+        if self.current['filtered'] is None:
+            if coalescer.superseded(args['routing_key'], args['payload'], args['destination_type'], args['seq']):
+                self.done('coalesced')
+                return
+            try:
+                r = self.sender.filter(args)
+            except Exception as e:
+                self.fail(e)
+                return
+            if r is None:
+                logger.info(f"Task {task_message} succeeded: {('event suppressed', json.dumps(args['payload']))}")
+                self.done('suppressed')
+                return
+            self.current['filtered'] = r
+        (_payload, _routing_key, _destination_type) = self.current['filtered']
+        delay = rate_limiter.acquire(_routing_key, _destination_type, reserved=self.current['rate_reserved'])
+        if delay > 0:
+            logger.debug(f"Task {task_message} waiting {round(delay, 2)}s for rate limit")
+            self.sender.count('deferred')
+            self.current['rate_reserved'] = True
+            self.wait(delay)
+            return
+        # a retry after a 429 is another send, which needs a token of its own
+        self.current['rate_reserved'] = False
+        try:
+            r = pd.send_event(_routing_key, _payload, args['base_url'], _destination_type)
+        except HTTPError as e:
+            if e.response is not None and e.response.status_code == 429:
+                countdown = rate_limited_countdown(self.current['retries'], _routing_key, _destination_type, e.response.headers.get('Retry-After'))
+                logger.info(f"Task {task_message} retry: Retry in {countdown}s: {e}")
+                self.sender.count('retried')
+                self.current['retries'] += 1
+                self.wait(countdown)
+            else:
+                self.fail(e)
+            return
+        except Exception as e:
+            self.fail(e)
+            return
+        logger.info(f"Task {task_message} succeeded: {(_routing_key, r)}")
+        self.done('sent')
+
+    def run(self):
+        self.consumer.run(self.on_message, self.on_tick, self.timeout, self.on_reset)
+
+
+class OrderedSender:
+    def __init__(self, queue_names=None):
+        # pd_events is included so that nothing gets stranded there when switching to ordered mode
+        self.workers = [PartitionWorker(self, name) for name in (queue_names or event_queue_names())]
+        # plugins weren't written to be called from more than one thread at a time
+        self.filter_lock = threading.Lock()
+        self.counts_lock = threading.Lock()
+        self.counts = {'sent': 0, 'suppressed': 0, 'coalesced': 0, 'deferred': 0, 'retried': 0, 'failed': 0}
+        pdaltagent.stats.register('ordered_sender', lambda: dict(self.counts, partitions=len(self.workers)))
+
+        events_session = pd.sessions['events']
+        events_session.pool_size = max(events_session.pool_size, len(self.workers))
+
+    def filter(self, args):
+        with self.filter_lock:
+            return filter_event(args['routing_key'], args['payload'], args['destination_type'])
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def tick(self):
+        with self.counts_lock:
+            pdaltagent.stats.maybe_dump()
+
+    def run(self):
+        if ORDERED_PARTITIONS <= 0:
+            logger.warning("PDAGENTD_ORDERED_PARTITIONS is not set, so events are not partitioned and will only be delivered from pd_events")
+        logger.info(f"Ordered sender starting with {len(self.workers)} queues")
+        threads = [
+            threading.Thread(target=worker.run, name=f"ordered_sender_{worker.queue_name}", daemon=True)
+            for worker in self.workers
+        ]
+        for thread in threads:
+            thread.start()
+        while all(thread.is_alive() for thread in threads):
+            time.sleep(1)
+
+
+def main():
+    OrderedSender().run()
+
+
+if __name__ == '__main__':
+    main()
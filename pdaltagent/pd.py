@@ -1,9 +1,13 @@
 import re
 import os
 import json
+import time
 import urllib
 import requests
 import datetime
+import threading
+from requests.adapters import HTTPAdapter
+import pdaltagent.stats
 
 # Uncomment the section below for low-level HTTPS debugging
 # import logging
@@ -19,6 +23,123 @@ BASE_URL = 'https://api.pagerduty.com'
 WEBHOOK_CONFIG_JSON = os.environ.get("PDAGENTD_WEBHOOK_CONFIG_JSON")
 WEBHOOK_SERVICES_LIST = os.environ.get("PDAGENTD_WEBHOOK_SERVICES_LIST")
 
+# max number of keep-alive connections kept per destination host in each worker process
+HTTP_POOL_SIZE = 10
+if os.environ.get("PDAGENTD_HTTP_POOL_SIZE"):
+    try:
+        HTTP_POOL_SIZE = int(os.environ.get("PDAGENTD_HTTP_POOL_SIZE"))
+    except:
+        pass
+
+# drop pooled connections that have been idle this long, because the server has probably closed them
+HTTP_POOL_IDLE_TIMEOUT_SECONDS = 60
+if os.environ.get("PDAGENTD_HTTP_POOL_IDLE_TIMEOUT_SECONDS"):
+    try:
+        HTTP_POOL_IDLE_TIMEOUT_SECONDS = float(os.environ.get("PDAGENTD_HTTP_POOL_IDLE_TIMEOUT_SECONDS"))
+    except:
+        pass
+
+class PooledSession:
+    """A requests session with keep-alive connection pools, for one kind of traffic (events, API...)
+
+    Proxies and the other environment settings are resolved once per destination host instead of
+    on every request, and the session is thrown away and recreated if it has been idle for longer
+    than idle_timeout or if the process has forked since it was created.
+    """
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, idle_timeout=HTTP_POOL_IDLE_TIMEOUT_SECONDS):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.session = None
+        self.pid = None
+        self.last_used = 0
+        self.settings = {}
+        self.retired_requests = 0
+        self.retired_connections = 0
+        self.recycles = 0
+
+    def _pool_counts(self):
+        requests_count = 0
+        connections_count = 0
+        if self.session:
+            for adapter in self.session.adapters.values():
+                for key in list(adapter.poolmanager.pools.keys()):
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool:
+                        requests_count += pool.num_requests
+                        connections_count += pool.num_connections
+        return (requests_count, connections_count)
+
+    def _new_session(self):
+        if self.session and self.pid == os.getpid():
+            (requests_count, connections_count) = self._pool_counts()
+            self.retired_requests += requests_count
+            self.retired_connections += connections_count
+            self.recycles += 1
+            self.session.close()
+        elif self.pid != os.getpid():
+            # forked: the parent's connections and counters aren't ours
+            self.retired_requests = self.retired_connections = self.recycles = 0
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size))
+        session.mount("http://", HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size))
+        if urllib.request.getproxies():
+            session.proxies.update(urllib.request.getproxies())
+        self.session = session
+        self.pid = os.getpid()
+        self.settings = {}
+
+    def get(self):
+        """Get the session, making a new one if needed"""
+        with self.lock:
+            now = time.monotonic()
+            if (self.session is None
+                    or self.pid != os.getpid()
+                    or (self.idle_timeout and now - self.last_used > self.idle_timeout)):
+                self._new_session()
+            self.last_used = now
+            return self.session
+
+    def send(self, req):
+        """Prepare and send a requests.Request, returning the response"""
+        session = self.get()
+        prepped = session.prepare_request(req)
+
+        # Merge environment settings once per scheme and host
+        parsed = urllib.parse.urlsplit(prepped.url)
+        settings_key = (parsed.scheme, parsed.netloc)
+        settings = self.settings.get(settings_key)
+        if settings is None:
+            settings = session.merge_environment_settings(prepped.url, {}, None, None, None)
+            self.settings[settings_key] = settings
+        return session.send(prepped, **settings)
+
+    def stats(self):
+        (requests_count, connections_count) = self._pool_counts() if self.pid == os.getpid() else (0, 0)
+        requests_count += self.retired_requests
+        connections_count += self.retired_connections
+        reused = max(requests_count - connections_count, 0)
+        return {
+            "requests": requests_count,
+            "connections": connections_count,
+            "handshakes_avoided": reused,
+            "reuse_rate": round(reused / requests_count, 4) if requests_count else 0.0,
+            "idle_recycles": self.recycles,
+            "pool_size": self.pool_size,
+        }
+
+sessions = {
+    "events": PooledSession(),
+    "api": PooledSession(),
+}
+
+def pool_stats():
+    """Connection reuse stats for the pooled sessions in this process"""
+    return {name: session.stats() for (name, session) in sessions.items()}
+
+pdaltagent.stats.register("http_pools", pool_stats)
+
 def auth_header_for_token(token):
     if re.search("^[0-9a-f]{64}$", token):
         return f"Bearer {token}"
@@ -53,17 +174,16 @@ def is_valid_v2_payload(payload):
         return False
     return True
 
-def send_event(routing_key, payload, base_url="https://events.pagerduty.com", destination_type="v2"):
-
-    session = requests.Session()                                                                     
-    if urllib.request.getproxies():                                                                  
-        session.proxies.update(urllib.request.getproxies())
-
-    url = f"{base_url}/v2/enqueue"
+def url_for_destination_type(routing_key, base_url="https://events.pagerduty.com", destination_type="v2"):
     if destination_type in ["x-ere", "routing", "ger"]:
-        url = f"{base_url}/x-ere/{routing_key}"
+        return f"{base_url}/x-ere/{routing_key}"
     elif destination_type in ["v1", "cet", "raw"]:
-        url = f"{base_url}/integration/{routing_key}/enqueue"
+        return f"{base_url}/integration/{routing_key}/enqueue"
+    return f"{base_url}/v2/enqueue"
+
+def send_event(routing_key, payload, base_url="https://events.pagerduty.com", destination_type="v2"):
+
+    url = url_for_destination_type(routing_key, base_url, destination_type)
 
     headers = {
         "Content-Type": "application/json"
@@ -75,11 +195,7 @@ def send_event(routing_key, payload, base_url="https://events.pagerduty.com", de
         json=payload
     )
 
-    prepped = session.prepare_request(req)
-
-    # Merge environment settings into session
-    settings = session.merge_environment_settings(prepped.url, {}, None, None, None)
-    response = session.send(prepped, **settings)
+    response = sessions["events"].send(req)
     response.raise_for_status()
 
     if len(response.content) > 0:
@@ -92,10 +208,6 @@ def request(token=None, endpoint=None, method="GET", params=None, data=None, add
     if not endpoint or not token:
         return None
 
-    session = requests.Session()                                                                     
-    if urllib.request.getproxies():                                                                  
-        session.proxies.update(urllib.request.getproxies())
-
     url = '/'.join([BASE_URL, endpoint])
     headers = {
         "Accept": "application/vnd.pagerduty+json;version=2",
@@ -116,11 +228,7 @@ def request(token=None, endpoint=None, method="GET", params=None, data=None, add
         json=data
     )
 
-    prepped = session.prepare_request(req)
-
-    # Merge environment settings into session
-    settings = session.merge_environment_settings(prepped.url, {}, None, None, None)
-    response = session.send(prepped, **settings)
+    response = sessions["api"].send(req)
     response.raise_for_status()
     if len(response.content) > 0:
         return response.json()
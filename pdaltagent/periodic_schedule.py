@@ -11,11 +11,14 @@ from croniter import croniter
 
 from celery.utils.log import get_task_logger
 from celery.schedules import crontab
+from celery.beat import PersistentScheduler
 
 from pdaltagent.periodic_tasks import run_fetch_events_method
 
 plugin_host = PluginHost(True if os.environ.get("PDAGENTD_DEBUG") else False)
 
+FETCH_EVENTS_ENTRY = "fetch_events from "
+
 logger = get_task_logger(__name__)
 if os.getenv('PDAGENTD_DEBUG'):
     logger.level = logging.DEBUG
@@ -25,11 +28,11 @@ def is_crontab_schedule(s):
         return False
     return croniter.is_valid(s)
 
-@app.on_after_finalize.connect
-def setup_periodic_tasks(sender, **kwargs):
-    logger.debug(f"initializing periodic scheduler")
-
-    for i, method in enumerate(plugin_host.methods['fetch_events']):
+def fetch_events_schedule():
+    """The beat schedule entries for the plugins' fetch_events methods, by name"""
+    schedule = {}
+    for i, method in enumerate(plugin_host.get_methods('fetch_events')):
+        modname = inspect.getmodule(method['method']).__name__
         if is_crontab_schedule(method.get('fetch_interval')):
             try:
                 (minute, hour, day_of_month, month_of_year, day_of_week) = re.split(r'\s+', method['fetch_interval'])
@@ -41,12 +44,24 @@ def setup_periodic_tasks(sender, **kwargs):
                     day_of_week=day_of_week
                 )
             except Exception as e:
-                logger.error(f"Module {inspect.getmodule(method['method']).__name__} has invalid cron schedule '{method['fetch_interval']}' - skipped")
+                logger.error(f"Module {modname} has invalid cron schedule '{method['fetch_interval']}' - skipped")
                 continue
         else:
             fetch_interval = float(method.get('fetch_interval', POLLING_INTERVAL_SECONDS))
-        logger.info(f"Adding fetch_events task from module {inspect.getmodule(method['method']).__name__} at interval {fetch_interval}")
-        sender.add_periodic_task(fetch_interval, run_fetch_events_method.s(i))
+        logger.info(f"Adding fetch_events task from module {modname} at interval {fetch_interval}")
+        schedule[FETCH_EVENTS_ENTRY + modname] = {
+            'task': run_fetch_events_method.name,
+            'schedule': fetch_interval,
+            'args': (i, modname),
+        }
+    return schedule
+
+@app.on_after_finalize.connect
+def setup_periodic_tasks(sender, **kwargs):
+    logger.debug(f"initializing periodic scheduler")
+
+    for (name, entry) in fetch_events_schedule().items():
+        sender.add_periodic_task(entry['schedule'], run_fetch_events_method.s(*entry['args']), name=name)
 
     if not PD_API_TOKEN:
         logger.warning(f"Can't get log entries because no token is set. Please set PDAGENTD_API_TOKEN environment variable if you want to poll PD log entries")
@@ -58,3 +73,33 @@ def setup_periodic_tasks(sender, **kwargs):
         log_entries_coll.create_index("created_at", expireAfterSeconds=KEEP_ACTIVITY_SECONDS)
         sender.add_periodic_task(float(POLLING_INTERVAL_SECONDS), poll_pd_log_entries.s())
 
+class PluginScheduler(PersistentScheduler):
+    """The beat scheduler, with the fetch_events entries brought up to date when the plugins are reloaded"""
+
+    def __init__(self, *args, **kwargs):
+        self.plugins_generation = plugin_host.generation
+        super().__init__(*args, **kwargs)
+
+    def tick(self, *args, **kwargs):
+        if self.plugins_generation != plugin_host.generation:
+            self.plugins_generation = plugin_host.generation
+            self.update_fetch_events()
+        return super().tick(*args, **kwargs)
+
+    def update_fetch_events(self):
+        schedule = fetch_events_schedule()
+        for name in [x for x in self.schedule.keys() if x.startswith(FETCH_EVENTS_ENTRY) and x not in schedule]:
+            logger.info(f"Removing {name} task")
+            del self.schedule[name]
+        for (name, entry) in schedule.items():
+            # entries that didn't change keep their last run time
+            new_entry = self.Entry(**dict(entry, name=name, app=self.app))
+            old_entry = self.schedule.get(name)
+            if old_entry is None or old_entry.args != new_entry.args or old_entry.schedule != new_entry.schedule:
+                self.schedule[name] = new_entry
+        self.app.conf.beat_schedule = dict(
+            {x: y for (x, y) in self.app.conf.beat_schedule.items() if not x.startswith(FETCH_EVENTS_ENTRY)},
+            **schedule
+        )
+
+app.conf.beat_scheduler = PluginScheduler
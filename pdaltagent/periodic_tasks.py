@@ -4,7 +4,7 @@ import datetime
 import inspect
 from func_timeout import func_timeout, FunctionTimedOut
 import pdaltagent.pd as pd
-from pdaltagent.plugin_host import PluginHost
+from pdaltagent.plugin_host import PluginHost, run_async
 from pdaltagent.config import app
 from pdaltagent.config import MONGODB_URL, PD_API_TOKEN, WEBHOOK_DEST_URL, IS_OVERVIEW, POLLING_INTERVAL_SECONDS
 from celery import chain
@@ -22,24 +22,37 @@ if os.getenv('PDAGENTD_DEBUG'):
 plugin_host = PluginHost(True if os.environ.get("PDAGENTD_DEBUG") else False)
 
 @app.task()
-def run_fetch_events_method(method_index):
-    method = plugin_host.methods['fetch_events'][method_index]['method']
+def run_fetch_events_method(method_index, modname=None):
+    fetch_methods = plugin_host.get_methods('fetch_events')
+    if modname is not None:
+        # look the method up by module, since beat and this worker may have reloaded the plugins at different times
+        fetch_methods = [x for x in fetch_methods if PluginHost.methodname(x) == modname]
+        if not fetch_methods:
+            logger.warning(f"fetch_events task from module {modname} isn't loaded, skipped")
+            return
+        method_index = 0
+    fetch_method = fetch_methods[method_index]
+    method = fetch_method['method']
     try:
-        timeout = float(plugin_host.methods['fetch_events'][method_index].get('fetch_interval', POLLING_INTERVAL_SECONDS))
+        timeout = float(fetch_method.get('fetch_interval', POLLING_INTERVAL_SECONDS))
     except:
-        if not croniter.is_valid(plugin_host.methods['fetch_events'][method_index].get('fetch_interval')):
+        if not croniter.is_valid(fetch_method.get('fetch_interval')):
             logger.error(f"fetch_events task from module {inspect.getmodule(method).__name__} has an invalid fetch_interval!")
             return
         now = datetime.datetime.now()
-        c = croniter(plugin_host.methods['fetch_events'][method_index].get('fetch_interval'), now)
+        c = croniter(fetch_method.get('fetch_interval'), now)
         t1 = c.next()
         t2 = c.next()
         timeout = t2 - t1
 
     logger.info(f"Running fetch_events task from module {inspect.getmodule(method).__name__} with timeout {timeout}")
     try:
-        events = func_timeout(timeout, method)
-    except FunctionTimedOut:
+        if inspect.iscoroutinefunction(method):
+            # async fetches are cancelled on time instead of leaving a thread behind
+            events = run_async(method(), timeout)
+        else:
+            events = func_timeout(timeout, method)
+    except (FunctionTimedOut, TimeoutError):
         logger.warning(f"fetch_events task from module {inspect.getmodule(method).__name__} timed out after {timeout} seconds!")
         return
 
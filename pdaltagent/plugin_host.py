@@ -7,12 +7,630 @@ import inspect
 import logging
 import sys
 import os
+import copy
+import math
+import time
+import pickle
+import marshal
+import resource
+import asyncio
+import threading
+import itertools
+import contextvars
 import validators
 from pathlib import Path
+from multiprocessing.connection import Client
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pdaltagent.config import PLUGIN_TIMEOUT_SECONDS, PLUGIN_THREADED, PLUGIN_BREAKER_FAILURES, PLUGIN_BREAKER_RESET_SECONDS, PLUGIN_PROCESSES, PLUGIN_WATCH_SECONDS, PLUGIN_POOL
+from pdaltagent.shared_table import SHARED_DIR
 
 from celery.app.defaults import DEFAULT_PROCESS_LOG_FMT
 from celery.utils.log import get_task_logger
 
+# returned by run_batch for an item whose filter raised, to leave it as it was
+UNCHANGED = object()
+
+# the batch method that a plugin can implement instead of (or as well as) each filter method
+BATCH_METHODS = {
+  'filter_event': 'filter_events',
+  'filter_webhook': 'filter_webhooks',
+}
+
+
+plugin_loop = None
+plugin_loop_pid = None
+plugin_loop_lock = threading.Lock()
+
+
+def get_plugin_loop():
+  """Get this process's event loop for running async plugin methods from synchronous code, starting it if needed"""
+  global plugin_loop, plugin_loop_pid
+  if plugin_loop_pid != os.getpid():
+    with plugin_loop_lock:
+      if plugin_loop_pid != os.getpid():
+        # worker processes are forked, and a loop thread doesn't survive the fork
+        plugin_loop = asyncio.new_event_loop()
+        threading.Thread(target=plugin_loop.run_forever, name='plugin_loop', daemon=True).start()
+        plugin_loop_pid = os.getpid()
+  return plugin_loop
+
+
+async def with_timeout(coro, timeout):
+  """Await a coroutine, cancelling it if it takes more than timeout seconds"""
+  if not timeout:
+    return await coro
+  try:
+    return await asyncio.wait_for(coro, timeout)
+  except asyncio.TimeoutError:
+    raise TimeoutError(f"timed out after {timeout} seconds") from None
+
+
+def run_async(coro, timeout=None):
+  """Run a coroutine from an async plugin method on the plugin event loop and wait for its result
+
+  Raises:
+      TimeoutError: if it took more than timeout seconds, in which case it was cancelled
+  """
+  loop = get_plugin_loop()
+  try:
+    running = asyncio.get_running_loop()
+  except RuntimeError:
+    running = None
+  if running is loop:
+    coro.close()
+    raise RuntimeError("Can't wait for an async plugin method from the plugin event loop")
+  return asyncio.run_coroutine_threadsafe(with_timeout(coro, timeout), loop).result()
+
+
+# most synchronous plugin calls that can be running in a process at once
+PLUGIN_THREADS = 32
+
+# most threads a process leaves stuck in plugin calls it gave up on. Past that, the pool of plugin threads
+# isn't replaced any more, so new calls queue behind the stuck ones and time out rather than start more
+PLUGIN_MAX_HUNG_THREADS = 4 * PLUGIN_THREADS
+
+plugin_executor = None
+plugin_executor_pid = None
+# plugin calls that were given up on but are still running in this process
+hung_threads = 0
+
+
+class GivenUp(TimeoutError):
+  """A plugin call that timed out and was left running in its thread. It still has the arguments it was given,
+  and may go on changing them, so the caller goes on with copies of them instead
+
+  Attributes:
+      copies (tuple): deep copies of the call's arguments, as they were when it was given up on
+  """
+
+  def __init__(self, message, copies):
+    super().__init__(message)
+    self.copies = copies
+
+
+def copy_args(args):
+  """Deep copy the arguments of a call that's still running in another thread, which may be changing them"""
+  for _ in range(9):
+    try:
+      return copy.deepcopy(args)
+    except RuntimeError:
+      # a dict or set changed size while it was being copied
+      pass
+  return copy.deepcopy(args)
+
+
+class PluginExecutor(ThreadPoolExecutor):
+  """A pool of plugin threads, counting the threads in it that are stuck in calls that were given up on"""
+
+  def __init__(self):
+    super().__init__(max_workers=PLUGIN_THREADS, thread_name_prefix='plugin')
+    self.hung = 0
+
+
+def get_plugin_executor():
+  """Get this process's pool of plugin threads, starting it if needed"""
+  global plugin_executor, plugin_executor_pid, hung_threads
+  if plugin_executor_pid != os.getpid():
+    with plugin_loop_lock:
+      if plugin_executor_pid != os.getpid():
+        plugin_executor = PluginExecutor()
+        plugin_executor_pid = os.getpid()
+        hung_threads = 0
+  return plugin_executor
+
+
+def give_up(executor, future, args, timeout, hung=None):
+  """Leave a plugin call that timed out to finish in the background, if it started. Once half the threads of
+  the pool are stuck in calls like that, new calls go to a new pool instead of waiting behind them, until
+  the process has PLUGIN_MAX_HUNG_THREADS stuck threads
+
+  Args:
+      args (tuple): the call's arguments
+      hung (function, optional): called with the future of the call if it's left running
+
+  Returns:
+      TimeoutError: the error to raise for the call, a GivenUp with copies of the arguments if it's left running
+  """
+  global plugin_executor, hung_threads
+  if future.cancel():
+    # it was still waiting for a thread
+    return TimeoutError(f"timed out after {timeout} seconds waiting for a plugin thread")
+  with plugin_loop_lock:
+    executor.hung += 1
+    hung_threads += 1
+    replace = executor is plugin_executor and executor.hung >= PLUGIN_THREADS // 2 and hung_threads < PLUGIN_MAX_HUNG_THREADS
+    if replace:
+      plugin_executor = PluginExecutor()
+    total = hung_threads
+  future.add_done_callback(lambda f: finish_hung(executor))
+  if hung is not None:
+    hung(future)
+  if replace:
+    get_task_logger(__name__).warning(f"{executor.hung} plugin threads are stuck in calls that timed out, starting new ones")
+    executor.shutdown(wait=False)
+  elif total == PLUGIN_MAX_HUNG_THREADS:
+    get_task_logger(__name__).error(f"{total} plugin threads are stuck in calls that timed out, not starting any more")
+  return GivenUp(f"timed out after {timeout} seconds", copy_args(args))
+
+
+def finish_hung(executor):
+  global hung_threads
+  with plugin_loop_lock:
+    executor.hung -= 1
+    hung_threads -= 1
+
+
+def run_in_thread(fn, args, timeout, hung=None):
+  """Call a synchronous plugin method in a plugin thread and wait at most timeout seconds for it. A thread
+  can't be stopped, so a method that times out is left to finish in the background with the arguments it
+  was given, and the caller gets copies of them to go on with (the method is given the originals, so
+  that calls that don't time out cost no copies)
+
+  Args:
+      hung (function, optional): called with the future of the call if it times out and is left running
+
+  Raises:
+      GivenUp: if it took more than timeout seconds and is still running
+      TimeoutError: if it took more than timeout seconds to get a thread
+  """
+  executor = get_plugin_executor()
+  # run in a copy of the caller's context, so things like the regex guard's event budget carry over
+  future = executor.submit(contextvars.copy_context().run, fn, *args)
+  try:
+    return future.result(timeout)
+  except TimeoutError:
+    raise give_up(executor, future, args, timeout, hung) from None
+
+
+async def run_in_thread_async(fn, args, timeout, hung=None):
+  """run_in_thread for callers running on an event loop, which go on with other work while they wait"""
+  executor = get_plugin_executor()
+  future = executor.submit(contextvars.copy_context().run, fn, *args)
+  wrapped = asyncio.wrap_future(future)
+  try:
+    # shielded, so that it's give_up that decides whether to cancel it
+    return await asyncio.wait_for(asyncio.shield(wrapped), timeout)
+  except asyncio.TimeoutError:
+    # nobody waits for its result any more, so don't let asyncio complain that nobody saw its error
+    wrapped.add_done_callback(lambda f: f.cancelled() or f.exception())
+    raise give_up(executor, future, args, timeout, hung) from None
+
+
+async def run_in_plugin_thread(fn, *args):
+  """Call a synchronous plugin method from an event loop in a plugin thread, so that it doesn't hold up
+  everything else on the loop, and wait for it however long it takes"""
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(get_plugin_executor(), contextvars.copy_context().run, fn, *args)
+
+
+def encode(value):
+  """Serialize arguments or results for the plugin process pool: with marshal, which is compact and fast for the
+  dicts, lists and strings that events are made of, or with pickle for anything marshal can't handle"""
+  try:
+    return b"m" + marshal.dumps(value)
+  except ValueError:
+    return b"p" + pickle.dumps(value)
+
+
+def decode(data):
+  return marshal.loads(data[1:]) if data[:1] == b"m" else pickle.loads(data[1:])
+
+
+# modules of the cpu_bound plugins, for the plugin pool to load before the first events need them
+cpu_modnames = set()
+
+# in the plugin pool's processes, the Plugin instance of each cpu_bound module
+cpu_plugins = {}
+
+# the socket of the plugin pool (see pdaltagent.plugin_pool), which runs the cpu_bound plugins for all the
+# worker processes on the host
+PLUGIN_POOL_SOCKET = os.environ.get("PDAGENTD_PLUGIN_POOL_SOCKET") or os.path.join(SHARED_DIR, "plugin_pool.sock")
+
+# how long a process that can't reach the plugin pool runs cpu_bound plugins itself before trying again
+PLUGIN_POOL_RETRY_SECONDS = 30
+
+pool_client = None
+pool_client_pid = None
+pool_retry_at = 0
+
+
+class PoolClient:
+  """A connection to the plugin pool, shared by the threads of a process. Calls are sent as they're made and
+  their results come back in any order, so a batch of calls can be running in the pool at once
+
+  Args:
+      address (str): the plugin pool's socket
+
+  Raises:
+      OSError: if the plugin pool can't be reached
+  """
+
+  def __init__(self, address):
+    self.conn = Client(address, family='AF_UNIX')
+    self.ids = itertools.count()
+    self.futures = {}
+    self.closed = False
+    self.lock = threading.Lock()
+    # the receiving thread takes self.lock, so a send that's waiting on a full socket mustn't hold it
+    self.send_lock = threading.Lock()
+    threading.Thread(target=self.receive, name='plugin-pool-client', daemon=True).start()
+
+  def request(self, kind, *args):
+    """Send a request to the plugin pool
+
+    Returns:
+        Future: its result
+
+    Raises:
+        ConnectionError: if the connection has been lost
+    """
+    future = Future()
+    with self.lock:
+      if self.closed:
+        raise ConnectionError("the connection to the plugin pool was lost")
+      request_id = next(self.ids)
+      self.futures[request_id] = future
+    try:
+      with self.send_lock:
+        self.conn.send((request_id, kind, args))
+    except (OSError, ValueError) as e:
+      self.close(e)
+      raise ConnectionError(f"the connection to the plugin pool was lost: {e}") from None
+    return future
+
+  def receive(self):
+    try:
+      while True:
+        (request_id, ok, value) = self.conn.recv()
+        with self.lock:
+          future = self.futures.pop(request_id, None)
+        if future is None:
+          continue
+        if ok:
+          future.set_result(value)
+        else:
+          future.set_exception(value)
+    except (EOFError, OSError) as e:
+      self.close(e)
+    except TypeError as e:
+      # the connection was closed by another thread while this one was waiting on it
+      if not self.closed:
+        self.close(e)
+
+  def close(self, e=None):
+    """Fail the calls that are waiting on a connection that was lost, so that the next calls connect again"""
+    with self.lock:
+      if self.closed:
+        return
+      self.closed = True
+      (futures, self.futures) = (self.futures, {})
+    get_task_logger(__name__).warning(f"Lost the connection to the plugin pool: {(str(e) or type(e).__name__) if e else 'closed'}")
+    try:
+      self.conn.close()
+    except OSError:
+      pass
+    for future in futures.values():
+      future.set_exception(ConnectionError("the connection to the plugin pool was lost"))
+
+
+def get_pool_client():
+  """Get this process's connection to the plugin pool, connecting if needed
+
+  Returns:
+      PoolClient: the connection, or None if the plugin pool can't be reached, in which case the cpu_bound
+          plugins run in this process until it's tried again PLUGIN_POOL_RETRY_SECONDS later, or if it's
+          turned off
+  """
+  global pool_client, pool_client_pid, pool_retry_at
+  if not PLUGIN_POOL:
+    return None
+  client = pool_client
+  if pool_client_pid == os.getpid() and client is not None and not client.closed:
+    return client
+  with plugin_loop_lock:
+    if pool_client_pid == os.getpid() and pool_client is not None and not pool_client.closed:
+      return pool_client
+    # worker processes are forked, and the connection's thread doesn't survive the fork
+    (pool_client, pool_client_pid) = (None, os.getpid())
+    if time.monotonic() < pool_retry_at:
+      return None
+    try:
+      pool_client = PoolClient(PLUGIN_POOL_SOCKET)
+    except OSError as e:
+      pool_retry_at = time.monotonic() + PLUGIN_POOL_RETRY_SECONDS
+      get_task_logger(__name__).warning(f"Can't reach the plugin pool at {PLUGIN_POOL_SOCKET} ({e}), running cpu_bound plugins in this process")
+      return None
+    return pool_client
+
+
+def load_cpu_plugins(modnames):
+  """Runs in the plugin pool's processes, so that the first events don't wait for the plugins to load"""
+  for modname in modnames:
+    try:
+      cpu_plugin(modname)
+    except Exception as e:
+      get_task_logger(__name__).error(f"Couldn't load plugin {modname} in plugin process: {e}")
+
+
+def cpu_plugin(modname):
+  plugin = cpu_plugins.get(modname)
+  if plugin is None:
+    plugin = cpu_plugins[modname] = importlib.import_module(modname).Plugin()
+  return plugin
+
+
+def call_in_process(modname, method_name, data):
+  """Runs in the plugin pool's processes: call a method of a cpu_bound plugin with encoded arguments, and encode the result"""
+  return encode(getattr(cpu_plugin(modname), method_name)(*decode(data)))
+
+
+def plugin_files():
+  """The modification time and size of each file in the plugin directories, with the plugin module it belongs to
+
+  Returns:
+      dict: {path: (module name, mtime in ns, size)}
+  """
+  r = {}
+  for root in pdaltagent.plugins.__path__:
+    for (dirpath, dirnames, filenames) in os.walk(root):
+      dirnames[:] = [x for x in dirnames if x != '__pycache__' and not x.startswith('.')]
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        name = os.path.relpath(path, root).split(os.sep)[0].split('.')[0]
+        if name.startswith('_'):
+          continue
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        r[path] = (f"{pdaltagent.plugins.__name__}.{name}", st.st_mtime_ns, st.st_size)
+  return r
+
+
+def rss_bytes():
+  """This process's resident set size, or its peak size where the current one isn't available"""
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError, ValueError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class CompiledFilter:
+  """A plugin's filter_event or filter_webhook method (or its filter_events or filter_webhooks batch method),
+  with its signature and module name worked out once when the plugin is loaded instead of on every call
+
+  Each method gets the plugin's timeout attribute (or PDAGENTD_PLUGIN_TIMEOUT_SECONDS) to run in. Methods
+  defined with async def are run on an event loop: awaited directly by acall in async callers, and on the
+  process's plugin loop by call in synchronous ones, and are cancelled if they take too long. Synchronous
+  methods run inline, and only count as timed out once they return, unless the plugin sets threaded = True
+  or its own timeout (or PDAGENTD_PLUGIN_THREADED is set and the plugin doesn't say otherwise); those are
+  run in a plugin thread and given up on if they take too long, when the item goes on with a copy of
+  itself as it was then, since the thread still has it.
+
+  Each method also has a circuit breaker. After PDAGENTD_PLUGIN_BREAKER_FAILURES timeouts or errors in a
+  row, the method is skipped for PDAGENTD_PLUGIN_BREAKER_RESET_SECONDS, and then one call is let through
+  to see whether it's working again, once any calls that were given up on have finished.
+
+  Args:
+      method (function): the plugin method
+      method_type (str): 'filter_event' or 'filter_webhook'
+      batch (bool): whether method is the batch version, which takes and returns lists
+
+  Raises:
+      ValueError: if the method takes an invalid number of arguments
+  """
+
+  def __init__(self, method, method_type, batch=False):
+    self.method = method
+    self.method_type = method_type
+    self.batch = batch
+    self.name = method.__name__
+    self.modname = inspect.getmodule(method).__name__
+    # plugins that change the event in place and want the host to give them a copy set isolate = True
+    self.isolate = bool(getattr(method.__self__, 'isolate', False))
+    self.is_async = inspect.iscoroutinefunction(method)
+    self.timeout = getattr(method.__self__, 'timeout', PLUGIN_TIMEOUT_SECONDS)
+    # a thread costs far more than most filters, and one that's given up on can't be stopped, so synchronous
+    # methods only run in one when their plugin asks for it
+    threaded = getattr(method.__self__, 'threaded', PLUGIN_THREADED or bool(getattr(method.__self__, 'timeout', None)))
+    self.threaded = not self.is_async and bool(threaded) and bool(self.timeout)
+    # plugins that set cpu_bound = True have their synchronous filter methods run in the plugin pool
+    self.cpu_bound = not self.is_async and bool(getattr(method.__self__, 'cpu_bound', False))
+    if self.cpu_bound:
+      self.threaded = False
+      cpu_modnames.add(self.modname)
+    num_params = self.num_params = len(inspect.signature(method).parameters)
+    max_params = 3 if method_type == 'filter_event' else 2
+    if not 1 <= num_params <= max_params:
+      raise ValueError(f"Plugin.{self.name} method of {self.modname} takes an invalid number of arguments. It should take 1-{max_params}")
+
+    if batch:
+      adapter = lambda payloads, *extras: method(payloads, *extras[:num_params - 1])
+    elif method_type == 'filter_event':
+      if num_params == 1:
+        adapter = lambda event, routing_key, destination_type: method(event)
+      elif num_params == 2:
+        adapter = lambda event, routing_key, destination_type: method(event, routing_key)
+      else:
+        adapter = method
+    else:
+      if num_params == 1:
+        adapter = lambda webhook, destination_url: method(webhook)
+      else:
+        adapter = method
+
+    self.acall = None
+    self.failures = 0
+    # when the breaker opened, or None while it's closed
+    self.opened = None
+    self.probing = False
+    # calls that were given up on but are still running in their threads
+    self.hung = 0
+    self.lock = threading.Lock()
+    self.counts = {'calls': 0, 'errors': 0, 'timeouts': 0, 'skipped': 0}
+    self.seconds = 0.0
+    self.max_seconds = 0.0
+
+    timeout = self.timeout
+    if self.cpu_bound:
+      if batch:
+        adapter = self.call_in_chunks
+        async def acall(payload, *extras):
+          return self.check_batch(decode(await with_timeout(asyncio.wrap_future(self.submit([payload], *[[x] for x in extras])), timeout)), 1)[0]
+      else:
+        adapter = lambda *args: self.collect(self.submit(*args))
+        async def acall(*args):
+          return decode(await with_timeout(asyncio.wrap_future(self.submit(*args)), timeout))
+      self.acall = acall
+    elif self.threaded:
+      (unguarded, adapter) = (adapter, lambda *args: run_in_thread(unguarded, args, timeout, self.hang))
+      # async callers wait on their own loop instead of blocking it
+      self.acall = lambda *args: run_in_thread_async(unguarded, args, timeout, self.hang)
+      if batch:
+        acall_batch = self.acall
+        async def acall(payload, *extras):
+          return self.check_batch(await acall_batch([payload], *[[x] for x in extras]), 1)[0]
+        self.acall = acall
+
+    if batch and self.is_async:
+      self.call_batch = lambda payloads, *extras: self.check_batch(run_async(adapter(payloads, *extras), timeout), len(payloads))
+      self.call = lambda payload, *extras: self.call_batch([payload], *[[x] for x in extras])[0]
+      async def acall(payload, *extras):
+        return self.check_batch(await with_timeout(adapter([payload], *[[x] for x in extras]), timeout), 1)[0]
+      self.acall = acall
+    elif batch:
+      self.call_batch = lambda payloads, *extras: self.check_batch(adapter(payloads, *extras), len(payloads))
+      self.call = lambda payload, *extras: self.call_batch([payload], *[[x] for x in extras])[0]
+    elif self.is_async:
+      self.call = lambda *args: run_async(adapter(*args), timeout)
+      self.acall = lambda *args: with_timeout(adapter(*args), timeout)
+    else:
+      self.call = adapter
+
+  def submit(self, *args):
+    """Start a call of a cpu_bound method in the plugin pool, returning a future of its encoded result. If the
+    plugin pool can't be reached, the method is called in this process instead, with a copy of the arguments"""
+    data = encode(args[:self.num_params])
+    client = get_pool_client()
+    if client is not None:
+      try:
+        return client.request('call', self.modname, self.name, data)
+      except ConnectionError:
+        pass
+    future = Future()
+    try:
+      future.set_result(encode(self.method(*decode(data))))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+  def collect(self, future, deadline=None):
+    """Wait for the result of a call started by submit, until the deadline or for the method's timeout
+
+    Raises:
+        TimeoutError: if the result isn't ready in time. The plugin process can't be stopped, but its result is ignored
+    """
+    timeout = max(deadline - time.perf_counter(), 0.001) if deadline else (self.timeout or None)
+    try:
+      return decode(future.result(timeout))
+    except TimeoutError:
+      raise TimeoutError(f"timed out after {self.timeout} seconds") from None
+
+  def call_in_chunks(self, payloads, *extras):
+    """Call a cpu_bound batch method with the batch split across the plugin processes"""
+    size = max(math.ceil(len(payloads) / PLUGIN_PROCESSES), 1)
+    deadline = time.perf_counter() + self.timeout if self.timeout else None
+    futures = [self.submit(payloads[i:i + size], *[x[i:i + size] for x in extras]) for i in range(0, len(payloads), size)]
+    results = []
+    for future in futures:
+      results.extend(self.collect(future, deadline))
+    return results
+
+  def hang(self, future):
+    """Count a call that was given up on until its thread finishes it"""
+    with self.lock:
+      self.hung += 1
+    future.add_done_callback(self.unhang)
+
+  def unhang(self, future):
+    with self.lock:
+      self.hung -= 1
+
+  def allow(self):
+    """Whether to call the method, or skip it because its circuit breaker is open"""
+    if self.opened is None:
+      return True
+    with self.lock:
+      if self.opened is None:
+        return True
+      # no probing while an earlier call is still stuck, since the probe would likely get stuck too
+      if not self.probing and not self.hung and time.monotonic() - self.opened >= PLUGIN_BREAKER_RESET_SECONDS:
+        # half open: let one call through to see whether it's working again
+        self.probing = True
+        return True
+      self.counts['skipped'] += 1
+      return False
+
+  def record(self, elapsed, error=None):
+    """Record how a call went
+
+    Returns:
+        bool: True if this failure opened the circuit breaker
+    """
+    self.counts['calls'] += 1
+    self.seconds += elapsed
+    if elapsed > self.max_seconds:
+      self.max_seconds = elapsed
+    if error is None:
+      if self.failures or self.opened is not None:
+        with self.lock:
+          (self.failures, self.opened, self.probing) = (0, None, False)
+      return False
+    with self.lock:
+      self.counts['timeouts' if isinstance(error, TimeoutError) else 'errors'] += 1
+      self.failures += 1
+      if self.probing or (self.opened is None and PLUGIN_BREAKER_FAILURES and self.failures >= PLUGIN_BREAKER_FAILURES):
+        (self.opened, self.probing) = (time.monotonic(), False)
+        return True
+      return False
+
+  def stats(self):
+    return dict(
+      self.counts,
+      avg_ms=round(self.seconds / max(self.counts['calls'], 1) * 1000, 2),
+      max_ms=round(self.max_seconds * 1000, 2),
+      hung=self.hung,
+      breaker='closed' if self.opened is None else ('half open' if self.probing else 'open'),
+    )
+
+  def check_batch(self, results, count):
+    if not isinstance(results, (list, tuple)) or len(results) != count:
+      raise ValueError(f"Plugin.{self.name} method of {self.modname} returned {type(results).__name__} {results!r:.100}. Should return a list with a result for each of the {count} items it was given.")
+    return results
+
+
 class PluginHost:
   @staticmethod
   def methodname(method):
@@ -43,60 +661,264 @@ class PluginHost:
       'filter_webhook': [],
       'fetch_events': [],
     }
-    self.logger.debug('PluginHost init loading plugins...')
-    self.load_plugins()
-  
+    self.pipelines = {'filter_event': [], 'filter_webhook': []}
+    # plugins are loaded the first time each type of method is needed, so a process only imports and
+    # initializes the plugins for the work it does (the webhook workers never load filter_event plugins)
+    self.loaded = set()
+    self.load_lock = threading.RLock()
+    self.modules = {}
+    self.instances = {}
+    self.load_times = {}
+    # incremented whenever the loaded plugins change, so that users of the methods can tell when to look again
+    self.generation = 0
+    self.watch_pid = None
+
+
+  def get_pipeline(self, method_type):
+    """The compiled filters of a method type, loading the plugins that implement it if they aren't loaded yet"""
+    if method_type not in self.loaded:
+      self.load_plugins([method_type])
+    return self.pipelines[method_type]
+
+
+  def get_methods(self, method_type):
+    """The methods of a method type, loading the plugins that implement it if they aren't loaded yet"""
+    if method_type not in self.loaded:
+      self.load_plugins([method_type])
+    return self.methods[method_type]
+
+
+  def load_plugins(self, method_types=None):
+    """Load the plugins in the pdaltagent.plugins namespace that implement any of method_types, and compile their
+    methods of those types. Plugins are only instantiated when they're needed for one of the types
+
+    Args:
+        method_types (list, optional): method types to load, like 'filter_event'. Defaults to all of them.
+    """
+
+    with self.load_lock:
+      method_types = [x for x in (method_types or self.methods.keys()) if x not in self.loaded]
+      if not method_types:
+        return
+      start = time.perf_counter()
+      if not hasattr(self, 'modnames'):
+        self.files = plugin_files()
+        self.modnames = self.find_plugins()
+        self.logger.debug(f"Found {len(self.modnames)} module names: {', '.join(self.modnames)}")
+
+      for modname in self.modnames:
+        if modname not in self.modules:
+          self.import_plugin(modname, self.modules, self.load_times)
+      for modname in self.modnames:
+        if self.modules[modname] is not None and modname not in self.instances:
+          self.instantiate_plugin(modname, self.modules[modname], method_types, self.instances, self.load_times)
 
-  def load_plugins(self):
-    """Load all the plugins in the pdaltagent.plugins namespace"""
+      self.load_methods(self.ordered(self.instances), method_types)
+      self.generation += 1
+      self.logger.info(f"Loaded {', '.join(method_types)} plugins in {round((time.perf_counter() - start) * 1000)}ms, process RSS is now {rss_bytes() // 1048576}MB")
+    self.warm()
+    self.watch()
+
+
+  def find_plugins(self):
+    """The names of the default plugin modules and the modules in the pdaltagent.plugins namespace"""
     self.default_plugin_modnames = [x.name for x in pkgutil.iter_modules(pdaltagent.default_plugins.__path__, pdaltagent.default_plugins.__name__ + '.')]
-    self.modnames = self.default_plugin_modnames + [x.name for x in pkgutil.iter_modules(pdaltagent.plugins.__path__, pdaltagent.plugins.__name__ + '.')]
-    self.logger.debug(f"Found {len(self.modnames)} module names: {', '.join(self.modnames)}")
-    self.modules = []
-    for modname in self.modnames:
-      try:
-        self.modules.append(importlib.import_module(modname))
-      except Exception as e:
-        self.logger.error(f"Couldn't import {modname}: {e}")
+    return self.default_plugin_modnames + [x.name for x in pkgutil.iter_modules(pdaltagent.plugins.__path__, pdaltagent.plugins.__name__ + '.')]
+
+
+  def import_plugin(self, modname, modules, load_times):
+    """Import a plugin module into modules (None if it can't be imported)
+
+    Returns:
+        bool: whether it was imported
+    """
+    (start, rss) = (time.perf_counter(), rss_bytes())
+    try:
+      modules[modname] = importlib.import_module(modname)
+    except Exception as e:
+      self.logger.error(f"Couldn't import {modname}: {e}")
+      modules[modname] = None
+    load_times[modname] = {
+      'import_ms': round((time.perf_counter() - start) * 1000, 2),
+      'import_rss_kb': (rss_bytes() - rss) // 1024,
+    }
+    return modules[modname] is not None
+
+
+  def instantiate_plugin(self, modname, module, method_types, instances, load_times):
+    """Create the Plugin of a module into instances (None if it can't be created), if it implements any of method_types
+
+    Returns:
+        bool: False if it couldn't be created
+    """
+    plugin_class = getattr(module, 'Plugin', None)
+    if plugin_class is not None and not any(hasattr(plugin_class, x) or hasattr(plugin_class, BATCH_METHODS.get(x, x)) for x in method_types):
+      return True
+    (start, rss) = (time.perf_counter(), rss_bytes())
+    try:
+      instances[modname] = module.Plugin()
+    except Exception as e:
+      self.logger.error(f"Couldn't instantiate Plugin class of module {module.__name__}: {e}")
+      instances[modname] = None
+    load_times[modname].update({
+      'init_ms': round((time.perf_counter() - start) * 1000, 2),
+      'init_rss_kb': (rss_bytes() - rss) // 1024,
+    })
+    return instances[modname] is not None
 
-    self.instances = []
-    for module in self.modules:
-      try:
-        self.instances.append(module.Plugin())
-      except Exception as e:
-        self.logger.error(f"Couldn't instantiate Plugin class of module {module.__name__}: {e}")
-    self.instances.sort(key=lambda x: (x.order if isinstance(getattr(x, 'order', None), int) else 999))
 
-    for instance in self.instances:
-      for method_type in self.methods.keys():
+  @staticmethod
+  def ordered(instances):
+    """The plugin instances that were created, in the order their methods should run"""
+    r = [x for x in instances.values() if x is not None]
+    r.sort(key=lambda x: (x.order if isinstance(getattr(x, 'order', None), int) else 999))
+    return r
+
+
+  def load_methods(self, instances, method_types=None):
+    """Collect the methods of the plugin instances, and compile the filter methods into pipelines
+
+    Args:
+        instances (list): plugin instances, in the order their filters should run
+        method_types (list, optional): the method types to collect, leaving the others as they are. Defaults to all of them.
+    """
+    method_types = list(method_types or self.methods.keys())
+    # plugins that are still loaded keep their compiled filters, and the stats and circuit breakers that go with them
+    compiled = {(id(step.method.__self__), step.name): step for pipeline in self.pipelines.values() for step in pipeline}
+    methods = dict(self.methods, **{method_type: [] for method_type in method_types})
+    pipelines = dict(self.pipelines, **{method_type: [] for method_type in method_types if method_type in BATCH_METHODS})
+    for instance in instances:
+      for method_type in method_types:
         method = getattr(instance, method_type, None)
+        if not inspect.ismethod(method) and method_type in BATCH_METHODS:
+          method = getattr(instance, BATCH_METHODS[method_type], None)
         if inspect.ismethod(method):
           if method_type == 'fetch_events':
-            self.methods[method_type].append({
+            methods[method_type].append({
               'method': method,
               'fetch_interval': getattr(method.__self__, 'fetch_interval', 10)
             })
           else:
-            self.methods[method_type].append(method)
-    for method_type in self.methods.keys():
+            # a plugin's batch method takes over from its single item method
+            batch_method = getattr(instance, BATCH_METHODS[method_type], None)
+            if inspect.ismethod(batch_method):
+              (method, batch) = (batch_method, True)
+            else:
+              batch = False
+            try:
+              step = compiled.get((id(instance), method.__name__)) or CompiledFilter(method, method_type, batch)
+              pipelines[method_type].append(step)
+            except ValueError as e:
+              self.logger.error(f"Not loading {method.__name__} method: {e}")
+              continue
+            methods[method_type].append(method)
+    (self.methods, self.pipelines) = (methods, pipelines)
+    self.loaded = self.loaded | set(method_types)
+    for method_type in method_types:
       self.logger.debug(f"Loaded {method_type} methods from {len(self.methods[method_type])} modules ({', '.join([self.methodname(x) for x in self.methods[method_type]])})")
 
 
   def unload_plugins(self):
     """Unload all the loaded plugins"""
 
-    for method_type in self.methods.keys():
-      self.methods[method_type] = []
-    del self.instances, self.modules, self.modnames
-    for modname in [x for x in sys.modules.keys() if x.startswith('pdaltagent.plugins.')]:
-      del sys.modules[modname]
+    with self.load_lock:
+      self.methods = {method_type: [] for method_type in self.methods.keys()}
+      self.pipelines = {'filter_event': [], 'filter_webhook': []}
+      self.loaded = set()
+      (self.modules, self.instances, self.load_times) = ({}, {}, {})
+      self.generation += 1
+      if hasattr(self, 'modnames'):
+        del self.modnames
+      for modname in [x for x in sys.modules.keys() if x.startswith('pdaltagent.plugins.')]:
+        del sys.modules[modname]
+
+
+  def reload_plugins(self, modnames=None):
+    """Reload plugins, for the method types that were loaded. The new plugins are loaded while the old ones
+    keep running, and swapped in all at once. If any of them can't be imported or instantiated, the old
+    plugins stay in place
+
+    Args:
+        modnames (list, optional): the plugin modules to reload. Defaults to all of them. Modules that were
+            added or removed are always reloaded.
+
+    Returns:
+        bool: whether the new plugins were swapped in
+    """
+
+    with self.load_lock:
+      if not self.loaded:
+        # nothing to swap out; the plugins will be loaded as they are when they're first needed
+        return True
+      start = time.perf_counter()
+      method_types = sorted(self.loaded)
+      files = plugin_files()
+      found = self.find_plugins()
+      changed = set(found) ^ set(self.modnames)
+      changed |= set(found if modnames is None else modnames) & set(found)
+      contains = lambda name: any(name == x or name.startswith(x + '.') for x in changed)
 
+      modules = {x: self.modules[x] for x in found if x in self.modules and x not in changed}
+      instances = {x: self.instances[x] for x in found if x in self.instances and x not in changed}
+      load_times = {x: self.load_times[x] for x in modules}
+      # the old modules are put back if the new ones don't load
+      saved = {x: module for (x, module) in sys.modules.items() if x.startswith('pdaltagent.plugins.') and contains(x)}
+      for x in saved:
+        del sys.modules[x]
 
-  def reload_plugins(self):
-    """Reload plugins"""
+      ok = True
+      for modname in found:
+        if modname not in modules:
+          ok = self.import_plugin(modname, modules, load_times) and ok
+      for modname in found:
+        if modules[modname] is not None and modname not in instances:
+          ok = self.instantiate_plugin(modname, modules[modname], method_types, instances, load_times) and ok
+      if not ok:
+        for x in [x for x in sys.modules.keys() if x.startswith('pdaltagent.plugins.') and contains(x)]:
+          del sys.modules[x]
+        sys.modules.update(saved)
+        self.logger.error(f"Keeping the plugins that were loaded, since some of {', '.join(sorted(changed))} couldn't be loaded")
+        return False
 
-    self.unload_plugins()
-    self.load_plugins()
+      reload_pool = bool(cpu_modnames & changed)
+      cpu_modnames.difference_update(changed)
+      (self.files, self.modnames, self.modules, self.instances, self.load_times) = (files, found, modules, instances, load_times)
+      self.load_methods(self.ordered(instances), method_types)
+      self.generation += 1
+      self.logger.info(f"Reloaded {', '.join(sorted(changed))} in {round((time.perf_counter() - start) * 1000)}ms")
+    self.warm(reload_pool)
+    return True
+
+
+  def watch(self):
+    """Start a thread that reloads plugins when the files in the plugin directories change, unless this
+    process has one already"""
+    if PLUGIN_WATCH_SECONDS <= 0 or self.watch_pid == os.getpid():
+      return
+    self.watch_pid = os.getpid()
+    threading.Thread(target=self.watch_plugins, name='plugin-watcher', daemon=True).start()
+
+
+  def watch_plugins(self):
+    while True:
+      time.sleep(PLUGIN_WATCH_SECONDS)
+      try:
+        files = plugin_files()
+        if files == self.files:
+          continue
+        # give a plugin that's being copied in a moment to finish
+        time.sleep(PLUGIN_WATCH_SECONDS / 4)
+        if plugin_files() != files:
+          continue
+        changed = sorted({files[x][0] for x in files.keys() - self.files.keys()} |
+                         {self.files[x][0] for x in self.files.keys() - files.keys()} |
+                         {files[x][0] for x in files.keys() & self.files.keys() if files[x] != self.files[x]})
+        self.logger.info(f"Plugin files changed, reloading {', '.join(changed)}")
+        if not self.reload_plugins(changed):
+          # don't try the broken plugins again until they change
+          self.files = files
+      except Exception as e:
+        self.logger.error(f"Error watching plugins: {e}")
 
 
   def call_filter_event_method(self, method, event, routing_key=None, destination_type="v2"):
@@ -104,7 +926,7 @@ class PluginHost:
     and return a standard dict
 
     Args:
-        method (function): the method to call
+        method (function): the method to call, or its CompiledFilter
         event (dict): the event to filter
         routing_key (str, optional): the routing key. Defaults to None.
         destination_type (str, optional): the type of PD integration - x-ere, v1 or v2. Defaults to "v2".
@@ -117,53 +939,45 @@ class PluginHost:
         dict: a dict with keys "event", "routing_key", "destination_type", "stop"
     """
 
-    _event = dict(event)
-    num_params = len(inspect.signature(method).parameters)
-    if num_params == 1:
-      r = method(_event)
-    elif num_params == 2:
-      r = method(_event, routing_key)
-    elif num_params == 3:
-      r = method(_event, routing_key, destination_type)
-    else:
-      raise ValueError(f"Plugin.filter_event method of {inspect.getmodule(method).__name__} takes an invalid number of arguments. It should take 1-3")
-
+    step = method if isinstance(method, CompiledFilter) else CompiledFilter(method, 'filter_event')
+    r = step.call(dict(event), routing_key, destination_type)
     if r is None:
       return None
-
-    ret = {
-      'event': None,
-      'routing_key': routing_key,
-      'destination_type': destination_type,
-      'stop': False,
+    (_event, _routing_key, _destination_type, stop) = self.event_result(step, r, routing_key, destination_type)
+    return {
+      'event': _event,
+      'routing_key': _routing_key,
+      'destination_type': _destination_type,
+      'stop': stop,
     }
 
+
+  def event_result(self, step, r, routing_key, destination_type):
+    """Turn what a filter event method returned (other than None) into an (event, routing_key, destination_type, stop) tuple
+
+    Raises:
+        ValueError: if the filter method returned an invalid value
+    """
+
     if isinstance(r, dict):
-      ret['event'] = r
-      return ret
+      return (r, routing_key, destination_type, False)
     if isinstance(r, tuple):
       if not 1 <= len(r) <= 4:
-        raise ValueError(f"Plugin.filter_event method of {inspect.getmodule(method).__name__} returned invalid value {r}. Should return a (event, routing_key?, destination_type?, stop?) tuple.")
+        raise ValueError(f"Plugin.filter_event method of {step.modname} returned invalid value {r}. Should return a (event, routing_key?, destination_type?, stop?) tuple.")
       if not isinstance(r[0], dict):
-        raise ValueError(f"Plugin.filter_event method of {inspect.getmodule(method).__name__} returned a tuple with invalid event {r[0]}. The first element of the tuple should be an event dict.")
-      ret['event'] = r[0]
-      if len(r) == 1:
-        return ret
-      if r[1] is not None and not pdaltagent.pd.is_valid_integration_key(r[1]):
-        raise ValueError(f"Plugin.filter_event method of {inspect.getmodule(method).__name__} returned a tuple with invalid routing key {r[1]}. The second element of the tuple should be a routing key or None.")
-      ret['routing_key'] = r[1] or ret['routing_key']
-      if len(r) == 2:
-        return ret
-      if r[2] is not None and not isinstance(r[2], str):
-        raise ValueError(f"Plugin.filter_event method of {inspect.getmodule(method).__name__} returned a tuple with invalid destination type {r[2]}. The third element of the tuple should be a string or None.")
-      ret['destination_type'] = r[2] or ret['destination_type']
-      if len(r) == 3:
-        return ret
-      if r[3]:
-        ret['stop'] = True
-      return ret
-
-    raise ValueError(f"Plugin.filter_event method of {inspect.getmodule(method).__name__} returned invalid value of type {type(r).__name__}. Should return a dict, tuple or None")
+        raise ValueError(f"Plugin.filter_event method of {step.modname} returned a tuple with invalid event {r[0]}. The first element of the tuple should be an event dict.")
+      if len(r) > 1 and r[1] is not None and not pdaltagent.pd.is_valid_integration_key(r[1]):
+        raise ValueError(f"Plugin.filter_event method of {step.modname} returned a tuple with invalid routing key {r[1]}. The second element of the tuple should be a routing key or None.")
+      if len(r) > 2 and r[2] is not None and not isinstance(r[2], str):
+        raise ValueError(f"Plugin.filter_event method of {step.modname} returned a tuple with invalid destination type {r[2]}. The third element of the tuple should be a string or None.")
+      return (
+        r[0],
+        (r[1] if len(r) > 1 else None) or routing_key,
+        (r[2] if len(r) > 2 else None) or destination_type,
+        bool(len(r) > 3 and r[3]),
+      )
+
+    raise ValueError(f"Plugin.filter_event method of {step.modname} returned invalid value of type {type(r).__name__}. Should return a dict, tuple or None")
 
 
   def call_filter_webhook_method(self, method, webhook, destination_url=None):
@@ -171,10 +985,9 @@ class PluginHost:
     and return a standard dict
 
     Args:
-        method (function): the method to call
+        method (function): the method to call, or its CompiledFilter
         webhook (dict): the webhook to filter
-        routing_key (str, optional): the routing key. Defaults to None.
-        destination_type (str, optional): the type of PD integration - x-ere, v1 or v2. Defaults to "v2".
+        destination_url (str, optional): the URL to send the webhook to
 
     Raises:
         ValueError: if the filter method signature is invalid
@@ -183,49 +996,49 @@ class PluginHost:
     Returns:
         dict: a dict with keys "webhook", "destination_url", "stop"
     """
-    _webhook = dict(webhook)
-    num_params = len(inspect.signature(method).parameters)
-    if num_params == 1:
-      r = method(_webhook)
-    elif num_params == 2:
-      r = method(_webhook, destination_url)
-    else:
-      raise ValueError(f"Plugin.filter_webhook method of {inspect.getmodule(method).__name__} takes an invalid number of arguments. It should take 1-2")
 
+    step = method if isinstance(method, CompiledFilter) else CompiledFilter(method, 'filter_webhook')
+    r = step.call(dict(webhook), destination_url)
     if r is None:
       return None
-
-    ret = {
-      'webhook': None,
-      'destination_url': destination_url,
-      'stop': False,
+    (_webhook, _destination_url, stop) = self.webhook_result(step, r, destination_url)
+    return {
+      'webhook': _webhook,
+      'destination_url': _destination_url,
+      'stop': stop,
     }
 
+
+  def webhook_result(self, step, r, destination_url):
+    """Turn what a filter webhook method returned (other than None) into a (webhook, destination_url, stop) tuple
+
+    Raises:
+        ValueError: if the filter method returned an invalid value
+    """
+
     if isinstance(r, dict):
-      ret['webhook'] = r
-      return ret
+      return (r, destination_url, False)
     if isinstance(r, tuple):
       if not 1 <= len(r) <= 3:
-        raise ValueError(f"Plugin.filter_webhook method of {inspect.getmodule(method).__name__} returned invalid value {r}. Should return a (webhook, destination_url?, stop?) tuple.")
+        raise ValueError(f"Plugin.filter_webhook method of {step.modname} returned invalid value {r}. Should return a (webhook, destination_url?, stop?) tuple.")
       if not isinstance(r[0], dict):
-        raise ValueError(f"Plugin.filter_webhook method of {inspect.getmodule(method).__name__} returned a tuple with invalid webhook {r[0]}. The first element of the tuple should be a webhook payload dict.")
-      ret['webhook'] = r[0]
-      if len(r) == 1:
-        return ret
-      if r[1] is not None and (not isinstance(r[1], str) or validators.url(r[1]) != True):
-        raise ValueError(f"Plugin.filter_webhook method of {inspect.getmodule(method).__name__} returned a tuple with invalid destination url {r[1]}. The second element of the tuple should be a destination url or None.")
-      ret['destination_url'] = r[1] or ret['destination_url']
-      if len(r) == 2:
-        return ret
-      if r[2]:
-        ret['stop'] = True
-      return ret
-
-    raise ValueError(f"Plugin.filter_webhook method of {inspect.getmodule(method).__name__} returned invalid value of type {type(r).__name__}. Should return a dict, tuple or None")
+        raise ValueError(f"Plugin.filter_webhook method of {step.modname} returned a tuple with invalid webhook {r[0]}. The first element of the tuple should be a webhook payload dict.")
+      if len(r) > 1 and r[1] is not None and (not isinstance(r[1], str) or validators.url(r[1]) != True):
+        raise ValueError(f"Plugin.filter_webhook method of {step.modname} returned a tuple with invalid destination url {r[1]}. The second element of the tuple should be a destination url or None.")
+      return (
+        r[0],
+        (r[1] if len(r) > 1 else None) or destination_url,
+        bool(len(r) > 2 and r[2]),
+      )
+
+    raise ValueError(f"Plugin.filter_webhook method of {step.modname} returned invalid value of type {type(r).__name__}. Should return a dict, tuple or None")
 
   def filter_event(self, event, routing_key=None, destination_type="v2"):
     """call all the filter event methods in order and return the result or None to suppress the event
 
+    The event is copied once on the way in, so the caller's dict (which Celery reuses if the task is
+    retried) isn't changed. After that, filters get the event in place unless they set isolate = True.
+
     Args:
         event (dict): the event to filter
         routing_key (str, optional): the routing key. Defaults to None.
@@ -239,28 +1052,7 @@ class PluginHost:
       self.logger.error(f"PluginHost.filter_event method called with an invalid value {event}. Call this method with a dict.")
       return None
 
-    _event = dict(event)
-    _routing_key = routing_key
-    _destination_type = destination_type
-
-    for filter in self.methods['filter_event']:
-      try:
-        r = self.call_filter_event_method(filter, _event, _routing_key, _destination_type)
-
-        if r is None:
-          return None
-
-        _event = r['event']
-        _routing_key = r['routing_key']
-        _destination_type = r['destination_type']
-
-        if 'stop' in r and r['stop']:
-          break
-
-      except Exception as e:
-        self.logger.error(f"Exception when calling Plugin.filter_event method of {inspect.getmodule(filter).__name__}: {e}")
-
-    return (_event, _routing_key, _destination_type)
+    return self.run_pipeline('filter_event', [dict(event), routing_key, destination_type], self.event_result)
 
 
 
@@ -279,22 +1071,318 @@ class PluginHost:
       self.logger.error(f"PluginHost.filter_webhook method called with an invalid value {webhook}. Call this method with a dict.")
       return None
 
-    _webhook = dict(webhook)
-    _destination_url = destination_url
+    return self.run_pipeline('filter_webhook', [dict(webhook), destination_url], self.webhook_result)
+
+
+  async def filter_event_async(self, event, routing_key=None, destination_type="v2"):
+    """filter_event for callers running on an event loop: async filter methods are awaited on the caller's
+    loop, so many events can be waiting on them at once, and synchronous ones are run in plugin threads (or
+    the plugin pool, for cpu_bound plugins) while the loop goes on with other events
+
+    Returns:
+        tuple: a tuple with the new event, routing key and destination type, or None if suppressed
+    """
+
+    if not isinstance(event, dict):
+      self.logger.error(f"PluginHost.filter_event_async method called with an invalid value {event}. Call this method with a dict.")
+      return None
+
+    return await self.run_pipeline_async('filter_event', [dict(event), routing_key, destination_type], self.event_result)
+
+
+  async def filter_webhook_async(self, webhook, destination_url=None):
+    """filter_webhook for callers running on an event loop, like filter_event_async
+
+    Returns:
+        tuple: a tuple with the new webhook and destination URL, or None if suppressed
+    """
+
+    if not isinstance(webhook, dict):
+      self.logger.error(f"PluginHost.filter_webhook_async method called with an invalid value {webhook}. Call this method with a dict.")
+      return None
+
+    return await self.run_pipeline_async('filter_webhook', [dict(webhook), destination_url], self.webhook_result)
+
+
+  def run_pipeline(self, method_type, item, result_fn):
+    """Run one item through a filter pipeline
+
+    Args:
+        method_type (str): 'filter_event' or 'filter_webhook'
+        item (list): [payload, *extras], which is updated as the filters run
+        result_fn (function): result_fn(step, r, *extras) turns what a filter returned into a (payload, *extras, stop) tuple
 
-    for filter in self.methods['filter_webhook']:
+    Returns:
+        tuple: (payload, *extras) after filtering, or None if it was suppressed
+    """
+
+    for step in self.get_pipeline(method_type):
+      if not step.allow():
+        item[0] = self.mark_skipped(method_type, item[0], step, 'circuit breaker open')
+        continue
+      start = time.perf_counter()
       try:
-        r = self.call_filter_webhook_method(filter, _webhook, _destination_url)
+        r = step.call(dict(item[0]) if step.isolate else item[0], *item[1:])
+        if r is not None:
+          (*result, stop) = result_fn(step, r, *item[1:])
+      except Exception as e:
+        self.item_failed(method_type, item, step, e, time.perf_counter() - start)
+        continue
+      self.step_done(step, time.perf_counter() - start)
+
+      if r is None:
+        return None
+      item = result
+      if stop:
+        break
+
+    return tuple(item)
 
-        if r is None:
-          return None
 
-        _webhook = r['webhook']
-        _destination_url = r['destination_url']
+  async def run_pipeline_async(self, method_type, item, result_fn):
+    """run_pipeline for callers running on an event loop"""
 
-        if r['stop']:
-          break
+    for step in self.get_pipeline(method_type):
+      if not step.allow():
+        item[0] = self.mark_skipped(method_type, item[0], step, 'circuit breaker open')
+        continue
+      start = time.perf_counter()
+      try:
+        payload = dict(item[0]) if step.isolate else item[0]
+        if step.acall is not None:
+          r = await step.acall(payload, *item[1:])
+        else:
+          # an inline method, which only means it isn't given up on
+          r = await run_in_plugin_thread(step.call, payload, *item[1:])
+        if r is not None:
+          (*result, stop) = result_fn(step, r, *item[1:])
       except Exception as e:
-        self.logger.error(f"Exception when calling Plugin.filter_webhook method of {inspect.getmodule(filter).__name__}: {e}")
+        self.item_failed(method_type, item, step, e, time.perf_counter() - start)
+        continue
+      self.step_done(step, time.perf_counter() - start)
+
+      if r is None:
+        return None
+      item = result
+      if stop:
+        break
 
-    return (_webhook, _destination_url)
+    return tuple(item)
+
+
+  def step_done(self, step, elapsed):
+    """Record a filter method call that returned"""
+
+    if step.timeout and elapsed > step.timeout:
+      # it couldn't be stopped, but it still counts against the method's circuit breaker
+      self.step_failed(step, TimeoutError(f"took {round(elapsed, 1)} seconds, more than its {step.timeout} second timeout"), elapsed)
+    else:
+      step.record(elapsed)
+
+
+  def item_failed(self, method_type, item, step, e, elapsed):
+    """Log and record a filter method call for one item that raised or timed out, and note on the item if it timed out"""
+
+    self.step_failed(step, e, elapsed)
+    if isinstance(e, GivenUp):
+      # the plugin's thread still has the payload, so go on with a copy (of the batch of one, for batch methods)
+      item[0] = e.copies[0][0] if step.batch else e.copies[0]
+    if isinstance(e, TimeoutError):
+      item[0] = self.mark_skipped(method_type, item[0], step, 'timed out')
+
+
+  def step_failed(self, step, e, elapsed):
+    """Log and record a filter method call that raised or timed out"""
+
+    if isinstance(e, TimeoutError):
+      self.logger.error(f"Plugin.{step.name} method of {step.modname} {e}")
+    else:
+      self.logger.error(f"Exception when calling Plugin.{step.name} method of {step.modname}: {e}")
+    if step.record(elapsed, e):
+      self.logger.error(f"Skipping Plugin.{step.name} method of {step.modname} for {PLUGIN_BREAKER_RESET_SECONDS} seconds after {step.failures} failures in a row")
+
+
+  def mark_skipped(self, method_type, payload, step, reason):
+    """Note on an event that a plugin didn't get to change it, in payload.custom_details.pdaltagent_skipped_plugins.
+    Webhooks and events without a payload dict are left alone
+
+    Returns:
+        dict: the event with the note
+    """
+
+    if method_type != 'filter_event' or not isinstance(payload.get('payload'), dict):
+      return payload
+    details = payload['payload'].get('custom_details')
+    if details is None:
+      details = {}
+    if not isinstance(details, dict):
+      return payload
+    # copy on the way down, since the nested dicts may still be shared with the caller
+    payload = dict(payload)
+    payload['payload'] = dict(payload['payload'])
+    details = dict(details)
+    skipped = details.get('pdaltagent_skipped_plugins')
+    details['pdaltagent_skipped_plugins'] = (skipped if isinstance(skipped, list) else []) + [f"{step.modname}: {reason}"]
+    payload['payload']['custom_details'] = details
+    return payload
+
+
+  def filter_events(self, items):
+    """call all the filter event methods in order for a batch of events, passing the whole batch to plugins that
+    implement filter_events, and return the result for each event
+
+    Args:
+        items (list): (event, routing_key, destination_type) tuples
+
+    Returns:
+        list: for each event, a tuple with the new event, routing key and destination type, or None if suppressed
+    """
+
+    batch = []
+    for (event, routing_key, destination_type) in items:
+      if not isinstance(event, dict):
+        self.logger.error(f"PluginHost.filter_events method called with an invalid value {event}. Call this method with dicts.")
+        batch.append(None)
+      else:
+        batch.append([dict(event), routing_key, destination_type])
+    return self.run_batch('filter_event', batch, self.event_result)
+
+
+  def filter_webhooks(self, items):
+    """call all the filter webhook methods in order for a batch of webhooks, passing the whole batch to plugins that
+    implement filter_webhooks, and return the result for each webhook
+
+    Args:
+        items (list): (webhook, destination_url) tuples
+
+    Returns:
+        list: for each webhook, a tuple with the new webhook and destination URL, or None if suppressed
+    """
+
+    batch = []
+    for (webhook, destination_url) in items:
+      if not isinstance(webhook, dict):
+        self.logger.error(f"PluginHost.filter_webhooks method called with an invalid value {webhook}. Call this method with dicts.")
+        batch.append(None)
+      else:
+        batch.append([dict(webhook), destination_url])
+    return self.run_batch('filter_webhook', batch, self.webhook_result)
+
+
+  def run_batch(self, method_type, batch, result_fn):
+    """Run a batch through a filter pipeline. Batch methods are called once with all the items that haven't been
+    suppressed or stopped yet, and single item methods are called for each of them. An exception in a filter
+    leaves the items it was called with as they were.
+
+    Args:
+        method_type (str): 'filter_event' or 'filter_webhook'
+        batch (list): a [payload, *extras] list for each item, or None for items that are already suppressed
+        result_fn (function): result_fn(step, r, *extras) turns what a filter returned into a (payload, *extras, stop) tuple
+
+    Returns:
+        list: a (payload, *extras) tuple for each item, or None if it was suppressed
+    """
+
+    active = [i for (i, item) in enumerate(batch) if item is not None]
+
+    for step in self.get_pipeline(method_type):
+      if not active:
+        break
+
+      if step.batch:
+        if not step.allow():
+          for i in active:
+            batch[i][0] = self.mark_skipped(method_type, batch[i][0], step, 'circuit breaker open')
+          continue
+        start = time.perf_counter()
+        try:
+          payloads = [dict(batch[i][0]) if step.isolate else batch[i][0] for i in active]
+          extras = [[batch[i][k] for i in active] for k in range(1, len(batch[active[0]]))]
+          returned = step.call_batch(payloads, *extras)
+        except Exception as e:
+          self.step_failed(step, e, time.perf_counter() - start)
+          if isinstance(e, GivenUp):
+            for (n, i) in enumerate(active):
+              batch[i][0] = e.copies[0][n]
+          if isinstance(e, TimeoutError):
+            for i in active:
+              batch[i][0] = self.mark_skipped(method_type, batch[i][0], step, 'timed out')
+          continue
+        self.step_done(step, time.perf_counter() - start)
+      else:
+        returned = [UNCHANGED] * len(active)
+        started = []
+        for (n, i) in enumerate(active):
+          if not step.allow():
+            batch[i][0] = self.mark_skipped(method_type, batch[i][0], step, 'circuit breaker open')
+            continue
+          start = time.perf_counter()
+          try:
+            if step.cpu_bound:
+              # start them all before waiting for any, so they run in parallel in the plugin processes
+              started.append((n, i, start, step.submit(batch[i][0], *batch[i][1:])))
+              continue
+            returned[n] = step.call(dict(batch[i][0]) if step.isolate else batch[i][0], *batch[i][1:])
+          except Exception as e:
+            self.item_failed(method_type, batch[i], step, e, time.perf_counter() - start)
+            continue
+          self.step_done(step, time.perf_counter() - start)
+        for (n, i, start, future) in started:
+          try:
+            returned[n] = step.collect(future, start + step.timeout if step.timeout else None)
+          except Exception as e:
+            self.item_failed(method_type, batch[i], step, e, time.perf_counter() - start)
+            continue
+          self.step_done(step, time.perf_counter() - start)
+
+      still_active = []
+      for (i, r) in zip(active, returned):
+        if r is UNCHANGED:
+          still_active.append(i)
+          continue
+        if r is None:
+          batch[i] = None
+          continue
+        try:
+          (*item, stop) = result_fn(step, r, *batch[i][1:])
+        except Exception as e:
+          self.logger.error(f"Exception when calling Plugin.{step.name} method of {step.modname}: {e}")
+          still_active.append(i)
+          continue
+        batch[i] = item
+        if not stop:
+          still_active.append(i)
+      active = still_active
+
+    return [tuple(item) if item is not None else None for item in batch]
+
+
+  def warm(self, reload=False):
+    """Have the plugin pool load the cpu_bound plugins, if there are any, so the first events don't wait for them.
+    This never raises, since events can still be filtered without it
+
+    Args:
+        reload (bool, optional): whether cpu_bound plugins were reloaded, so the pool should start new processes
+            if their files have changed since it started the ones it has
+    """
+    try:
+      if any(step.cpu_bound for pipeline in self.pipelines.values() for step in pipeline):
+        client = get_pool_client()
+        if client is not None:
+          client.request('reload' if reload else 'warm', sorted(cpu_modnames))
+    except Exception as e:
+      self.logger.error(f"Couldn't warm the plugin pool: {e}")
+
+
+  def stats(self):
+    """Latency, errors, timeouts and circuit breaker state of each filter method, and how long each plugin took to load"""
+    r = {
+      method_type: {f"{step.modname}.{step.name}": step.stats() for step in pipeline}
+      for (method_type, pipeline) in self.pipelines.items()
+    }
+    r['loading'] = {
+      'method_types': sorted(self.loaded),
+      'modules': self.load_times,
+      'rss_kb': rss_bytes() // 1024,
+    }
+    return r
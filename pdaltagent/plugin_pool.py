@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+The plugin pool: one pool of PDAGENTD_PLUGIN_PROCESSES processes per host that runs the filter methods of
+plugins that set cpu_bound = True for all the worker processes. The workers' pool processes are daemonic,
+so they can't start processes of their own, and a pool in each of them would be far too many processes
+anyway. Workers connect to this over a Unix socket (see pdaltagent.plugin_host.PoolClient), and run their
+cpu_bound plugins themselves while it can't be reached.
+
+Run it next to the workers, as the same user (see supervisord.conf):
+
+    python3 -m pdaltagent.plugin_pool
+
+It runs by default, since plugins can be added at any time and it starts no plugin processes until a
+cpu_bound plugin is used; with PDAGENTD_PLUGIN_POOL=false it exits at once.
+"""
+
+import os
+import sys
+import fcntl
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import Listener
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pdaltagent.config import PLUGIN_POOL, PLUGIN_PROCESSES
+from pdaltagent.plugin_host import PLUGIN_POOL_SOCKET, plugin_files, load_cpu_plugins, call_in_process
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+
+class PluginPool:
+    """Serves the calls of the worker processes' cpu_bound plugins from one ProcessPoolExecutor.
+
+    Each connection is handled by a thread that submits its calls to the executor as they arrive and sends
+    each result back when it's done, tagged with the id of the call it's for. The processes load the plugins
+    the workers ask for, and are replaced with new ones when a worker says it has reloaded a cpu_bound
+    plugin whose files have changed since they were started.
+
+    Args:
+        address (str): the Unix socket to listen on
+        processes (int): how many plugin processes to run
+    """
+
+    def __init__(self, address=PLUGIN_POOL_SOCKET, processes=PLUGIN_PROCESSES):
+        self.address = address
+        self.processes = processes
+        self.modnames = set()
+        self.executor = None
+        self.files = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.files = plugin_files()
+                # spawned rather than forked, since this process has a thread for each connection
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=load_cpu_plugins,
+                    initargs=(sorted(self.modnames),),
+                )
+            return self.executor
+
+    def replace_executor(self, executor):
+        """Let the processes of executor exit once they finish the calls they have, so that the next call starts
+        new ones, unless it's been replaced already"""
+        with self.lock:
+            if self.executor is not executor:
+                return
+            self.executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, fn, *args):
+        executor = self.get_executor()
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            # a plugin process died, maybe taking the plugin down with it
+            logger.error("A plugin process exited unexpectedly, starting new ones")
+            self.replace_executor(executor)
+            return self.get_executor().submit(fn, *args)
+
+    def warm(self, modnames, reload=False):
+        """Load the plugins in modnames in the processes, in new processes if reload and the plugins have changed"""
+        with self.lock:
+            self.modnames.update(modnames)
+            executor = self.executor
+        if reload and executor is not None and plugin_files() != self.files:
+            logger.info(f"Plugins changed, starting new plugin processes for {', '.join(sorted(self.modnames))}")
+            self.replace_executor(executor)
+        for _ in range(self.processes):
+            self.submit(load_cpu_plugins, sorted(modnames))
+
+    def handle(self, conn):
+        """Serve the requests on one connection until it's closed"""
+        send_lock = threading.Lock()
+
+        def reply(request_id, ok, value):
+            with send_lock:
+                try:
+                    conn.send((request_id, ok, value))
+                except (OSError, ValueError):
+                    pass
+                except Exception:
+                    # an exception that can't be pickled
+                    conn.send((request_id, False, RuntimeError(str(value))))
+
+        def done(request_id, future):
+            e = future.exception()
+            reply(request_id, e is None, future.result() if e is None else e)
+
+        try:
+            while True:
+                (request_id, kind, args) = conn.recv()
+                try:
+                    if kind == 'call':
+                        future = self.submit(call_in_process, *args)
+                        future.add_done_callback(lambda f, request_id=request_id: done(request_id, f))
+                    elif kind in ('warm', 'reload'):
+                        self.warm(args[0], reload=(kind == 'reload'))
+                        reply(request_id, True, None)
+                    else:
+                        raise ValueError(f"unknown request {kind}")
+                except Exception as e:
+                    reply(request_id, False, e)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def serve(self):
+        """Listen for connections from the workers. Only one plugin pool runs per socket: this waits for the lock
+        on it, so a second one takes over if the first exits"""
+        os.makedirs(os.path.dirname(self.address), exist_ok=True)
+        with open(self.address + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # left by a plugin pool that exited without cleaning up
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            with Listener(self.address, family='AF_UNIX') as listener:
+                os.chmod(self.address, 0o600)
+                logger.info(f"Plugin pool listening on {self.address} with {self.processes} processes")
+                self.get_executor()
+                try:
+                    while True:
+                        try:
+                            conn = listener.accept()
+                        except OSError as e:
+                            logger.error(f"Couldn't accept a plugin pool connection: {e}")
+                            continue
+                        threading.Thread(target=self.handle, args=(conn,), name='plugin-pool-connection', daemon=True).start()
+                finally:
+                    # the plugin processes would otherwise outlive this one
+                    with self.lock:
+                        (executor, self.executor) = (self.executor, None)
+                    if executor is not None:
+                        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def main():
+    if not PLUGIN_POOL:
+        logger.info("The plugin pool is turned off (PDAGENTD_PLUGIN_POOL), cpu_bound plugins run in the workers")
+        sys.exit(0)
+    # supervisord stops programs with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        PluginPool().serve()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import time
+import queue
+import socket
+import datetime
+import inspect
+import logging
+import os
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+
+class TaskMessage:
+    """A Celery task message that was received directly from the broker with kombu,
+    for consumers that want to process many task messages at once instead of running them
+    one at a time in a Celery worker.
+
+    Supports Celery message protocol versions 1 and 2.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        headers = message.headers or {}
+        if 'task' in headers:
+            (self.args, self.kwargs, _embed) = message.decode()
+            self.name = headers['task']
+            self.id = headers.get('id')
+            self.retries = headers.get('retries') or 0
+            eta = headers.get('eta')
+        else:
+            body = message.decode()
+            self.name = body.get('task')
+            self.id = body.get('id')
+            self.args = body.get('args') or []
+            self.kwargs = body.get('kwargs') or {}
+            self.retries = body.get('retries') or 0
+            eta = body.get('eta')
+        self.eta = None
+        if eta:
+            try:
+                self.eta = datetime.datetime.fromisoformat(eta)
+                if self.eta.tzinfo is None:
+                    self.eta = self.eta.replace(tzinfo=datetime.timezone.utc)
+            except (TypeError, ValueError):
+                logger.warning(f"Ignoring invalid eta {eta!r} of task {self.name}[{self.id}]")
+
+    def __repr__(self):
+        return f"{self.name}[{self.id}]"
+
+    def bind(self, task):
+        """Get the task arguments as a dict of parameter name to value, with defaults applied
+
+        Args:
+            task (celery.Task): the task that this message is for
+        """
+        bound = inspect.signature(task.run).bind(*self.args, **self.kwargs)
+        bound.apply_defaults()
+        return bound.arguments
+
+    def seconds_until_due(self):
+        """Seconds until the message's eta, or 0 if it doesn't have one or is already due"""
+        if self.eta is None:
+            return 0
+        return max((self.eta - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+
+    def ack(self):
+        self.message.ack()
+
+    def reject(self):
+        """Reject the message without requeueing it"""
+        self.message.reject(requeue=False)
+
+    def retry(self, task, countdown, **kwargs):
+        """Republish the message to run again after countdown seconds, the same way Task.retry() does,
+        with kwargs added to its keyword arguments, and ack the original"""
+        self.republish(task, countdown, self.retries + 1, kwargs)
+
+    def defer(self, task, countdown, arguments=None, **kwargs):
+        """Republish the message to run again after countdown seconds without counting it as a retry,
+        with kwargs added to its keyword arguments, and ack the original
+
+        Args:
+            arguments (dict, optional): all of the task's arguments by name, to publish instead of the message's
+        """
+        self.republish(task, countdown, self.retries, kwargs, arguments)
+
+    def republish(self, task, countdown, retries, kwargs, arguments=None):
+        if arguments is not None:
+            (args, kwargs) = ((), dict(arguments, **kwargs))
+        else:
+            (args, kwargs) = (self.args, dict(self.kwargs, **kwargs))
+        task.apply_async(
+            args,
+            kwargs,
+            task_id=self.id,
+            retries=retries,
+            countdown=countdown,
+        )
+        self.message.ack()
+
+
+class QueueConsumer:
+    """Consume Celery task messages from queues with plain kombu, reconnecting when the broker
+    connection is lost.
+
+    Args:
+        app (celery.Celery): the Celery app, used for its broker connection and queue declarations
+        queue_names (list): the names of the queues to consume
+        prefetch_count (int): the max number of unacked messages to hold at once
+    """
+
+    def __init__(self, app, queue_names, prefetch_count=1):
+        self.app = app
+        self.queue_names = queue_names
+        self.prefetch_count = prefetch_count
+        self.consumer = None
+        self.calls = queue.SimpleQueue()
+
+    def call_soon_threadsafe(self, fn, *args):
+        """Schedule fn(*args) to run on the consumer thread, which is the only thread that may
+        use the broker channel (to ack, reject or change QoS)"""
+        self.calls.put((fn, args))
+
+    def run_pending_calls(self):
+        while True:
+            try:
+                (fn, args) = self.calls.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(*args)
+            except Exception as e:
+                # most likely the message came from a channel that's gone now, and will be redelivered
+                logger.warning(f"Couldn't run {getattr(fn, '__name__', fn)} on consumer thread: {e}")
+
+    def set_prefetch_count(self, prefetch_count):
+        if prefetch_count != self.prefetch_count:
+            self.prefetch_count = prefetch_count
+            if self.consumer:
+                self.consumer.qos(prefetch_count=prefetch_count)
+
+    def run(self, on_message, on_tick, timeout, on_reset=None):
+        """Consume forever
+
+        Args:
+            on_message (function): called with a TaskMessage for each message received
+            on_tick (function): called after every message received and every time drain_events times out
+            timeout (function): returns the max number of seconds to wait for the next message
+            on_reset (function, optional): called when the connection was lost, so that any unacked messages
+              being held can be forgotten (the broker will redeliver them)
+        """
+
+        def callback(body, message):
+            try:
+                on_message(TaskMessage(message))
+            except Exception as e:
+                logger.error(f"Rejecting message that couldn't be decoded as a Celery task: {e}")
+                message.reject(requeue=False)
+
+        while True:
+            conn = self.app.connection_for_read()
+            try:
+                conn.ensure_connection(max_retries=None)
+                queues = [self.app.amqp.queues[name] for name in self.queue_names]
+                with conn.Consumer(
+                    queues,
+                    callbacks=[callback],
+                    accept=self.app.conf.accept_content,
+                    prefetch_count=self.prefetch_count,
+                ) as consumer:
+                    self.consumer = consumer
+                    logger.info(f"Consuming from {', '.join(self.queue_names)} with prefetch count {self.prefetch_count}")
+                    while True:
+                        try:
+                            conn.drain_events(timeout=max(timeout(), 0.01))
+                        except socket.timeout:
+                            conn.heartbeat_check()
+                        self.run_pending_calls()
+                        on_tick()
+            except conn.connection_errors + conn.channel_errors as e:
+                logger.error(f"Lost connection to broker: {e}, reconnecting...")
+                self.consumer = None
+                if on_reset:
+                    on_reset()
+                time.sleep(1)
+            finally:
+                conn.release()
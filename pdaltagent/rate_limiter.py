@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import email.utils
+import logging
+import threading
+
+import pdaltagent.stats
+from pdaltagent.shared_table import SharedTable
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# events per second allowed per routing key, 0 for no limit
+RATE_LIMIT_PER_ROUTING_KEY = 0
+if os.environ.get("PDAGENTD_RATE_LIMIT_PER_ROUTING_KEY"):
+    try:
+        RATE_LIMIT_PER_ROUTING_KEY = float(os.environ.get("PDAGENTD_RATE_LIMIT_PER_ROUTING_KEY"))
+    except:
+        pass
+
+# how many events can be sent at once to a routing key that has been quiet for a while
+RATE_LIMIT_BURST_PER_ROUTING_KEY = None
+if os.environ.get("PDAGENTD_RATE_LIMIT_BURST_PER_ROUTING_KEY"):
+    try:
+        RATE_LIMIT_BURST_PER_ROUTING_KEY = float(os.environ.get("PDAGENTD_RATE_LIMIT_BURST_PER_ROUTING_KEY"))
+    except:
+        pass
+
+# events per second allowed per destination type, like {"v2": 100, "x-ere": [50, 200]} where [50, 200]
+# means 50 per second with bursts of up to 200
+RATE_LIMITS_PER_INTEGRATION_TYPE = {}
+if os.environ.get("PDAGENTD_RATE_LIMITS_PER_INTEGRATION_TYPE"):
+    try:
+        RATE_LIMITS_PER_INTEGRATION_TYPE = json.loads(os.environ.get("PDAGENTD_RATE_LIMITS_PER_INTEGRATION_TYPE"))
+    except:
+        pass
+
+# how long to hold off a routing key after a 429 response that doesn't have a Retry-After header
+RATE_LIMITED_BACKOFF_SECONDS = 3
+if os.environ.get("PDAGENTD_RATE_LIMITED_BACKOFF_SECONDS"):
+    try:
+        RATE_LIMITED_BACKOFF_SECONDS = float(os.environ.get("PDAGENTD_RATE_LIMITED_BACKOFF_SECONDS"))
+    except:
+        pass
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds from now, or None"""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token buckets per routing key and per destination type, shared by all the processes on this host.
+
+    Before sending an event, call acquire() to take a token from the event's buckets; if it returns a
+    delay, the event should be deferred by that many seconds instead of being sent, with the token
+    reserved for it. When it comes back, call acquire() again with reserved=True, which doesn't take
+    another token but does defer it again if the routing key has been blocked by a 429 in the meantime.
+    When PagerDuty responds with a 429, call rate_limited() so that every process backs off that routing key.
+    """
+
+    def __init__(self, per_routing_key=RATE_LIMIT_PER_ROUTING_KEY, per_routing_key_burst=RATE_LIMIT_BURST_PER_ROUTING_KEY,
+                 per_integration_type=RATE_LIMITS_PER_INTEGRATION_TYPE, backoff=RATE_LIMITED_BACKOFF_SECONDS):
+        self.per_routing_key = (per_routing_key, per_routing_key_burst or max(per_routing_key, 1))
+        self.per_integration_type = {}
+        for (destination_type, limit) in per_integration_type.items():
+            if isinstance(limit, list):
+                self.per_integration_type[destination_type] = (float(limit[0]), float(limit[1]))
+            else:
+                self.per_integration_type[destination_type] = (float(limit), max(float(limit), 1))
+        self.backoff = backoff
+        self.table = None
+        self.table_lock = threading.Lock()
+        self.disabled = False
+        self.counts = {'allowed': 0, 'deferred': 0, 'rate_limited': 0}
+
+    def get_table(self):
+        if self.table is None and not self.disabled:
+            with self.table_lock:
+                if self.table is None:
+                    try:
+                        self.table = SharedTable("rate_limits", ["tokens", "updated", "blocked_until"])
+                    except OSError as e:
+                        logger.error(f"Couldn't create shared rate limit table, rate limiting is disabled: {e}")
+                        self.disabled = True
+        return self.table
+
+    def buckets(self, routing_key, destination_type):
+        """Get the (key, rate, burst) of each bucket that applies to an event. rate 0 means only 429 feedback"""
+        r = [(f"routing_key:{routing_key}", *self.per_routing_key)]
+        if destination_type in self.per_integration_type:
+            r.append((f"destination_type:{destination_type}", *self.per_integration_type[destination_type]))
+        return r
+
+    @staticmethod
+    def refill(record, rate, burst, now):
+        if record['updated'] == 0:
+            record['tokens'] = burst
+        elif rate > 0:
+            # no tokens come in while the key is held off after a 429
+            start = max(record['updated'], min(record['blocked_until'], now))
+            record['tokens'] = min(burst, record['tokens'] + (now - start) * rate)
+        record['updated'] = now
+
+    def acquire(self, routing_key, destination_type="v2", reserved=False):
+        """Take a token for an event. When there aren't any left, the token is reserved anyway by letting the
+        balance go negative, so each deferred event waits for its own place in line instead of all of them
+        coming back at once to find one token between them
+
+        Args:
+            reserved (bool, optional): whether the event was deferred with a token reserved for it already,
+                in which case it only waits out any block from a 429
+
+        Returns:
+            float: 0 if the event can be sent now, otherwise the number of seconds to defer it
+        """
+        table = self.get_table()
+        if table is None:
+            return 0
+        now = time.time()
+        buckets = [(b, *table.slot_for(b[0])) for b in self.buckets(routing_key, destination_type)]
+        if reserved:
+            delay = self.blocked_for(table, buckets, now)
+            self.counts['deferred' if delay > 0 else 'allowed'] += 1
+            return delay
+        with table.locked(*[index for (_, index, _) in buckets]):
+            records = []
+            delay = 0
+            for ((_, rate, burst), index, key_hash) in buckets:
+                (slot_hash, record) = table.read(index)
+                if slot_hash != key_hash:
+                    if rate <= 0:
+                        # nothing to track for this key until it gets a 429
+                        continue
+                    # empty, or another key's bucket that we take over
+                    record = {'tokens': 0, 'updated': 0, 'blocked_until': 0}
+                self.refill(record, rate, burst, now)
+                blocked = max(record['blocked_until'] - now, 0)
+                delay = max(delay, blocked)
+                if rate > 0:
+                    record['tokens'] -= 1
+                    if record['tokens'] < 0:
+                        # in line behind the other reserved tokens, which start coming in when the block ends
+                        delay = max(delay, blocked - record['tokens'] / rate)
+                records.append((index, key_hash, record))
+            for (index, key_hash, record) in records:
+                table.write(index, key_hash, record)
+        if delay > 0:
+            self.counts['deferred'] += 1
+            return delay
+        self.counts['allowed'] += 1
+        return 0
+
+    @staticmethod
+    def blocked_for(table, buckets, now):
+        """The seconds left on the longest 429 block of an event's buckets"""
+        delay = 0
+        for (_, index, key_hash) in buckets:
+            with table.locked(index):
+                (slot_hash, record) = table.read(index)
+            if slot_hash == key_hash:
+                delay = max(delay, record['blocked_until'] - now)
+        return delay
+
+    def rate_limited(self, routing_key, destination_type="v2", retry_after=None):
+        """Record a 429 response for a routing key, so that all processes hold off sending to it
+
+        Args:
+            retry_after (str, optional): the Retry-After header of the response
+
+        Returns:
+            float: the number of seconds that the routing key is blocked for
+        """
+        self.counts['rate_limited'] += 1
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = self.backoff
+        table = self.get_table()
+        if table is None:
+            return delay
+        now = time.time()
+        (rate, burst) = self.per_routing_key
+        (index, key_hash) = table.slot_for(f"routing_key:{routing_key}")
+        with table.locked(index):
+            (slot_hash, record) = table.read(index)
+            if slot_hash != key_hash:
+                record = {'tokens': 0, 'updated': 0, 'blocked_until': 0}
+            self.refill(record, rate, burst, now)
+            # tokens reserved for deferred events stay reserved, so they still go first after the block
+            record['tokens'] = min(record['tokens'], 0)
+            record['blocked_until'] = max(record['blocked_until'], now + delay)
+            table.write(index, key_hash, record)
+        logger.info(f"Routing key {routing_key} was rate limited, holding off for {round(delay, 2)} seconds")
+        return delay
+
+    def stats(self):
+        return dict(self.counts)
+
+
+rate_limiter = RateLimiter()
+pdaltagent.stats.register("rate_limiter", rate_limiter.stats)
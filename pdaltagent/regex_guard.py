@@ -0,0 +1,474 @@
+import os
+import re
+import sys
+import time
+import pickle
+import select
+import signal
+import struct
+import logging
+import threading
+import subprocess
+import contextlib
+import contextvars
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+import pdaltagent.stats
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# max milliseconds for one regex search or substitution
+REGEX_CALL_BUDGET_MS = 100
+if os.environ.get("PDAGENTD_REGEX_CALL_BUDGET_MS"):
+    try:
+        REGEX_CALL_BUDGET_MS = float(os.environ.get("PDAGENTD_REGEX_CALL_BUDGET_MS"))
+    except:
+        pass
+
+# max milliseconds for all the regexes run on one event
+REGEX_EVENT_BUDGET_MS = 1000
+if os.environ.get("PDAGENTD_REGEX_EVENT_BUDGET_MS"):
+    try:
+        REGEX_EVENT_BUDGET_MS = float(os.environ.get("PDAGENTD_REGEX_EVENT_BUDGET_MS"))
+    except:
+        pass
+
+# regex calls slower than this are counted as slow in the stats
+REGEX_SLOW_MS = 10
+if os.environ.get("PDAGENTD_REGEX_SLOW_MS"):
+    try:
+        REGEX_SLOW_MS = float(os.environ.get("PDAGENTD_REGEX_SLOW_MS"))
+    except:
+        pass
+
+# a regex that runs out of time this many times is quarantined (treated as not matching) for a while
+REGEX_QUARANTINE_AFTER = 3
+if os.environ.get("PDAGENTD_REGEX_QUARANTINE_AFTER"):
+    try:
+        REGEX_QUARANTINE_AFTER = int(os.environ.get("PDAGENTD_REGEX_QUARANTINE_AFTER"))
+    except:
+        pass
+
+REGEX_QUARANTINE_SECONDS = 600
+if os.environ.get("PDAGENTD_REGEX_QUARANTINE_SECONDS"):
+    try:
+        REGEX_QUARANTINE_SECONDS = float(os.environ.get("PDAGENTD_REGEX_QUARANTINE_SECONDS"))
+    except:
+        pass
+
+# patterns that look catastrophic get this fraction of the call budget
+SUSPECT_BUDGET_FRACTION = 0.1
+
+# most idle regex worker processes each process keeps for suspect patterns run outside the main thread
+MAX_IDLE_WORKERS = 4
+
+# how long a new regex worker process gets to start
+WORKER_START_SECONDS = 10
+
+# the regex worker: runs (pattern, flags, method, args) requests from its stdin, answering each with
+# (ok, result) on its stdout, where a search's result is where the match starts
+WORKER_CODE = r'''
+import re, sys, pickle, signal, struct
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+(stdin, stdout) = (sys.stdin.buffer, sys.stdout.buffer)
+stdout.write(b"R")
+stdout.flush()
+while True:
+    header = stdin.read(4)
+    if len(header) < 4:
+        break
+    (pattern, flags, method, args) = pickle.loads(stdin.read(struct.unpack("<I", header)[0]))
+    try:
+        regex = re.compile(pattern, flags)
+        if method == "search":
+            match = regex.search(*args)
+            r = (True, match.start() if match else None)
+        else:
+            r = (True, regex.sub(*args))
+    except Exception as e:
+        r = (False, repr(e))
+    data = pickle.dumps(r)
+    stdout.write(struct.pack("<I", len(data)) + data)
+    stdout.flush()
+'''
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+if hasattr(sre_constants, "POSSESSIVE_REPEAT"):
+    REPEATS = REPEATS + (sre_constants.POSSESSIVE_REPEAT,)
+
+
+class RegexTimeout(Exception):
+    pass
+
+
+def catastrophic(pattern, flags=0):
+    """Look for the nested unbounded quantifiers, like (a+)+ or (\\w+\\s?)*, that make a regex backtrack
+    exponentially on input that almost matches
+
+    Returns:
+        str: a description of the problem, or None if the pattern looks safe
+    """
+
+    def walk(items, inside_repeat):
+        for (op, av) in items:
+            if op in REPEATS:
+                (_min, _max, sub) = av
+                unbounded = _max == sre_constants.MAXREPEAT or _max > 100
+                if unbounded and inside_repeat:
+                    return "nested unbounded quantifiers"
+                r = walk(sub, inside_repeat or unbounded)
+                if r:
+                    return r
+            elif op == sre_constants.SUBPATTERN:
+                r = walk(av[-1], inside_repeat)
+                if r:
+                    return r
+            elif op == sre_constants.BRANCH:
+                for branch in av[1]:
+                    r = walk(branch, inside_repeat)
+                    if r:
+                        return r
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                r = walk(av[1], inside_repeat)
+                if r:
+                    return r
+        return None
+
+    try:
+        return walk(sre_parse.parse(pattern, flags), False)
+    except Exception:
+        return None
+
+
+def literal(pattern, flags=0):
+    """Check whether searching for a pattern is the same as looking for a plain string in the text, which is
+    the case for the wildcard patterns (like web-1.*) that most rules use
+
+    Returns:
+        tuple: (anchored, text), where anchored means the text has to be at the start, or None if the pattern
+            needs the regex engine
+    """
+    try:
+        items = list(sre_parse.parse(pattern, flags))
+    except Exception:
+        return None
+    anchored = bool(items) and items[0] == (sre_constants.AT, sre_constants.AT_BEGINNING)
+    if anchored:
+        items = items[1:]
+
+    def any_string(item):
+        (op, av) = item
+        return op in REPEATS[:2] and av[0] == 0 and av[1] == sre_constants.MAXREPEAT and list(av[2]) == [(sre_constants.ANY, None)]
+
+    # a .* at either end doesn't change whether a search matches, except right after a ^
+    while items and any_string(items[-1]):
+        items = items[:-1]
+    while items and not anchored and any_string(items[0]):
+        items = items[1:]
+    if not all(op == sre_constants.LITERAL for (op, av) in items):
+        return None
+    return (anchored, "".join(chr(av) for (op, av) in items))
+
+
+class RegexWorker:
+    """A process for running regexes in, which can be killed when one runs out of time, unlike a thread
+
+    Raises:
+        OSError: if the process couldn't be started
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, "-c", WORKER_CODE], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            if self.read(1, time.monotonic() + WORKER_START_SECONDS) != b"R":
+                raise OSError("the regex worker didn't start")
+        except (RegexTimeout, EOFError) as e:
+            self.kill()
+            raise OSError(f"the regex worker didn't start: {e}") from None
+
+    def run(self, regex, method, args, budget):
+        """Run regex.method(*args) in the process
+
+        Returns:
+            tuple: (ok, result), where result is where the match starts for a search, and an error message if not ok
+
+        Raises:
+            RegexTimeout: if it took more than budget seconds, in which case the process has to be killed
+            OSError, EOFError: if the process has died
+        """
+        data = pickle.dumps((regex.pattern, regex.flags, method, args))
+        deadline = time.monotonic() + budget
+        self.process.stdin.write(struct.pack("<I", len(data)) + data)
+        self.process.stdin.flush()
+        size = struct.unpack("<I", self.read(4, deadline))[0]
+        return pickle.loads(self.read(size, deadline))
+
+    def read(self, size, deadline):
+        fd = self.process.stdout.fileno()
+        data = b""
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise RegexTimeout("regex ran out of time")
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                raise EOFError("the regex worker exited")
+            data += chunk
+        return data
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+        except OSError:
+            pass
+
+
+class RegexGuard:
+    """Runs regexes with a time budget per call and per event, and keeps stats per pattern.
+
+    In the main thread, a call that runs over its budget is interrupted with SIGALRM. Other threads (plugin
+    threads, and the ones the async sender runs synchronous filters in) can't be interrupted, so there
+    patterns that look catastrophic are run in a RegexWorker process, which is killed when they run out of
+    time. The budgets of other patterns are only advisory outside the main thread: their time is measured
+    and counted against them, but a call isn't stopped when it runs over, and these calls are counted as
+    advisory_budget_calls in the stats. A pattern that runs out of time REGEX_QUARANTINE_AFTER times is
+    quarantined for REGEX_QUARANTINE_SECONDS, so one bad rule can't keep stalling the queue. Patterns are
+    checked for catastrophic backtracking when they're first compiled, and suspect ones get a smaller budget.
+    """
+
+    def __init__(self, call_budget_ms=REGEX_CALL_BUDGET_MS, event_budget_ms=REGEX_EVENT_BUDGET_MS, slow_ms=REGEX_SLOW_MS,
+                 quarantine_after=REGEX_QUARANTINE_AFTER, quarantine_seconds=REGEX_QUARANTINE_SECONDS):
+        self.call_budget = call_budget_ms / 1000
+        self.event_budget = event_budget_ms / 1000
+        self.slow = slow_ms / 1000
+        self.quarantine_after = quarantine_after
+        self.quarantine_seconds = quarantine_seconds
+        self.compiled = {}
+        self.rules = {}
+        # [deadline, warned] for the event being processed; a context variable rather than a thread local,
+        # so it follows the event into plugin threads and doesn't leak between coroutines
+        self.current_event = contextvars.ContextVar('regex_guard_event', default=None)
+        self.armed = False
+        self.previous_handler = None
+        self.alarm_pid = None
+        # idle RegexWorkers, and the process they belong to, since forked processes can't share them
+        self.workers = []
+        self.workers_pid = None
+        self.workers_lock = threading.Lock()
+        self.counts = {
+            'calls': 0, 'timeouts': 0, 'event_budget_exceeded': 0, 'quarantined_calls': 0,
+            'advisory_budget_calls': 0, 'worker_calls': 0, 'workers_killed': 0,
+        }
+
+    def rule(self, regex):
+        key = (regex.pattern, regex.flags)
+        r = self.rules.get(key)
+        if r is None:
+            r = self.rules[key] = {
+                'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'slow': 0, 'timeouts': 0,
+                'suspect': catastrophic(regex.pattern, regex.flags), 'quarantined_until': 0,
+            }
+        return r
+
+    def compile(self, pattern, flags=0):
+        """Compile a pattern, checking it for catastrophic backtracking the first time it's seen. Raises re.error"""
+        key = (pattern, flags)
+        regex = self.compiled.get(key)
+        if regex is None:
+            regex = re.compile(pattern, flags)
+            if len(self.compiled) >= 10000:
+                self.compiled.clear()
+            self.compiled[key] = regex
+            r = self.rule(regex)
+            if r['suspect']:
+                logger.warning(f"Regex {pattern!r} may backtrack catastrophically ({r['suspect']}), limiting it to {round(self.call_budget * SUSPECT_BUDGET_FRACTION * 1000)}ms per call")
+        return regex
+
+    @contextlib.contextmanager
+    def event(self, count=1):
+        """Run everything inside with a shared time budget for all the regexes of one event, or of count events"""
+        if self.current_event.get() is not None:
+            # already inside an event
+            yield
+            return
+        token = self.current_event.set([time.monotonic() + self.event_budget * count, False])
+        try:
+            yield
+        finally:
+            self.current_event.reset(token)
+
+    def on_alarm(self, signum, frame):
+        if self.armed:
+            self.armed = False
+            raise RegexTimeout("regex ran out of time")
+        if callable(self.previous_handler):
+            self.previous_handler(signum, frame)
+
+    def install_alarm(self):
+        # installed once per process and left in place, since swapping signal handlers on every
+        # call costs more than most regexes do; alarms that aren't ours go to the previous handler
+        if self.alarm_pid != os.getpid():
+            self.alarm_pid = os.getpid()
+            self.previous_handler = signal.signal(signal.SIGALRM, self.on_alarm)
+
+    def run(self, regex, method, *args):
+        """Call regex.method(*args) within the budget. Raises RegexTimeout"""
+        r = self.rule(regex)
+        self.counts['calls'] += 1
+        now = time.monotonic()
+        if r['quarantined_until'] > now:
+            self.counts['quarantined_calls'] += 1
+            raise RegexTimeout(f"regex {regex.pattern!r} is quarantined")
+        budget = self.call_budget * (SUSPECT_BUDGET_FRACTION if r['suspect'] else 1)
+        event = self.current_event.get()
+        if event is not None:
+            deadline = event[0]
+            if deadline <= now:
+                self.counts['event_budget_exceeded'] += 1
+                if not event[1]:
+                    event[1] = True
+                    logger.warning(f"Regexes used up the {round(self.event_budget * 1000)}ms budget for this event, skipping the rest")
+                raise RegexTimeout("event regex budget used up")
+            budget = min(budget, deadline - now)
+
+        # only the main thread gets signals, and don't get in the way of anyone else's timer
+        use_alarm = threading.current_thread() is threading.main_thread() and signal.getitimer(signal.ITIMER_REAL)[0] == 0
+        # elsewhere, nothing can stop a regex, so the suspect ones are run in a process that can be killed
+        worker = None
+        if not use_alarm and r['suspect'] and (method == 'search' or isinstance(args[0], str)):
+            worker = self.take_worker()
+        if use_alarm:
+            self.install_alarm()
+            self.armed = True
+            signal.setitimer(signal.ITIMER_REAL, budget)
+        elif worker is None:
+            self.counts['advisory_budget_calls'] += 1
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            if worker is not None:
+                return self.run_in_worker(worker, regex, method, args, budget)
+            return getattr(regex, method)(*args)
+        except RegexTimeout:
+            timed_out = True
+            raise
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                self.armed = False
+            elapsed = time.perf_counter() - start
+            r['calls'] += 1
+            r['seconds'] += elapsed
+            r['max_seconds'] = max(r['max_seconds'], elapsed)
+            if elapsed > self.slow:
+                r['slow'] += 1
+            if timed_out or elapsed > budget:
+                # in other threads we can't stop it, but it still counts against the pattern
+                self.timed_out(regex, r, elapsed)
+
+    def take_worker(self):
+        """An idle RegexWorker, or a new one (which isn't timed against the regex's budget)
+
+        Returns:
+            RegexWorker: the worker, or None if one couldn't be started
+        """
+        with self.workers_lock:
+            if self.workers_pid != os.getpid():
+                # the parent's workers, which are the parent's to use
+                (self.workers, self.workers_pid) = ([], os.getpid())
+            if self.workers:
+                return self.workers.pop()
+        try:
+            return RegexWorker()
+        except OSError as e:
+            logger.warning(f"Couldn't start a regex worker ({e}), running suspect regexes here without a time limit")
+            return None
+
+    def run_in_worker(self, worker, regex, method, args, budget):
+        """Call regex.method(*args) in a RegexWorker, killing it if it runs out of time. Raises RegexTimeout"""
+        try:
+            self.counts['worker_calls'] += 1
+            (ok, result) = worker.run(regex, method, args, budget)
+        except RegexTimeout:
+            self.counts['workers_killed'] += 1
+            worker.kill()
+            raise
+        except (OSError, EOFError, ValueError, pickle.PickleError) as e:
+            worker.kill()
+            logger.warning(f"Couldn't run regex {regex.pattern!r} in a regex worker ({e}), running it here without a time limit")
+            self.counts['advisory_budget_calls'] += 1
+            return getattr(regex, method)(*args)
+        with self.workers_lock:
+            if len(self.workers) < MAX_IDLE_WORKERS and self.workers_pid == os.getpid():
+                self.workers.append(worker)
+                worker = None
+        if worker is not None:
+            worker.kill()
+        if not ok:
+            # raise the same error here
+            return getattr(regex, method)(*args)
+        if method == 'search':
+            # the worker found where it matches, so the match object is made here, from that position, in the
+            # time that matching took there
+            return None if result is None else regex.search(args[0], result)
+        return result
+
+    def timed_out(self, regex, r, elapsed):
+        self.counts['timeouts'] += 1
+        r['timeouts'] += 1
+        logger.warning(f"Regex {regex.pattern!r} ran out of time after {round(elapsed * 1000)}ms")
+        if r['timeouts'] % self.quarantine_after == 0:
+            r['quarantined_until'] = time.monotonic() + self.quarantine_seconds
+            logger.error(f"Quarantining regex {regex.pattern!r} for {self.quarantine_seconds} seconds after {r['timeouts']} timeouts")
+
+    def search(self, pattern, string, flags=0):
+        """re.search within the budget, returning None if it runs out of time or is quarantined. Raises re.error"""
+        regex = pattern if isinstance(pattern, re.Pattern) else self.compile(pattern, flags)
+        try:
+            return self.run(regex, 'search', string)
+        except RegexTimeout:
+            return None
+
+    def sub(self, regex, repl, string):
+        """regex.sub within the budget. Raises RegexTimeout"""
+        return self.run(regex, 'sub', repl, string)
+
+    def stats(self):
+        now = time.monotonic()
+        worst = sorted(
+            [(key, r) for (key, r) in list(self.rules.items()) if r['slow'] or r['timeouts']],
+            key=lambda x: x[1]['max_seconds'],
+            reverse=True,
+        )[:20]
+        return dict(
+            self.counts,
+            slow_rules=[
+                {
+                    'pattern': key[0][:100],
+                    'calls': r['calls'],
+                    'slow': r['slow'],
+                    'timeouts': r['timeouts'],
+                    'avg_ms': round(r['seconds'] / max(r['calls'], 1) * 1000, 2),
+                    'max_ms': round(r['max_seconds'] * 1000, 2),
+                    'suspect': r['suspect'],
+                    'quarantined': r['quarantined_until'] > now,
+                }
+                for (key, r) in worst
+            ],
+        )
+
+
+regex_guard = RegexGuard()
+pdaltagent.stats.register("regex_guard", regex_guard.stats)
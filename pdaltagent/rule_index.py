@@ -0,0 +1,97 @@
+import heapq
+
+
+class RuleIndex:
+    """
+    An index of an ordered list of rules on the values their conditions require, so that an event
+    only visits the rules it may match instead of all of them.
+
+    A rule is indexed on one path and the (case-folded) values its condition can't be true without
+    the value at that path being one of; the rest have no such test (regexes, negations, ORs) and are
+    visited for every event. Visiting a rule still means checking its whole condition.
+
+    Args:
+        keys (list): for each rule, None, or a (path, get, values) tuple where get is a function of the
+          event that returns the value at path and values is the set of values that rule requires
+    """
+
+    def __init__(self, keys):
+        self.size = len(keys)
+        self.always = []
+        self.getters = {}
+        self.indexes = {}
+        for (position, key) in enumerate(keys):
+            if key is None:
+                self.always.append(position)
+                continue
+            (path, get, values) = key
+            self.getters.setdefault(path, get)
+            index = self.indexes.setdefault(path, {})
+            for value in values:
+                index.setdefault(value, []).append(position)
+        self.getters = list(self.getters.items())
+
+    @staticmethod
+    def index_value(value):
+        """
+        The form of an event's value that the index is looked up by, which is what BPQL = compares.
+        """
+        if value is None:
+            return None
+        return str(value).lower()
+
+    def candidates(self, entity):
+        """
+        The positions of the rules that entity may match, in order, as a Candidates iterator.
+        """
+        return Candidates(self, entity)
+
+    def stats(self):
+        return {
+            'rules': self.size,
+            'always_checked': len(self.always),
+            'indexed_paths': sorted(self.indexes),
+        }
+
+
+class Candidates:
+    """
+    Iterates over the positions of the rules an event may match, in order. Applying a rule can change
+    the event, so the caller says so with changed(), and then rules further on that the new values
+    may match are visited too.
+    """
+
+    def __init__(self, index, entity):
+        self.index = index
+        self.entity = entity
+        self.position = -1
+        self.values = {}
+        queued = set(index.always)
+        for (path, get) in index.getters:
+            value = self.values[path] = index.index_value(get(entity))
+            queued.update(index.indexes[path].get(value, ()))
+        self.queued = queued
+        self.heap = sorted(queued)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.heap:
+            raise StopIteration
+        self.position = heapq.heappop(self.heap)
+        return self.position
+
+    def changed(self):
+        """
+        Read the indexed values of the event again, after the rule at the current position changed it.
+        """
+        index = self.index
+        for (path, get) in index.getters:
+            value = index.index_value(get(self.entity))
+            if value != self.values[path]:
+                self.values[path] = value
+                for p in index.indexes[path].get(value, ()):
+                    if p > self.position and p not in self.queued:
+                        self.queued.add(p)
+                        heapq.heappush(self.heap, p)
@@ -10,16 +10,48 @@ class Plugin():
     filter_webhooks - to filter reconstructed webhooks from PagerDuty
     fetch_events - to go get events from somewhere and send them to PagerDuty at some interval
 
+  Instead of filter_event, you can implement filter_events, which gets a list of events (and
+  optionally a list of their routing keys and a list of their destination types) and returns a
+  list with what filter_event would have returned for each one. The batch sender calls it with
+  a whole batch at once, so you can look up everything the batch needs in one query; everywhere
+  else it's called with one event at a time. filter_webhooks works the same way for webhooks.
+
+  Any of these methods can be defined with async def instead, if it spends its time waiting on
+  other systems. Async methods are cancelled if they take longer than `self.timeout` seconds
+  (default PDAGENTD_PLUGIN_TIMEOUT_SECONDS, or 30), and the event goes on without their changes.
+  Synchronous filter methods run inline, and only count as timed out once they return, so a hung
+  one holds up its worker. If yours may hang, set `self.threaded = True` (setting `self.timeout`
+  does this too): they then run in a separate thread that's given up on after that long, at the
+  cost of a thread handoff on every call. Either way, a filter method
+  that times out or raises PDAGENTD_PLUGIN_BREAKER_FAILURES times in a row is skipped for a while,
+  and events that it was skipped for get a note in payload.custom_details.pdaltagent_skipped_plugins.
+
+  If your filter methods spend their time computing rather than waiting (parsing, big regexes, ML
+  models), set `self.cpu_bound = True`. They're then run in the plugin pool, which is
+  PDAGENTD_PLUGIN_PROCESSES separate processes shared by all the workers, so they don't hold up
+  the other plugins or each other. Each of those processes imports your module and creates its own
+  Plugin(), so don't count on state shared with the worker, and events and return values have to be
+  picklable (plain dicts, lists and strings are best).
+
   This module will get imported inside the Python environment where PDaltagent is running. If
   you're running in Docker and you need to use other pip packages, use the `add_pip_pkg` command
   that's installed in /usr/local/bin. This installs pip packages in an include directory that's mounted at
   ./pdaltagent_pdagentd/plugins/lib outside the container (see the docker-compose.yml for details)
+
+  When you add, change or remove a plugin file, the running workers reload it within a few seconds
+  (see PDAGENTD_PLUGIN_WATCH_SECONDS). Plugins in other files keep their Plugin instance. If the new
+  file can't be imported or its Plugin can't be created, the workers keep using the plugins they had.
   """
 
   def __init__(self):
     """
     Do your plugin initialization here.
 
+    A process only creates your Plugin when it first needs one of the methods it implements, so
+    an event worker doesn't create plugins that only have filter_webhook, and the beat scheduler
+    only creates the ones with fetch_events. Define those methods in the class (not by assigning
+    them in __init__) so they can be found before the Plugin is created.
+
     If you implement a fetch_events method, PDaltagent will call it every `self.fetch_interval` seconds.
     If you don't set `self.fetch_interval`, it will default to PDAGENTD_POLLING_INTERVAL_SECONDS env var
     or 10 seconds if you haven't set that.
@@ -28,6 +60,10 @@ class Plugin():
 
     `self.order` specifies the order in which this class's filter_event and filter_webhook
     methods will run, if you implement those. Lower comes before higher.
+
+    Filter methods get the event or webhook that the previous filter returned, not a copy of it.
+    If your filter changes it in place and might fail partway through, set `self.isolate = True`
+    to get a copy, so that the next filter doesn't see a half-changed event.
     """
 
     self.order = 100
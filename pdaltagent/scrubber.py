@@ -1,5 +1,12 @@
-import json
+import os
 import re
+import sys
+import hashlib
+import threading
+import collections
+
+import pdaltagent.stats
+from pdaltagent.regex_guard import regex_guard, RegexTimeout
 
 # adapted from https://github.com/madisonmay/CommonRegex
 
@@ -39,15 +46,202 @@ regexes = {
     "ssn_number"      : ssn
 }
 
+# characters that a string has to contain for each pattern to have any chance of matching it, so that
+# most strings can skip most patterns without running them
+# (all the characters that \d matches, which aren't only 0-9)
+DIGITS = frozenset(c for c in map(chr, range(sys.maxunicode + 1)) if c.isdecimal())
+prefilters = {
+    "email_address"   : set("@"),
+    "ip_address"      : set("."),
+    "ipv6_address"    : set(":"),
+    "phone"           : DIGITS,
+    "phone_with_ext"  : DIGITS,
+    "link"            : set("."),
+    "price"           : set("$"),
+    "hex_color"       : set("#"),
+    "credit_card"     : DIGITS,
+    "btc_address"     : set("13"),
+    "street_address"  : DIGITS,
+    "zip_code"        : DIGITS,
+    "po_box"          : DIGITS,
+    "ssn_number"      : DIGITS,
+}
+PREFILTER = set().union(*prefilters.values())
+
+# paths that are never scrubbed, and paths whose values are always replaced, like "payload.custom_details.*.password".
+# a path covers everything under it, and * matches any key or list index
+SCRUB_PII_ALLOW_PATHS = ["routing_key"]
+if os.environ.get("PDAGENTD_SCRUB_PII_ALLOW_PATHS") is not None:
+    SCRUB_PII_ALLOW_PATHS = [x.strip() for x in os.environ.get("PDAGENTD_SCRUB_PII_ALLOW_PATHS").split(",") if x.strip()]
+
+SCRUB_PII_DENY_PATHS = []
+if os.environ.get("PDAGENTD_SCRUB_PII_DENY_PATHS"):
+    SCRUB_PII_DENY_PATHS = [x.strip() for x in os.environ.get("PDAGENTD_SCRUB_PII_DENY_PATHS").split(",") if x.strip()]
+
+REDACTED = "{{REDACTED}}"
+
+# how many scrubbed strings to remember, and how many bytes of strings, 0 to turn the cache off
+SCRUB_PII_CACHE_SIZE = 10000
+if os.environ.get("PDAGENTD_SCRUB_PII_CACHE_SIZE"):
+    try:
+        SCRUB_PII_CACHE_SIZE = int(os.environ.get("PDAGENTD_SCRUB_PII_CACHE_SIZE"))
+    except:
+        pass
+
+SCRUB_PII_CACHE_BYTES = 32 * 1024 * 1024
+if os.environ.get("PDAGENTD_SCRUB_PII_CACHE_BYTES"):
+    try:
+        SCRUB_PII_CACHE_BYTES = int(os.environ.get("PDAGENTD_SCRUB_PII_CACHE_BYTES"))
+    except:
+        pass
+
+# strings longer than this are scrubbed every time, so one big log blob can't flush the whole cache
+SCRUB_PII_CACHE_MAX_STRING = 64 * 1024
+
+
+class StringCache:
+    """LRU cache of original string to scrubbed string, keyed by a hash of the original.
+
+    The original string is kept with each entry and compared on every hit, so a hash collision is a
+    miss instead of a wrong answer, and cached results are always exactly what scrubbing would return.
+    If scrubbing raises, nothing is cached and the exception goes to the caller.
+
+    Args:
+        max_entries (int): most strings to keep
+        max_bytes (int): most bytes of original plus scrubbed strings to keep (counting characters)
+    """
+
+    def __init__(self, max_entries=SCRUB_PII_CACHE_SIZE, max_bytes=SCRUB_PII_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'uncacheable': 0}
+
+    @staticmethod
+    def key(string):
+        return hashlib.blake2b(string.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def get_or_compute(self, string, compute):
+        if self.max_entries <= 0 or len(string) > SCRUB_PII_CACHE_MAX_STRING:
+            self.counts['uncacheable'] += 1
+            return compute(string)
+        key = self.key(string)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == string:
+                self.entries.move_to_end(key)
+                self.counts['hits'] += 1
+                return entry[1]
+        self.counts['misses'] += 1
+        r = compute(string)
+        size = len(string) + len(r)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[0]) + len(old[1])
+            self.entries[key] = (string, r)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                (_key, (evicted, evicted_r)) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted) + len(evicted_r)
+                self.counts['evictions'] += 1
+        return r
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, entries=len(self.entries), bytes=self.bytes)
+
+ALLOW = "allow"
+DENY = "deny"
+
+
+class Scrubber:
+    """Scrubs PII out of the string values of an event, leaving its keys, numbers and structure alone.
+
+    Each string runs through the patterns in the same order as the regexes dict, skipping the
+    patterns that can't match because the string doesn't have any of their prefilter characters.
+
+    Args:
+        allow_paths (list): paths that aren't scrubbed
+        deny_paths (list): paths whose string values are replaced with {{REDACTED}}
+        cache (StringCache, optional): cache for scrubbed strings
+    """
+
+    def __init__(self, allow_paths=SCRUB_PII_ALLOW_PATHS, deny_paths=SCRUB_PII_DENY_PATHS, cache=None):
+        self.cache = cache
+        self.patterns = [(regex, f"{{{{{name.upper()}}}}}", prefilters.get(name)) for (name, regex) in regexes.items()]
+        # deny wins over allow when both match the same path
+        self.rules = [(tuple(p.split(".")), DENY) for p in deny_paths] + [(tuple(p.split(".")), ALLOW) for p in allow_paths]
+
+    def scrub_string(self, string):
+        if PREFILTER.isdisjoint(string):
+            return string
+        try:
+            if self.cache is not None:
+                return self.cache.get_or_compute(string, self.apply_patterns)
+            return self.apply_patterns(string)
+        except RegexTimeout:
+            # couldn't tell what's in it, so don't let it through. This isn't cached, since the same
+            # string may well be scrubbed in time for an event that hasn't used up its regex budget
+            return REDACTED
+
+    def apply_patterns(self, string):
+        """Raises RegexTimeout if the patterns run out of time"""
+        for (regex, replacement, prefilter) in self.patterns:
+            if prefilter is None or not prefilter.isdisjoint(string):
+                string = regex_guard.sub(regex, replacement, string)
+        return string
+
+    def descend(self, rules, key):
+        """Advance the rules that are still matching the path by one key
+
+        Returns:
+            tuple: (decision, rules) where decision is ALLOW or DENY if a rule matched the whole path
+        """
+        key = str(key)
+        remaining = []
+        for (segments, action, depth) in rules:
+            if segments[depth] == "*" or segments[depth] == key:
+                if depth + 1 == len(segments):
+                    return (action, [])
+                remaining.append((segments, action, depth + 1))
+        return (None, remaining)
+
+    def walk(self, value, rules, decision):
+        if isinstance(value, str):
+            if decision == DENY:
+                return REDACTED
+            if decision == ALLOW:
+                return value
+            return self.scrub_string(value)
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            return value
+        r = {} if isinstance(value, dict) else []
+        for (key, child) in items:
+            (child_decision, child_rules) = (decision, [])
+            if decision is None and rules:
+                (child_decision, child_rules) = self.descend(rules, key)
+            child = self.walk(child, child_rules, child_decision)
+            if isinstance(r, dict):
+                r[key] = child
+            else:
+                r.append(child)
+        return r
+
+    def scrub(self, body):
+        """Return a scrubbed copy of an event"""
+        with regex_guard.event():
+            return self.walk(body, [(segments, action, 0) for (segments, action) in self.rules], None)
+
+
+scrubber = Scrubber(cache=StringCache())
+pdaltagent.stats.register("scrubber_cache", scrubber.cache.stats)
+
 def scrub(body_in):
-    body = dict(body_in)
-    routing_key = None
-    if 'routing_key' in body:
-        routing_key = body['routing_key']
-    string = json.dumps(body)
-    for (name, regex) in regexes.items():
-        string = regex.sub(f"{{{{{name.upper()}}}}}", string)
-    body = json.loads(string)
-    if routing_key:
-        body['routing_key'] = routing_key
-    return body
+    return scrubber.scrub(body_in)
@@ -0,0 +1,95 @@
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+import tempfile
+import contextlib
+
+# Directory for state shared between all the worker and listener processes on this host
+SHARED_DIR = os.environ.get("PDAGENTD_SHARED_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "pdaltagent"
+)
+
+MAGIC = b"PDSHTBL1"
+HEADER = struct.Struct("<8sII")
+
+
+class SharedTable:
+    """A fixed-size hash table of float records in a memory-mapped file, shared between processes.
+
+    Each slot holds a 64-bit key hash followed by len(fields) doubles, and can be locked on its own
+    with a POSIX record lock, so processes only contend when they use the same slot. There is no
+    probing: keys that hash to the same slot share it, and callers check the stored key hash to find
+    out whether a slot holds their key or someone else's.
+
+    Args:
+        name (str): file name of the table in SHARED_DIR
+        fields (list): names of the float fields in each record
+        slots (int): number of slots
+    """
+
+    def __init__(self, name, fields, slots=4096):
+        self.fields = list(fields)
+        self.slots = slots
+        self.record = struct.Struct("<Q" + "d" * len(self.fields))
+        self.size = HEADER.size + self.record.size * self.slots
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        self.path = os.path.join(SHARED_DIR, name)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, HEADER.size, 0)
+            if len(header) < HEADER.size or HEADER.unpack(header) != (MAGIC, len(self.fields), self.slots) \
+                    or os.fstat(self.fd).st_size != self.size:
+                # new file, or one made with a different layout
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, len(self.fields), self.slots), 0)
+                try:
+                    # the listener and the workers run as different users
+                    os.fchmod(self.fd, 0o666)
+                except OSError:
+                    pass
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self.fd, self.size)
+        # record locks are per process, so threads in this process also need to take this
+        self.thread_lock = threading.Lock()
+
+    @staticmethod
+    def key_hash(key):
+        # 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def slot_for(self, key):
+        """Get the (slot index, key hash) for a key"""
+        h = self.key_hash(key)
+        return (h % self.slots, h)
+
+    def offset(self, index):
+        return HEADER.size + index * self.record.size
+
+    @contextlib.contextmanager
+    def locked(self, *indexes):
+        """Lock slots for a read-modify-write. Always locks in index order, so it can't deadlock"""
+        indexes = sorted(set(indexes))
+        with self.thread_lock:
+            for index in indexes:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, self.record.size, self.offset(index))
+            try:
+                yield
+            finally:
+                for index in reversed(indexes):
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, self.record.size, self.offset(index))
+
+    def read(self, index):
+        """Read a slot, returning (key hash, dict of fields)"""
+        values = self.record.unpack_from(self.mm, self.offset(index))
+        return (values[0], dict(zip(self.fields, values[1:])))
+
+    def write(self, index, key_hash, values):
+        """Write a slot from a key hash and a dict of fields"""
+        self.record.pack_into(self.mm, self.offset(index), key_hash, *[float(values.get(f, 0)) for f in self.fields])
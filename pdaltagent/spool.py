@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import pdaltagent.stats
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+if os.getenv('PDAGENTD_DEBUG'):
+    logger.level = logging.DEBUG
+
+# where the listener spools events that it can't publish to the broker; empty to turn spooling off
+SPOOL_DIR = "/var/spool/pdaltagent"
+if os.environ.get("PDAGENTD_SPOOL_DIR") is not None:
+    SPOOL_DIR = os.environ.get("PDAGENTD_SPOOL_DIR")
+
+# how big a spool segment file gets before a new one is started
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+if os.environ.get("PDAGENTD_SPOOL_SEGMENT_BYTES"):
+    try:
+        SPOOL_SEGMENT_BYTES = int(os.environ.get("PDAGENTD_SPOOL_SEGMENT_BYTES"))
+    except:
+        pass
+
+# how long to wait for more writes to share an fsync of the spool
+SPOOL_FSYNC_MS = 20
+if os.environ.get("PDAGENTD_SPOOL_FSYNC_MS"):
+    try:
+        SPOOL_FSYNC_MS = float(os.environ.get("PDAGENTD_SPOOL_FSYNC_MS"))
+    except:
+        pass
+
+# how long a publish to the broker can take before the event is spooled instead
+PUBLISH_TIMEOUT_MS = 500
+if os.environ.get("PDAGENTD_PUBLISH_TIMEOUT_MS"):
+    try:
+        PUBLISH_TIMEOUT_MS = float(os.environ.get("PDAGENTD_PUBLISH_TIMEOUT_MS"))
+    except:
+        pass
+
+
+class Spool:
+    """A write-ahead spool for events that couldn't be published to the broker.
+
+    Events are appended as JSON lines to segment files in SPOOL_DIR, one active segment per process,
+    and writers that arrive within SPOOL_FSYNC_MS of each other share an fsync. Once anything is
+    spooled, the process keeps spooling until the spool has been drained, so its events still reach
+    the broker in order. A drainer thread replays closed segments (including those left behind by
+    other processes) into the broker once it's reachable again, and deletes them.
+
+    A publish that times out may still reach the broker, so an event can be delivered twice around
+    an outage, but it won't be lost.
+
+    Args:
+        publish (function): publish(routing_key, payload, destination_type, task_id) to the broker
+        spool_dir (str): directory for the segment files
+    """
+
+    def __init__(self, publish, spool_dir=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES,
+                 fsync_ms=SPOOL_FSYNC_MS, publish_timeout_ms=PUBLISH_TIMEOUT_MS):
+        self.publish_fn = publish
+        self.spool_dir = spool_dir
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_ms / 1000
+        self.publish_timeout = publish_timeout_ms / 1000
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='spool_publish')
+        self.cond = threading.Condition()
+        self.spooling = False
+        self.file = None
+        self.segment = 0
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        self.last_failure = 0
+        self.counts = {'published': 0, 'spooled': 0, 'replayed': 0, 'publish_timeouts': 0}
+        self.drainer = threading.Thread(target=self.drain_forever, name='spool_drainer', daemon=True)
+        self.drainer.start()
+
+    # writing
+
+    def publish(self, routing_key, payload, destination_type):
+        """Publish an event to the broker, or spool it if the broker is down or too slow"""
+        with self.cond:
+            spooling = self.spooling
+        if not spooling:
+            try:
+                self.executor.submit(self.publish_fn, routing_key, payload, destination_type, None).result(self.publish_timeout)
+                self.counts['published'] += 1
+                return
+            except TimeoutError:
+                self.counts['publish_timeouts'] += 1
+                self.failed(f"publishing took more than {self.publish_timeout}s")
+            except Exception as e:
+                self.failed(e)
+        self.append(routing_key, payload, destination_type)
+
+    def failed(self, reason):
+        """Record a failed publish, so that events are spooled until the broker is back"""
+        with self.cond:
+            if not self.spooling:
+                logger.warning(f"Couldn't publish to the broker: {reason}, spooling events")
+            self.spooling = True
+            self.last_failure = time.monotonic()
+
+    def append(self, routing_key, payload, destination_type):
+        """Write an event to the spool and wait until it's on disk"""
+        line = json.dumps({
+            'id': str(uuid.uuid4()),
+            'routing_key': routing_key,
+            'payload': payload,
+            'destination_type': destination_type,
+        }).encode() + b"\n"
+        with self.cond:
+            self.spooling = True
+            if self.file is None:
+                self.open_segment()
+            self.file.write(line)
+            self.file.flush()
+            self.written += 1
+            mine = self.written
+            while self.synced < mine:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                # lead an fsync for everyone who writes in the next fsync interval
+                self.syncing = True
+                self.cond.wait(self.fsync_interval)
+                target = self.written
+                fd = self.file.fileno()
+                self.cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self.cond.acquire()
+                    self.synced = max(self.synced, target)
+                    self.syncing = False
+                    self.cond.notify_all()
+            self.counts['spooled'] += 1
+            if self.file is not None and self.file.tell() >= self.segment_bytes:
+                self.close_segment()
+
+    def open_segment(self):
+        self.segment += 1
+        name = f"{int(time.time() * 1000):013d}-{os.getpid()}-{self.segment}.spool"
+        self.file = open(os.path.join(self.spool_dir, name), "ab")
+        # held until the segment is closed, so drainers leave it alone while it's being written
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def close_segment(self):
+        """Close the active segment so it can be drained. Must hold self.cond"""
+        while self.syncing:
+            self.cond.wait()
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            self.synced = self.written
+            self.cond.notify_all()
+
+    # draining
+
+    def segments(self):
+        return sorted(f for f in os.listdir(self.spool_dir) if f.endswith(".spool"))
+
+    def drain_segment(self, name):
+        """Replay a segment into the broker and delete it, if no one else is writing or draining it
+
+        Returns:
+            bool: False if the broker couldn't be reached
+        """
+        path = os.path.join(self.spool_dir, name)
+        offset_path = path + ".offset"
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return True
+        with f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            if not os.path.exists(path):
+                # someone else finished draining it between listdir and flock
+                return True
+            try:
+                with open(offset_path) as o:
+                    f.seek(int(o.read() or 0))
+            except (FileNotFoundError, ValueError):
+                pass
+            replayed = 0
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    # torn write from a process that died mid-append
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.error(f"Skipping corrupt record in spool segment {name}")
+                    continue
+                try:
+                    self.executor.submit(self.publish_fn, record['routing_key'], record['payload'],
+                                         record['destination_type'], record['id']).result(self.publish_timeout)
+                except Exception as e:
+                    logger.debug(f"Broker still unavailable, stopping spool drain: {e!r}")
+                    self.last_failure = time.monotonic()
+                    with open(offset_path, "w") as o:
+                        o.write(str(f.tell() - len(line)))
+                    self.counts['replayed'] += replayed
+                    return False
+                replayed += 1
+            self.counts['replayed'] += replayed
+            if replayed:
+                logger.info(f"Replayed {replayed} spooled events from {name}")
+            os.unlink(path)
+            try:
+                os.unlink(offset_path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def drain(self):
+        """Drain every closed segment, then this process's active one
+
+        Returns:
+            bool: False if the broker couldn't be reached
+        """
+        for name in self.segments():
+            if not self.drain_segment(name):
+                return False
+        with self.cond:
+            if not self.spooling or time.monotonic() - self.last_failure < 1:
+                return True
+            # hold off new writes while the last of this process's spool goes out, then stop spooling
+            self.close_segment()
+            for name in self.segments():
+                if f"-{os.getpid()}-" in name and not self.drain_segment(name):
+                    return False
+            self.spooling = False
+            logger.info("Spool drained, publishing events to the broker directly again")
+        return True
+
+    def drain_forever(self):
+        backoff = 1
+        while True:
+            time.sleep(backoff)
+            try:
+                ok = self.drain()
+            except Exception as e:
+                logger.error(f"Error draining spool: {e!r}")
+                ok = False
+            backoff = 1 if ok else min(backoff * 2, 30)
+
+    def stats(self):
+        r = dict(self.counts, spooling=self.spooling)
+        try:
+            r['segments'] = len(self.segments())
+        except OSError:
+            pass
+        return r
+
+
+spool = None
+spool_pid = None
+spool_lock = threading.Lock()
+
+
+def get_spool(publish):
+    """Get this process's spool, or None if spooling is turned off or the spool dir can't be used"""
+    global spool, spool_pid
+    if not SPOOL_DIR:
+        return None
+    if spool_pid != os.getpid():
+        with spool_lock:
+            if spool_pid != os.getpid():
+                # listener workers are forked, and each one needs its own segment and drainer thread
+                spool_pid = os.getpid()
+                try:
+                    spool = Spool(publish)
+                    pdaltagent.stats.register("spool", spool.stats)
+                except OSError as e:
+                    logger.error(f"Couldn't use spool dir {SPOOL_DIR}, events won't be spooled: {e}")
+                    spool = None
+    return spool
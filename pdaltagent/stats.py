@@ -0,0 +1,97 @@
+import os
+import sys
+import json
+import time
+import tempfile
+
+# Each process writes a snapshot of its counters to its own file in STATS_DIR, so that
+# stats from all the prefork worker children can be collected in one place (for example
+# by the admin API) without any IPC.
+STATS_DIR = os.environ.get("PDAGENTD_STATS_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "pdaltagent-stats"
+)
+STATS_INTERVAL_SECONDS = 10
+if os.environ.get("PDAGENTD_STATS_INTERVAL_SECONDS"):
+    try:
+        STATS_INTERVAL_SECONDS = float(os.environ.get("PDAGENTD_STATS_INTERVAL_SECONDS"))
+    except:
+        pass
+
+_providers = {}
+_last_dump = 0
+
+
+def register(name, provider):
+    """Register a function that returns a JSON-serializable dict of stats under name"""
+    _providers[name] = provider
+
+
+def snapshot():
+    """Return the current stats of every registered provider in this process"""
+    r = {}
+    for name, provider in list(_providers.items()):
+        try:
+            r[name] = provider()
+        except Exception as e:
+            r[name] = {"error": str(e)}
+    return r
+
+
+def dump():
+    """Write this process's stats snapshot to STATS_DIR"""
+    global _last_dump
+    _last_dump = time.monotonic()
+    if not _providers:
+        return
+    try:
+        os.makedirs(STATS_DIR, exist_ok=True)
+        path = os.path.join(STATS_DIR, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "pid": os.getpid(),
+                "process": " ".join(sys.argv),
+                "time": time.time(),
+                "stats": snapshot(),
+            }, f, default=str)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def maybe_dump():
+    """Dump stats if it's been more than STATS_INTERVAL_SECONDS since the last dump"""
+    if time.monotonic() - _last_dump >= STATS_INTERVAL_SECONDS:
+        dump()
+
+
+def collect():
+    """Read the stats snapshots of all live processes on this host"""
+    r = []
+    try:
+        filenames = os.listdir(STATS_DIR)
+    except OSError:
+        return r
+    for filename in filenames:
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(STATS_DIR, filename)
+        try:
+            with open(path) as f:
+                s = json.load(f)
+            try:
+                os.kill(s["pid"], 0)
+            except PermissionError:
+                # process exists but belongs to another user (e.g. celery)
+                pass
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        except (OSError, ValueError, KeyError):
+            continue
+        r.append(s)
+    return r
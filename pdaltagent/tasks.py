@@ -6,53 +6,170 @@ import logging
 import json
 import random
 from requests import HTTPError
+import pdaltagent.stats
 from pdaltagent.config import app
 from pdaltagent.plugin_host import PluginHost
+from pdaltagent.rate_limiter import rate_limiter
+from pdaltagent.coalescer import coalescer
+from pdaltagent.regex_guard import regex_guard
 from celery.utils.log import get_task_logger
+from celery.signals import task_postrun, worker_process_shutdown
 from celery import Task
 
 class SendTask(Task):
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         logger.warning(f"Failed to send {args[1]!r} to {args[0]}: {exc}")
 
+class SendEventTask(SendTask):
+    def apply_async(self, args=None, kwargs=None, **options):
+        # give each new event its place in line for coalescing; retries keep the seq they already have
+        kwargs = dict(kwargs or {})
+        if 'seq' not in kwargs:
+            args = list(args or [])
+            routing_key = args[0] if len(args) > 0 else kwargs.get('routing_key')
+            payload = args[1] if len(args) > 1 else kwargs.get('payload')
+            destination_type = args[3] if len(args) > 3 else kwargs.get('destination_type', "v2")
+            kwargs['seq'] = coalescer.enqueued(routing_key, payload, destination_type)
+        return super().apply_async(args, kwargs, **options)
+
 plugin_host = PluginHost(True if os.environ.get("PDAGENTD_DEBUG") else False)
+pdaltagent.stats.register("plugins", plugin_host.stats)
 
 logger = get_task_logger(__name__)
 if os.getenv('PDAGENTD_DEBUG'):
     logger.level = logging.DEBUG
 
-@app.task(base=SendTask,
-          bind=True,
-          throws=(HTTPError,),
-          retry_backoff=True,
-          max_retries=None,
-          acks_late=True)
-def send_to_pd(self, routing_key, payload, base_url="https://events.pagerduty.com", destination_type="v2"):
+@task_postrun.connect
+def dump_stats(**kwargs):
+    pdaltagent.stats.maybe_dump()
+
+@worker_process_shutdown.connect
+def log_stats(**kwargs):
+    logger.info(f"HTTP connection pool stats: {json.dumps(pd.pool_stats())}")
+    pdaltagent.stats.dump()
+
+def retry_countdown(retries):
+    """Seconds to wait before retrying an event that was rate limited by PagerDuty"""
+    return int(random.uniform(3, 5) * (retries + 1))
+
+def rate_limited_countdown(retries, routing_key, destination_type, retry_after=None):
+    """Record a 429 from PagerDuty for a routing key and return the seconds to wait before retrying
+
+    Args:
+        retries (int): how many times the event has been retried already
+        retry_after (str, optional): the Retry-After header of the 429 response
+    """
+    return max(retry_countdown(retries), rate_limiter.rate_limited(routing_key, destination_type, retry_after))
+
+def deferred_arguments(args, r):
+    """The arguments to requeue a send_to_pd task with when it's deferred by the rate limiter: the event as the
+    plugins left it, so they don't run on it again, with the rate limit token that acquire() reserved for it
+
+    Args:
+        args (dict): the task's arguments by name
+        r (tuple): (payload, routing_key, destination_type) after filtering
+    """
+    (_payload, _routing_key, _destination_type) = r
+    return dict(args, routing_key=_routing_key, payload=_payload, destination_type=_destination_type, filtered=True, rate_reserved=True)
+
+def defer(task, countdown, arguments):
+    """Requeue the event that a send_to_pd task is running for, to be sent after countdown seconds with arguments
+    from deferred_arguments(). Unlike Task.retry(), this doesn't count as a retry"""
+    request = task.request
+    task.apply_async((), arguments, task_id=request.id, retries=request.retries, countdown=countdown)
+
+def filter_event(routing_key, payload, destination_type="v2"):
+    """Run an event through the filter_event plugins
+
+    Returns:
+        tuple: (payload, routing_key, destination_type) after filtering, or None if the event was suppressed
+    """
     logger.debug(f"Before filter event, routing key: {routing_key}, type: {destination_type}, payload: {json.dumps(payload)}")
     time_before_filter = time.time()
-    r = plugin_host.filter_event(payload, routing_key, destination_type)
+    with regex_guard.event():
+        r = plugin_host.filter_event(payload, routing_key, destination_type)
     time_after_filter = time.time()
     filter_time = round(time_after_filter - time_before_filter, 2)
     if ( filter_time > 5):
         logger.warning(f"Event filtering took too long! ({filter_time} seconds) for event: {json.dumps(payload)}")
-    if r is None:
-        return ('event suppressed', json.dumps(payload))
+    if r is not None:
+        (_payload, _routing_key, _destination_type) = r
+        logger.debug(f"After filter event, routing key: {_routing_key}, type: {_destination_type}, payload: {json.dumps(_payload)}")
+    return r
+
+def filter_events(items):
+    """Run a batch of events through the filter_event plugins, with plugins that implement filter_events
+    getting the whole batch at once
+
+    Args:
+        items (list): (routing_key, payload, destination_type) tuples
+
+    Returns:
+        list: for each event, (payload, routing_key, destination_type) after filtering, or None if the event was suppressed
+    """
+    time_before_filter = time.time()
+    with regex_guard.event(len(items)):
+        results = plugin_host.filter_events([(payload, routing_key, destination_type) for (routing_key, payload, destination_type) in items])
+    time_after_filter = time.time()
+    filter_time = round(time_after_filter - time_before_filter, 2)
+    if ( filter_time > 5 * max(len(items), 1)):
+        logger.warning(f"Event filtering took too long! ({filter_time} seconds) for a batch of {len(items)} events")
+    logger.debug(f"Filtered a batch of {len(items)} events in {filter_time} seconds, {len([r for r in results if r is None])} suppressed")
+    return results
+
+async def filter_event_async(routing_key, payload, destination_type="v2"):
+    """filter_event for callers running on an event loop, which awaits async filter_event plugins instead
+    of blocking on them
+
+    Returns:
+        tuple: (payload, routing_key, destination_type) after filtering, or None if the event was suppressed
+    """
+    time_before_filter = time.time()
+    r = await plugin_host.filter_event_async(payload, routing_key, destination_type)
+    filter_time = round(time.time() - time_before_filter, 2)
+    if ( filter_time > 5):
+        logger.warning(f"Event filtering took too long! ({filter_time} seconds) for event: {json.dumps(payload)}")
+    return r
+
+@app.task(base=SendEventTask,
+          bind=True,
+          throws=(HTTPError,),
+          retry_backoff=True,
+          max_retries=None,
+          acks_late=True)
+def send_to_pd(self, routing_key, payload, base_url="https://events.pagerduty.com", destination_type="v2", seq=None, rate_reserved=False, filtered=False):
+    if filtered:
+        # deferred after it was filtered, and checked for coalescing before that
+        r = (payload, routing_key, destination_type)
+    else:
+        if coalescer.superseded(routing_key, payload, destination_type, seq):
+            return ('event coalesced', json.dumps(payload))
+        r = filter_event(routing_key, payload, destination_type)
+        if r is None:
+            return ('event suppressed', json.dumps(payload))
     (_payload, _routing_key, _destination_type) = r
-    logger.debug(f"After filter event, routing key: {_routing_key}, type: {_destination_type}, payload: {json.dumps(_payload)}")
+    delay = rate_limiter.acquire(_routing_key, _destination_type, reserved=rate_reserved)
+    if delay > 0:
+        args = dict(routing_key=routing_key, payload=payload, base_url=base_url, destination_type=destination_type, seq=seq)
+        defer(self, delay, deferred_arguments(args, r))
+        return ('event deferred', round(delay, 2))
     r = None
     try:
         r = pd.send_event(_routing_key, _payload, base_url, _destination_type)
     except HTTPError as e:
         if e.response.status_code == 429:
-            raise self.retry(exc=e, countdown=int(random.uniform(3, 5) * (self.request.retries + 1)))
+            countdown = rate_limited_countdown(self.request.retries, _routing_key, _destination_type, e.response.headers.get('Retry-After'))
+            # the retry is another send, which needs a token of its own
+            raise self.retry(exc=e, countdown=countdown, kwargs=dict(self.request.kwargs, rate_reserved=False))
         raise e
     return (_routing_key, r)
 
-@app.task(base=SendTask,
-          bind=True,
-          throws=(HTTPError,),
-          retry_backoff=15)
-def send_webhook(self, url, payload):
+def filter_webhook(url, payload):
+    """Run a webhook through the filter_webhook plugins
+
+    Returns:
+        tuple: (payload, url) after filtering, or None if the webhook was suppressed
+    """
     logger.debug(f"Before filter webhook, url: {url}, payload: {json.dumps(payload)}")
     time_before_filter = time.time()
     r = plugin_host.filter_webhook(payload, url)
@@ -60,15 +177,38 @@ def send_webhook(self, url, payload):
     filter_time = round(time_after_filter - time_before_filter, 2)
     if ( filter_time > 5):
         logger.warning(f"Webhook filtering took too long! ({filter_time} seconds) for webhook: {json.dumps(payload)}")
+    if r is not None:
+        (_payload, _url) = r
+        logger.debug(f"After filter webhook, url: {_url}, payload: {json.dumps(_payload)}")
+    return r
+
+async def filter_webhook_async(url, payload):
+    """filter_webhook for callers running on an event loop, like filter_event_async
+
+    Returns:
+        tuple: (payload, url) after filtering, or None if the webhook was suppressed
+    """
+    time_before_filter = time.time()
+    r = await plugin_host.filter_webhook_async(payload, url)
+    filter_time = round(time.time() - time_before_filter, 2)
+    if ( filter_time > 5):
+        logger.warning(f"Webhook filtering took too long! ({filter_time} seconds) for webhook: {json.dumps(payload)}")
+    return r
+
+@app.task(base=SendTask,
+          bind=True,
+          throws=(HTTPError,),
+          retry_backoff=15)
+def send_webhook(self, url, payload):
+    r = filter_webhook(url, payload)
     if r is None:
         return ('webhook suppressed', url, json.dumps(payload))
     (_payload, _url) = r
-    logger.debug(f"After filter webhook, url: {_url}, payload: {json.dumps(_payload)}")
     r = None
     try:
         r = requests.post(_url, json=_payload)
     except HTTPError as e:
         if e.response.status_code == 429:
-            raise self.retry(exc=e, countdown=int(random.uniform(3, 5) * (self.request.retries + 1)))
+            raise self.retry(exc=e, countdown=retry_countdown(self.request.retries))
         raise e
     return (_url, r)
@@ -1,5 +1,283 @@
+import os
+
 from pdaltagent import __version__
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_scrub_cache_matches_uncached(monkeypatch):
+    from pdaltagent.scrubber import Scrubber, StringCache, REDACTED
+    from pdaltagent.regex_guard import regex_guard
+    event = {
+        'routing_key': 'R0000000000000000000000000000000',
+        'payload': {
+            'summary': 'Mail ops@example.com or call 415-555-1234 from 10.0.0.1',
+            'source': 'web-01.example.com',
+            'custom_details': {'count': 12345, 'lines': ['no pii here', 'zip 94107', 'no pii here']},
+        },
+    }
+    uncached = Scrubber()
+    (big, small) = (StringCache(), StringCache(max_entries=2, max_bytes=1024))
+    for cache in [big, small]:
+        cached = Scrubber(cache=cache)
+        for _ in range(3):
+            assert cached.scrub(event) == uncached.scrub(event)
+    assert big.counts['hits'] > 0
+    assert len(small.entries) <= 2
+
+    # a string redacted because an event ran out of regex time is scrubbed again for the next event
+    cached = Scrubber(cache=StringCache())
+    string = 'host web-01.example.com is down'
+    with monkeypatch.context() as m:
+        m.setattr(regex_guard, 'event_budget', 0.0001 / 1000)
+        with regex_guard.event():
+            assert cached.scrub_string(string) == REDACTED
+    assert cached.scrub_string(string) == uncached.scrub_string(string) == 'host {{LINK}} is down'
+
+    # \d matches more than 0-9, so the prefilters have to as well
+    string = 'call \u0665\u0665\u0665\u0661\u0662\u0663\u0664\u0665\u0666\u0667'
+    assert uncached.scrub_string(string) == 'call {{PHONE}}'
+
+
+def test_catastrophic_regex_is_stopped_outside_the_main_thread():
+    import threading
+    from pdaltagent.regex_guard import RegexGuard
+    guard = RegexGuard()
+    results = []
+
+    def run():
+        with guard.event():
+            results.append(guard.search(r'(a+)+$', 'a' * 30 + 'b'))
+            results.append(guard.search(r'(a+)+$', 'aaaa').span())
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert results == [None, (0, 4)]
+    assert guard.counts['workers_killed'] == 1 and guard.counts['advisory_budget_calls'] == 0
+
+
+def test_compiled_conditions_match_interpreter():
+    from pdaltagent.enrichment import Enrichment
+    enrich = Enrichment(None, broken_regex=True, prepend_path='payload.custom_details.')
+    conditions = [
+        None,
+        {'=': ['host', 'Web-01']},
+        {'!=': ['host', {'type': 'regex', 'value': 'web-*'}]},
+        {'IN': ['check', ['cpu', 'Disk', {'type': 'formal-regex', 'value': '^mem(ory'}]]},
+        {'NOT IN': ['check', ['cpu', 'disk']]},
+        {'=': ['.payload.source', {'type': 'regex', 'value': '(db|web)-0[0-9]'}]},
+        {'=': ['tags.1', 'b']},
+        {'AND': [{'=': ['host', 'web-01']}, {'OR': [{'IN': ['check', ['cpu']]}, {'!=': ['env', 'prod']}]}]},
+        {'OR': [{'=': ['host', 'db-01']}], '=': ['check', 'cpu']},
+        {'=': ['host', {'type': 'unknown', 'value': 'x'}]},
+        {'in': ['host', ['web-01']]},
+        enrich.text_BPQL_to_json('host = "web*" AND check IN ["cpu", "disk"]'),
+    ]
+    events = [
+        {'payload': {'source': 'web-01', 'custom_details': {'host': 'web-01', 'check': 'cpu', 'tags': ['a', 'b']}}},
+        {'payload': {'source': 'db-07', 'custom_details': {'host': 'DB-01', 'check': 'memory', 'env': 'prod'}}},
+        {'payload': {'source': 'x', 'custom_details': {'check': 'Disk', 'tags': 'ab'}}},
+        {'payload': {'source': 'DB-01', 'custom_details': {'host': 'WEB-\u017f01', 'check': 'MEMORY(ory'}}},
+        {'payload': {}},
+    ]
+
+    def outcome(fn):
+        try:
+            return fn()
+        except Exception as e:
+            return type(e)
+
+    for condition in conditions:
+        predicate = enrich.compile_condition(condition)
+        for event in events:
+            assert outcome(lambda: predicate(event)) == outcome(lambda: enrich.evaluate_condition(event, condition)), (condition, event)
+
+
+def test_rule_index_matches_every_rule():
+    import copy
+    from pdaltagent.enrichment import Enrichment
+    from pdaltagent.rule_index import RuleIndex
+    enrich = Enrichment(None, prepend_path='payload.custom_details.')
+
+    def compose(destination, value):
+        return {'type': 'composition', 'config': {'destination': destination, 'value': value}}
+
+    rules = [
+        dict(compose('team', 'web'), id='1', when={'=': ['host', 'web-01']}),
+        # changes check, which later rules are indexed on
+        dict(compose('check', 'disk'), id='2', when={'IN': ['check', ['CPU', 'load']]}),
+        dict(compose('severity', 'high'), id='3', when={'AND': [{'=': ['check', 'disk']}, {'!=': ['env', 'dev']}]}),
+        dict(compose('owner', 'dba'), id='4', when={'=': ['host', {'type': 'regex', 'value': 'db-*'}]}),
+        dict(compose('routed', 'yes'), id='5', when={'AND': [{'IN': ['team', ['web', 'db']]}, {'=': ['check', 'disk']}]}),
+        dict(compose('check', 'cpu'), id='6', when={'OR': [{'=': ['env', 'prod']}, {'=': ['env', 'stage']}]}),
+        dict(compose('cpu_again', 'yes'), id='7', when={'=': ['check', 'cpu']}),
+        dict(compose('never', 'yes'), id='8', when={'IN': ['check', []]}),
+        dict(compose('port', 'yes'), id='9', when={'=': ['port', '80']}),
+    ]
+    events = [
+        {'payload': {'custom_details': {'host': 'web-01', 'check': 'cpu', 'env': 'prod'}}},
+        {'payload': {'custom_details': {'host': 'DB-02', 'check': 'Load', 'port': 80}}},
+        {'payload': {'custom_details': {'host': 'web-01', 'env': 'dev', 'check': 'disk'}}},
+        {'payload': {}},
+    ]
+    for set_type in ('match_all', 'match_first'):
+        enrich.enrichments = [{'name': 'test', 'type': set_type, 'rules': rules}]
+        enrich.compile_conditions()
+        indexed = [enrich.enrich_event(copy.deepcopy(event)) for event in events]
+        # every rule checked for every event, as before the index
+        enrich.rule_index = lambda enrichment_set: RuleIndex([None] * len(enrichment_set['rules']))
+        assert indexed == [enrich.enrich_event(copy.deepcopy(event)) for event in events]
+        del enrich.rule_index
+    assert enrich.predicates[(id(enrich.enrichments[0]), 'rules', None)][1].stats()['always_checked'] == 2
+
+
+def test_mapping_store_finds_rows_with_duplicate_keys(tmp_path):
+    from pdaltagent.mapping_store import MappingStore
+    # most rows share their env and team, which used to make building the index quadratic
+    rows = [{'_id': i, 'host': f'host-{i}', 'env': 'prod' if i % 50 else 'Dev', 'team': ['web', 'db'][i % 2]} for i in range(5000)]
+    rows.append({'_id': 5000, 'host': 'host-7', 'env': 'stage', 'team': 'web'})
+    path = str(tmp_path / 'mapping_test.store')
+    MappingStore.build(path, iter(rows), 'test', ['host', 'env', 'team'])
+    store = MappingStore(path)
+
+    def find(query, case_insensitive=False):
+        for row in rows:
+            if all(row.get(f) == v or case_insensitive and str(row.get(f)).lower() == str(v).lower() for (f, v) in query.items()):
+                return {f: v for (f, v) in row.items() if f != '_id'}
+        return None
+
+    queries = [
+        {'env': 'prod'},
+        {'env': 'dev'},
+        {'env': 'Dev', 'team': 'web'},
+        {'env': 'Dev', 'team': 'db'},
+        {'host': 'host-7', 'env': 'stage'},
+        {'team': 'web', 'host': 'host-4999'},
+        {'team': 'db', 'host': 'host-4999'},
+        {'env': 'qa'},
+    ]
+    for query in queries:
+        for case_insensitive in (False, True):
+            assert store.find_one(query, case_insensitive) == find(query, case_insensitive), (query, case_insensitive)
+    assert store.find_one({'owner': 'x'}) is NotImplemented
+
+
+class CpuBoundPlugin:
+    cpu_bound = True
+
+    def filter_event(self, event):
+        return dict(event, pid=os.getpid())
+
+
+# set before the billiard pool forks, since the filter can't be pickled
+cpu_bound_filter = None
+
+
+def call_cpu_bound_filter(i):
+    return (os.getpid(), cpu_bound_filter.call({'i': i}, None, 'v2'))
+
+
+def test_cpu_bound_plugin_in_billiard_pool(tmp_path, monkeypatch):
+    global cpu_bound_filter
+    import sys
+    import types
+    import billiard
+    import pdaltagent
+    if 'pdaltagent.plugins' not in sys.modules:
+        # the plugins directory only exists where PDaltagent is deployed
+        plugins = types.ModuleType('pdaltagent.plugins')
+        plugins.__path__ = [str(tmp_path)]
+        monkeypatch.setitem(sys.modules, 'pdaltagent.plugins', plugins)
+        monkeypatch.setattr(pdaltagent, 'plugins', plugins, raising=False)
+    from pdaltagent import plugin_host
+    # celery's worker processes are daemonic, so they can't start plugin processes of their own, and with no
+    # plugin pool to reach they run the plugin themselves
+    monkeypatch.setattr(plugin_host, 'PLUGIN_POOL_SOCKET', str(tmp_path / 'plugin_pool.sock'))
+    monkeypatch.setattr(plugin_host, 'pool_retry_at', 0)
+    cpu_bound_filter = plugin_host.CompiledFilter(CpuBoundPlugin().filter_event, 'filter_event')
+    assert cpu_bound_filter.cpu_bound
+    try:
+        with billiard.Pool(2) as pool:
+            results = pool.map(call_cpu_bound_filter, range(4))
+    finally:
+        cpu_bound_filter = None
+    assert [event['i'] for (pid, event) in results] == list(range(4))
+    assert all(event['pid'] == pid and pid != os.getpid() for (pid, event) in results)
+
+
+POOL_PLUGIN = """
+import os
+import time
+import datetime
+
+
+class Plugin:
+    cpu_bound = True
+    timeout = 1
+
+    def filter_event(self, event):
+        if 'sleep' in event:
+            time.sleep(event['sleep'])
+        if 'fail' in event:
+            raise ValueError(event['fail'])
+        if 'date' in event:
+            # marshal can't encode this, so the result comes back pickled
+            return dict(event, date=datetime.date(*event['date']))
+        return dict(event, pid=os.getpid())
+"""
+
+
+def test_cpu_bound_plugin_in_plugin_pool(tmp_path, monkeypatch):
+    import sys
+    import datetime
+    import importlib
+    import types
+    import pytest
+    import threading
+    import time
+    import multiprocessing
+    import pdaltagent
+    if 'pdaltagent.plugins' not in sys.modules:
+        plugins = types.ModuleType('pdaltagent.plugins')
+        plugins.__path__ = [str(tmp_path)]
+        monkeypatch.setitem(sys.modules, 'pdaltagent.plugins', plugins)
+        monkeypatch.setattr(pdaltagent, 'plugins', plugins, raising=False)
+        # spawned plugin processes couldn't import the stand-in for the plugins directory, forked ones have it
+        from pdaltagent import plugin_pool
+        monkeypatch.setattr(plugin_pool, 'multiprocessing', types.SimpleNamespace(get_context=lambda method: multiprocessing.get_context('fork')))
+    from pdaltagent import plugin_host
+    from pdaltagent.plugin_pool import PluginPool
+    (tmp_path / 'pool_plugin.py').write_text(POOL_PLUGIN)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    address = str(tmp_path / 'pool' / 'plugin_pool.sock')
+    pool = PluginPool(address, processes=2)
+    threading.Thread(target=pool.serve, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(address) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    monkeypatch.setattr(plugin_host, 'PLUGIN_POOL_SOCKET', address)
+    monkeypatch.setattr(plugin_host, 'pool_client', None)
+    monkeypatch.setattr(plugin_host, 'pool_retry_at', 0)
+    step = plugin_host.CompiledFilter(importlib.import_module('pool_plugin').Plugin().filter_event, 'filter_event')
+    try:
+        event = step.call({'i': 1}, None, 'v2')
+        assert event['i'] == 1 and event['pid'] != os.getpid()
+        assert plugin_host.pool_client is not None and not plugin_host.pool_client.closed
+        assert step.call({'date': [2024, 2, 29]}, None, 'v2')['date'] == datetime.date(2024, 2, 29)
+        with pytest.raises(ValueError, match='bad event'):
+            step.call({'fail': 'bad event'}, None, 'v2')
+        with pytest.raises(TimeoutError):
+            step.call({'sleep': 3}, None, 'v2')
+        # the connection and the other process are still there for the next call
+        assert step.call({'i': 2}, None, 'v2')['i'] == 2
+        assert not plugin_host.pool_client.closed
+    finally:
+        if plugin_host.pool_client is not None:
+            plugin_host.pool_client.close()
+        if pool.executor is not None:
+            pool.executor.shutdown(wait=True, cancel_futures=True)
+        sys.modules.pop('pool_plugin', None)